@@ -2,11 +2,15 @@ import datetime
 import json
 import os
 import pickle
+import sys
 import music21
 import re
 from fractions import Fraction
 from typing import Dict, List, Tuple, Any, Optional
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from abc_lexer import ABCLexerError, split_voices_tokens
+
 def encode_abc_to_tokens(abc_text: str) -> Tuple[bool, Dict[str, Any]]:
     """
     - Takes ABC text
@@ -38,17 +42,21 @@ def encode_abc_to_tokens(abc_text: str) -> Tuple[bool, Dict[str, Any]]:
     data = abc_text
 
     try:
-        abc = music21.abcFormat.ABCHandler()
-        abc.process(data)
+        # Same tokens as music21's parse, which is only used for what the lexer does not cover
+        try:
+            voices = split_voices_tokens(data)
+        except ABCLexerError:
+            abc = music21.abcFormat.ABCHandler()
+            abc.process(data)
+            voices = [voice_to_tokens(voice) for voice in abc.splitByVoice()]
 
         voice_tokens: Dict[int, List[str]] = {}
         unused_tokens = set()
         is_there_a_voice = False
 
-        for i, voice in enumerate(abc.splitByVoice()):
+        for i, (tokens, local_unused) in enumerate(voices):
             is_there_a_voice = True
 
-            tokens, local_unused = voice_to_tokens(voice)
             voice_tokens[i] = tokens
             unused_tokens.update(local_unused)
 
@@ -0,0 +1,90 @@
+import json
+import os
+import sys
+import time
+import shutil
+import hashlib
+import music21
+
+sys.path.append("./scripts")
+from data_pipeline_lib import Process
+import abc_lexer
+import tokenize_abc
+
+# Compare the lexer with music21 on the ABC files of the folder given as argument (e.g. ./scripts/Sandbox/abc_lexer_samples),
+# or on one file out of SAMPLE_EVERY of the cleaned corpus without argument
+SAMPLE_EVERY = 10
+# Each parse is timed REPEAT_COUNT times, its fastest time being kept
+REPEAT_COUNT = 5
+
+def time_function(function, data: str):
+    result = None
+    best_time = None
+    for _ in range(REPEAT_COUNT):
+        start_time = time.perf_counter()
+        result = function(data)
+        elapsed = time.perf_counter() - start_time
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return result, best_time
+
+def parse_with_music21(data: str):
+    try:
+        abc = music21.abcFormat.ABCHandler()
+        abc.process(data)
+        return [tokenize_abc.voice_to_tokens(voice) for voice in abc.splitByVoice()]
+    except Exception:
+        return None
+
+def parse_with_lexer(data: str):
+    try:
+        return abc_lexer.split_voices_tokens(data)
+    except abc_lexer.ABCLexerError as e:
+        return e
+
+def compare(from_path: str):
+    with open(from_path) as abc_file:
+        data = abc_file.read()
+
+    music21_voices_tokens, music21_time = time_function(parse_with_music21, data)
+    lexer_voices_tokens, lexer_time = time_function(parse_with_lexer, data)
+
+    if isinstance(lexer_voices_tokens, abc_lexer.ABCLexerError):
+        # Not covered by the lexer: tokenize_abc uses music21 for this file
+        return (from_path, None, music21_time, lexer_time, str(lexer_voices_tokens))
+
+    if lexer_voices_tokens != music21_voices_tokens:
+        return (from_path, False, music21_time, lexer_time, "music21 failed" if music21_voices_tokens is None else "different tokens")
+
+    return (from_path, True, music21_time, lexer_time, None)
+
+def process_function(from_path: str, to_path: str):
+    if int(hashlib.md5(from_path.encode()).hexdigest(), 16) % SAMPLE_EVERY != 0:
+        return None
+    return compare(from_path)
+
+if len(sys.argv) > 1:
+    # Files are compared one after another, so that timings are not disturbed by other workers
+    results = [compare(os.path.join(root, file_name)) for root, _, file_names in sorted(os.walk(sys.argv[1])) for file_name in sorted(file_names) if file_name.endswith(".abc")]
+else:
+    process = Process("verify_abc_lexer", "./midi/lmd_matched_flat_sanitized_abc_clean", "./midi/lmd_matched_flat_sanitized_abc_clean_tmp")
+    results = [result for result in process.step_by_function(process_function, useProcessExecutor=True, adaptive_chunking=True) if result is not None]
+
+    shutil.rmtree("./midi/lmd_matched_flat_sanitized_abc_clean_tmp")
+
+wrong_abc_files = {from_path: reason for from_path, is_same, _, _, reason in results if is_same is False}
+fallback_abc_files = {from_path: reason for from_path, is_same, _, _, reason in results if is_same is None}
+
+# The speedup is measured on the files the lexer covers, the others being parsed by music21 anyway
+covered_results = [result for result in results if result[1] is not None]
+music21_time = sum(result[2] for result in covered_results)
+lexer_time = sum(result[3] for result in covered_results)
+
+print("[verify_abc_lexer] {} file(s) compared: {} different, {} not covered by the lexer.".format(len(results), len(wrong_abc_files), len(fallback_abc_files)))
+print("[verify_abc_lexer] Covered files: music21 {:.3f}s, lexer {:.3f}s (x{:.1f}).".format(music21_time, lexer_time, music21_time / max(lexer_time, 1e-9)))
+
+os.makedirs("./results", exist_ok=True)
+with open("./results/failed_jobs_{}.json".format("verify_abc_lexer"), "w") as wrong_file:
+    json.dump({"different": wrong_abc_files, "not_covered": fallback_abc_files}, wrong_file)
+
+if len(wrong_abc_files) > 0:
+    sys.exit(1)
@@ -0,0 +1,277 @@
+import re
+
+
+# Streaming lexer for the ABC written by midi2abc, producing the same voice tokens as
+# music21's ABCHandler.process() + splitByVoice() followed by tokenize_abc.voice_to_tokens().
+# Only the constructs midi2abc emits are handled (fields, comments, bars, notes, rests, chords,
+# ties and simple tuplets): anything else raises ABCLexerError so that callers fall back to music21.
+
+
+class ABCLexerError(Exception):
+    pass
+
+
+# Same alternatives, in the same order, as music21.abcFormat.ABCHandler.tokenize()
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>%[^\n]*)
+    | (?P<field>[A-Zw]:(?=[^|])[^\n]*)
+    | (?P<bar>:\|[12]|\|\]|\|\||\[\||\[[12]|\|[12]|:\||\|:|::|\||:)
+    | (?P<tuplet>\([1-9](?=[^:]))
+    | (?P<tie>-)
+    | (?P<chord>\[[^\]]*\][0-9/]*)
+    | (?P<note>(?P<accidentals>[\^=_]*)(?P<pitch>[A-Ga-gz])(?P<suffix>[0-9,/']*))
+    | (?P<space>[\s\\]+)
+    | (?P<error>[\s\S])
+""", re.VERBOSE)
+
+# Chords music21 parses without raising: notes with an inner length, then an outer length
+CHORD_PATTERN = re.compile(r"\[(?:[\^=_]*[A-Ga-g][,']*[0-9]*(?:/[0-9]*)?)+\][0-9]*(?:/[0-9]*)?")
+
+VERSION_PATTERN = re.compile(r"%abc-(\d+)\.(\d+)\.?(\d+)?")
+DIRECTIVE_PATTERN = re.compile(r"^%%([a-z\-]+)\s+(\S+)(.*)")
+DEFAULT_NOTE_LENGTH_PATTERN = re.compile(r"(\d+)/(\d+|G)")
+METER_PATTERN = re.compile(r"(\d+)/(\d+)")
+
+# Bars that music21 replaces with two ABCBar tokens
+DOUBLE_BARS = {"::", "|1", "|2", ":|1", ":|2"}
+
+KEY_NAMES = sorted(["c", "g", "d", "a", "e", "b", "f#", "g#", "a#", "f", "bb", "eb", "d#", "ab", "e#", "db", "c#", "gb", "cb", "hp"], key=len, reverse=True)
+KEY_MODES = (("dor", "dorian"), ("phr", "phrygian"), ("lyd", "lydian"), ("mix", "mixolydian"), ("maj", "major"), ("ion", "ionian"), ("aeo", "aeolian"), ("m", "minor"))
+MODE_SHARPS = {"major": 0, "ionian": 0, "minor": -3, "aeolian": -3, "dorian": -2, "phrygian": -4, "lydian": 1, "mixolydian": -1, "locrian": -5}
+FIFTHS_ORDER = "FCGDAEB"
+
+_pitch_name_cache = {}
+_quarter_length_cache = {}
+
+
+def get_key_sharps(data: str):
+    # music21.abcFormat.ABCMetadata.getKeySignatureParameters() followed by key.pitchToSharps()
+    key_name = "C"
+    remain = ""
+    for target in KEY_NAMES:
+        if target == data[:len(target)].lower():
+            key_name = data[:len(target)]
+            remain = data[len(target):]
+            break
+
+    mode = None
+    remain = remain.strip()
+    if remain == "":
+        mode = "major"
+    else:
+        for match, mode_name in KEY_MODES:
+            if remain.lower().startswith(match):
+                mode = mode_name
+                break
+
+    if key_name == "HP":
+        key_name, mode = "C", None
+    elif key_name == "Hp":
+        key_name, mode = "D", None
+    elif key_name.lower() == "hp":
+        raise ABCLexerError("unsupported key: {}".format(data))
+
+    sharps = FIFTHS_ORDER.index(key_name[0].upper()) - 1
+    if len(key_name) > 1:
+        sharps += 7 if key_name[1] == "#" else -7
+    if mode is not None:
+        sharps += MODE_SHARPS[mode]
+
+    if not -7 <= sharps <= 7:
+        raise ABCLexerError("unsupported key: {}".format(data))
+
+    return sharps
+
+def get_meter_default_quarter_length(data: str):
+    # music21.abcFormat.ABCMetadata.getDefaultQuarterLength() of a meter, restricted to meters music21 accepts
+    if data.lower() == "none":
+        return 0.5
+    if data == "C":
+        n, d = 4, 4
+    elif data == "C|":
+        n, d = 2, 2
+    else:
+        match = METER_PATTERN.fullmatch(data)
+        if match is None:
+            raise ABCLexerError("unsupported meter: {}".format(data))
+        n, d = int(match.group(1)), int(match.group(2))
+        if n == 0 or d not in (1, 2, 4, 8, 16, 32, 64):
+            raise ABCLexerError("unsupported meter: {}".format(data))
+
+    return 0.25 if n / d < 0.75 else 0.5
+
+def get_default_quarter_length(data: str):
+    match = DEFAULT_NOTE_LENGTH_PATTERN.fullmatch(data)
+    if match is None or match.group(2) == "0":
+        raise ABCLexerError("unsupported default note length: {}".format(data))
+
+    return int(match.group(1)) * 4 / (4 if match.group(2) == "G" else int(match.group(2)))
+
+def get_pitch_name(src: str, carried_accidental: str, sharps):
+    # music21.abcFormat.ABCNote.getPitchName(), keyed on the key signature sharps count
+    cache_key = (src, carried_accidental, sharps)
+    pitch_name = _pitch_name_cache.get(cache_key)
+    if pitch_name is not None:
+        return pitch_name
+
+    name = next(c for c in src if c in "abcdefgABCDEFGz")
+
+    if name == "z":
+        pitch_name = "z"
+    else:
+        octave = (5 if name.islower() else 4) - src.count(",") + src.count("'")
+        accidentals = "-" * src.count("_") + "#" * src.count("^") + "n" * src.count("=")
+        carried_accidentals = "-" * carried_accidental.count("_") + "#" * carried_accidental.count("^") + "n" * carried_accidental.count("=")
+
+        if carried_accidentals and accidentals:
+            raise ABCLexerError("carried accidentals not rendered moot: {}".format(src))
+
+        if not carried_accidentals and not accidentals and sharps is not None:
+            altered_steps = FIFTHS_ORDER[:sharps] if sharps >= 0 else FIFTHS_ORDER[::-1][:-sharps]
+            if name.upper() in altered_steps:
+                name += "#" if sharps > 0 else "-"
+
+        pitch_name = "{}{}{}".format(name.upper(), carried_accidentals or accidentals, octave)
+
+    _pitch_name_cache[cache_key] = pitch_name
+    return pitch_name
+
+def get_quarter_length(src: str, default_quarter_length: float):
+    # music21.abcFormat.ABCNote.getQuarterLength() without broken rhythms, as str() of its result
+    cache_key = (src, default_quarter_length)
+    quarter_length = _quarter_length_cache.get(cache_key)
+    if quarter_length is not None:
+        return quarter_length
+
+    number = "".join(c for c in src if c.isdigit() or c == "/")
+
+    try:
+        if number == "":
+            ql = default_quarter_length
+        elif number == "/":
+            ql = default_quarter_length * 0.5
+        elif number == "//":
+            ql = default_quarter_length * 0.25
+        elif number == "///":
+            ql = default_quarter_length * 0.125
+        elif number.startswith("/"):
+            ql = default_quarter_length / int(number.split("/")[1])
+        elif number.endswith("/"):
+            ql = default_quarter_length * int(number.split("/", maxsplit=1)[0]) / 2
+        elif number.count("/") == 2:
+            ql = 1
+        elif "/" in number:
+            n, d = number.split("/")
+            ql = default_quarter_length * int(n) / int(d)
+        else:
+            ql = default_quarter_length * int(number)
+    except (ValueError, ZeroDivisionError) as e:
+        raise ABCLexerError("unsupported length in {}: {}".format(src, e))
+
+    quarter_length = str(ql)
+    _quarter_length_cache[cache_key] = quarter_length
+    return quarter_length
+
+def split_voices_tokens(data: str):
+    """
+    Returns one (tokens, unused_tokens) pair per ABCHandler of music21's splitByVoice():
+    the common header first, then each voice (a single pair when there are less than two voices).
+    """
+    version = VERSION_PATTERN.search(data[:100])
+    propagates_accidentals = version is not None and (int(version.group(1)), int(version.group(2)), int(version.group(3) or 0)) >= (2, 0, 0)
+    directives = {}
+
+    default_quarter_length = None
+    sharps = None
+    accidentalized = {}
+
+    tokens = []
+    unused_tokens = set()
+    segments = [(tokens, unused_tokens)]
+
+    for match in TOKEN_PATTERN.finditer(data):
+        kind = match.lastgroup
+
+        if kind == "space":
+            continue
+
+        if kind == "note":
+            if default_quarter_length is None:
+                raise ABCLexerError("no active default note length provided for note processing")
+
+            src = match.group()
+            accidentals = match.group("accidentals")
+            pitch = match.group("pitch")
+
+            # Accidentals carried through the bar, including music21's handling of repeated accidentals
+            carried_accidental = ""
+            propagation = (directives.get("propagate-accidentals", "pitch")) if propagates_accidentals else "not"
+            if propagation in ("pitch", "octave"):
+                accidental_key = pitch.upper() if propagation == "pitch" else pitch + "".join(c for c in match.group("suffix") if c in ",'")
+                if accidentals:
+                    accidentalized[accidental_key] = accidentals[0] + accidentals[2:]
+                else:
+                    carried_accidental = accidentalized.get(accidental_key, "")
+
+            tokens.append(get_pitch_name(src, carried_accidental, sharps))
+            tokens.append(get_quarter_length(src, default_quarter_length))
+
+        elif kind == "bar":
+            accidentalized = {}
+            tokens.append("|")
+            if match.group() in DOUBLE_BARS:
+                tokens.append("|")
+
+        elif kind == "chord":
+            src = match.group()
+            if CHORD_PATTERN.fullmatch(src) is None:
+                raise ABCLexerError("unsupported chord: {}".format(src))
+            if default_quarter_length is None:
+                raise ABCLexerError("no active default note length provided for note processing")
+
+            tokens.append("[")
+            tokens.append(get_pitch_name(src[1:src.index("]")], "", sharps))
+            tokens.append("]")
+            tokens.append(get_quarter_length(src, default_quarter_length))
+
+        elif kind == "field":
+            src = match.group().strip()
+            tag = src[0]
+            field_data = src.split("%")[0][2:].strip()
+
+            if tag == "M":
+                meter_default_quarter_length = get_meter_default_quarter_length(field_data)
+                if default_quarter_length is None:
+                    default_quarter_length = meter_default_quarter_length
+            elif tag == "L":
+                default_quarter_length = get_default_quarter_length(field_data)
+            elif tag == "K":
+                sharps = get_key_sharps(field_data)
+            elif tag == "V" and field_data and field_data[0].isdigit():
+                tokens = []
+                unused_tokens = set()
+                segments.append((tokens, unused_tokens))
+
+            unused_tokens.add(src)
+
+        elif kind == "comment":
+            directive = DIRECTIVE_PATTERN.match(match.group())
+            if directive:
+                directives[directive.group(1)] = directive.group(2)
+
+        elif kind == "tuplet" or kind == "tie":
+            unused_tokens.add(match.group())
+
+        else:
+            raise ABCLexerError("unsupported character {!r} at position {}".format(match.group(), match.start()))
+
+    if not any(segment_tokens or segment_unused_tokens for segment_tokens, segment_unused_tokens in segments):
+        raise ABCLexerError("must process tokens before calling split")
+
+    # splitByVoice() does not split on less than two voices
+    if len(segments) <= 2:
+        tokens = [token for segment_tokens, _ in segments for token in segment_tokens]
+        unused_tokens = set().union(*(segment_unused_tokens for _, segment_unused_tokens in segments))
+        segments = [(tokens, unused_tokens)]
+
+    return segments
@@ -1,5 +1,7 @@
 import os
 import pickle
+import pyarrow.compute as pc
+from token_corpus import TokenCorpus
 
 def get_all_tokens(from_path:str):
     tokens = set()
@@ -24,9 +26,27 @@ def get_all_tokens(from_path:str):
 
     return tokens
 
+def get_all_corpus_tokens(corpus_path: str):
+    # Ids are read straight from the memory-mapped corpus, tokens outside of the vocabulary from the strings kept in its index
+    corpus = TokenCorpus(corpus_path)
+    token_ids = pc.unique(corpus.array()).to_pylist()
+    tokens = {corpus.vocabulary[token_id] for token_id in token_ids if token_id != 0}
+    if 0 in token_ids:
+        if corpus.unknown_tokens is not None:
+            tokens.update(pc.unique(pc.list_flatten(corpus.unknown_tokens)).to_pylist())
+        else:
+            tokens.add(corpus.vocabulary[0])
+    corpus.close()
+
+    return tokens
+
 
 if __name__ == "__main__":
-    tokens = get_all_tokens("./midi/lmd_matched_flat_sanitized_abc_clean_tokenized")
+    corpus_path = "./midi/lmd_matched_flat_sanitized_abc_clean_tokenized.bin"
+    if os.path.exists(corpus_path):
+        tokens = get_all_corpus_tokens(corpus_path)
+    else:
+        tokens = get_all_tokens("./midi/lmd_matched_flat_sanitized_abc_clean_tokenized")
 
     with open("results/all_tokens.pkl", "wb") as tokens_file:
         pickle.dump(tokens, tokens_file)
@@ -1,18 +1,27 @@
+import os
 import json
-import pickle
 import re
+import shutil
+import fnmatch
+import concurrent.futures
 from tqdm import tqdm
 from pathlib import Path
 import pyarrow as pa
 import pyarrow.parquet as pq
 from datasets import ClassLabel
+from token_corpus import TokenCorpus
+from metadata_index import MUSESCORE_INFO_TYPE
+from data_pipeline_lib import packed_open, walk_folder
 
 # --- CONFIG ---
 TOK_ROOT = Path("./midi/lmd_matched_flat_sanitized_abc_clean_tokenized")
+TOKEN_CORPUS_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean_tokenized.bin"
 ABC_ROOT = Path("./midi/lmd_matched_flat_sanitized_abc_clean_split")
 GENRE_JSON = Path("./results/msd_trackid_to_genre.json")
 OUT_DIR = Path("./data")
-SHARD_ROWS = 500_000  # adjust based on RAM / size
+SHARD_ROWS = 500_000  # maximum rows per parquet file
+ROW_GROUP_ROWS = 10_000  # rows buffered by each worker (bounds peak RAM)
+WORKERS = os.cpu_count()  # each worker writes its own shards of each corpus
 WRITE_TEXTS = True  # set False if you don't want the textual corpus
 WRITE_TOKENS = True  # set False if you don't want the token corpus
 
@@ -26,94 +35,179 @@ GENRES = ["Rock", "Pop", "Electronic", "Country", "RnB", "Jazz", "World", "Other
 genre_label = ClassLabel(names=GENRES)
 genre_to_id = {g:i for i,g in enumerate(GENRES)}
 
-VOICE_RE = re.compile(r"voice_(\d+)\.pkl")
 TRACK_RE = re.compile(r"track (\d+)\.abc")
 
 MIDI2ABC_T_PATH_RE = re.compile(r"T: from .*lmd_matched_flat_sanitized")
 
-def iter_dataset(root: Path, glob_str: str, compiled_regex, is_abc_text_corpus: bool = True):
+COMMON_FIELDS = [
+    ("track_id", pa.string()),
+    ("arrangement_id", pa.string()),
+    ("voice_index", pa.int64()),
+    ("program_id", pa.int64()),
+    ("program_name", pa.string()),
+    ("musescore_info", MUSESCORE_INFO_TYPE),
+    ("instrument_category", pa.int64()),
+    ("genre_category", pa.int64()),
+]
+TOKENS_SCHEMA = pa.schema(COMMON_FIELDS + [("token_sequence", pa.list_(pa.string()))])
+TEXTS_SCHEMA = pa.schema(COMMON_FIELDS + [("abc_text", pa.string())])
+
+def get_arrangements(root: Path):
+    # (track, arrangement, voice files) of a folder of files or of a packed store (see split_abc_tracks.STORAGE)
+    arrangements = []
+    for folder_path, file_paths in walk_folder(str(root)):
+        relative_parts = Path(os.path.relpath(folder_path, root)).parts
+        if len(relative_parts) == 2:
+            arrangements.append((relative_parts[0], relative_parts[1], sorted(file_paths, key=os.path.basename)))
+    return sorted(arrangements, key=lambda arrangement: arrangement[:2])
+
+def iter_abc_texts(arrangements: list, glob_str: str, compiled_regex):
+    for track_id, arrangement_id, file_paths in arrangements:
+        for path in file_paths:
+            if not fnmatch.fnmatch(os.path.basename(path), glob_str):
+                continue
+            m = compiled_regex.search(os.path.basename(path))
+            if not m:
+                print(f"WARNING: {path} does not exist.")
+                continue
+            try:
+                with packed_open(path, "r", encoding="utf-8") as abc_file:
+                    content = abc_file.read()
+                content = MIDI2ABC_T_PATH_RE.sub('T: from lmd_matched_flat_sanitized', content)
+            except Exception:
+                print(f"WARNING: Could not read '{path}'.")
+                continue
+            yield track_id, arrangement_id, int(m.group(1)), content
+
+def iter_token_corpus(corpus_path: str, start: int, stop: int):
+    # Voices are sorted by track, arrangement and voice in the corpus index, like the folders of the text corpus
+    corpus = TokenCorpus(corpus_path)
+    for i in range(start, stop):
+        track_id, arrangement_id, voice_idx = corpus.key(i)
+        yield track_id, arrangement_id, voice_idx, corpus.tokens(i)
+    corpus.close()
+
+def iter_dataset(entries, is_abc_text_corpus: bool = True):
     with open(GENRE_JSON, "r", encoding="utf-8") as f:
         msd_to_genre = json.load(f)
-    for track_dir in sorted(root.iterdir()):
-        if not track_dir.is_dir():
-            continue
-        track_id = track_dir.name
+    voice_meta_key = None
+    voice_meta = None
+    for track_id, arrangement_id, voice_idx, content in entries:
         genre_name = msd_to_genre.get(track_id)
         if genre_name is None or genre_name not in genre_to_id:
             genre_name = "Unknown"
         g_id = genre_to_id[genre_name]
-        for arr_dir in sorted(track_dir.iterdir()):
-            if not arr_dir.is_dir():
-                continue
-            arrangement_id = arr_dir.name
+
+        if voice_meta_key != (track_id, arrangement_id):
+            voice_meta_key = (track_id, arrangement_id)
             meta_path = TOK_ROOT / track_id / arrangement_id / "metadata.json"
             if not meta_path.exists():
                 print(f"WARNING: meta_path '{meta_path}' does not exist.")
+                voice_meta = None
                 continue
             with open(meta_path, "r", encoding="utf-8") as mf:
                 voice_meta = json.load(mf)
+        elif voice_meta is None:
+            continue
+
+        vm = voice_meta.get(str(voice_idx - 1) if is_abc_text_corpus else str(voice_idx))
+        if vm is None:
+            print(f"WARNING: Found invalid voice metadata ({voice_meta}).")
+            continue
 
-            for path in sorted(arr_dir.glob(glob_str)):
-                m = compiled_regex.search(path.name)
-                if not m:
-                    print(f"WARNING: {path} does not exist.")
-                    continue
-                voice_idx = int(m.group(1))
-                try:
-                    if is_abc_text_corpus:
-                        content = path.read_text(encoding="utf-8")
-                        content = MIDI2ABC_T_PATH_RE.sub('T: from lmd_matched_flat_sanitized', content)
-                    else:
-                        with open(path, "rb") as f:
-                             content = [str(t) for t in pickle.load(f)]
-                except Exception:
-                    print(f"WARNING: Could not read '{path}'.")
-                    continue
-
-                vm = voice_meta.get(str(voice_idx - 1) if is_abc_text_corpus else str(voice_idx))
-                if vm is None:
-                    print(f"WARNING: Found invalid voice metadata ({voice_meta}).")
-                    continue
-
-                vi = vm.get("category_name")
-                if vi is None:
-                    print(f"WARNING: Found invalid voice instrument ({vm}).")
-                    continue
-
-                yield {
-                    "track_id": track_id,
-                    "arrangement_id": arrangement_id,
-                    "voice_index": voice_idx,
-                    "program_id": int(vm["program_id"]),
-                    "program_name": vm["program_name"],
-                    "musescore_info": vm["musescore_info"],
-                    "instrument_category": instrument_to_id[vi],
-                    "genre_category": g_id,
-                    "abc_text" if is_abc_text_corpus else "token_sequence": content,
-                }
-
-def write_parquet_shards(rows_iter, out_path):
-    out_path.mkdir(parents=True, exist_ok=True)
+        vi = vm.get("category_name")
+        if vi is None:
+            print(f"WARNING: Found invalid voice instrument ({vm}).")
+            continue
+
+        yield {
+            "track_id": track_id,
+            "arrangement_id": arrangement_id,
+            "voice_index": voice_idx,
+            "program_id": int(vm["program_id"]),
+            "program_name": vm["program_name"],
+            "musescore_info": vm["musescore_info"],
+            "instrument_category": instrument_to_id[vi],
+            "genre_category": g_id,
+            "abc_text" if is_abc_text_corpus else "token_sequence": content,
+        }
+
+def write_parquet_shards(rows_iter, out_path: Path, schema: pa.Schema, shard_name: str):
+    # Streams row groups of ROW_GROUP_ROWS rows, starting a new file every SHARD_ROWS rows
+    writer = None
     batch = []
+    row_count = 0
     part_idx = 0
-    for idx, row in tqdm(enumerate(rows_iter, 1)):
+    for row in rows_iter:
         batch.append(row)
-        if len(batch) >= SHARD_ROWS:
-            table = pa.Table.from_pylist(batch, schema=None)
-            pq.write_table(table, out_path / f"part-{part_idx:04d}.parquet", compression="zstd")
+        if len(batch) >= ROW_GROUP_ROWS:
+            writer = writer or pq.ParquetWriter(out_path / f"part-{shard_name}-{part_idx:04d}.parquet", schema, compression="zstd")
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema), row_group_size=ROW_GROUP_ROWS)
+            row_count += len(batch)
             batch.clear()
-            part_idx += 1
+            if row_count >= SHARD_ROWS * (part_idx + 1):
+                writer.close()
+                writer = None
+                part_idx += 1
     if batch:
-        table = pa.Table.from_pylist(batch, schema=None)
-        pq.write_table(table, out_path / f"part-{part_idx:04d}.parquet", compression="zstd")
+        writer = writer or pq.ParquetWriter(out_path / f"part-{shard_name}-{part_idx:04d}.parquet", schema, compression="zstd")
+        writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema), row_group_size=ROW_GROUP_ROWS)
+        row_count += len(batch)
+    if writer is not None:
+        writer.close()
+    return row_count
+
+def get_temporary_path(out_path: Path):
+    return out_path.with_name(out_path.name + ".tmp")
+
+def prepare_temporary_dir(out_path: Path):
+    # Parts are written next to the previous corpus, which is only replaced once all of them are written
+    shutil.rmtree(get_temporary_path(out_path), ignore_errors=True)
+    get_temporary_path(out_path).mkdir(parents=True)
+
+def swap_temporary_dir(out_path: Path):
+    # Parts of a previous run (e.g. with another WORKERS count) are not left among the new ones
+    shutil.rmtree(out_path, ignore_errors=True)
+    os.replace(get_temporary_path(out_path), out_path)
+
+def write_token_shard(shard_idx: int, start: int, stop: int):
+    rows = iter_dataset(iter_token_corpus(TOKEN_CORPUS_PATH, start, stop), False)
+    return write_parquet_shards(rows, get_temporary_path(OUT_DIR / "abc_tokens"), TOKENS_SCHEMA, f"{shard_idx:04d}")
+
+def write_text_shard(shard_idx: int, arrangements: list):
+    rows = iter_dataset(iter_abc_texts(arrangements, "track *.abc", TRACK_RE), True)
+    return write_parquet_shards(rows, get_temporary_path(OUT_DIR / "abc_texts"), TEXTS_SCHEMA, f"{shard_idx:04d}")
+
+def split_range(count: int, parts: int):
+    # Contiguous slices, so that shards keep the track order
+    return [(count * i // parts, count * (i + 1) // parts) for i in range(parts)]
 
 if __name__ == "__main__":
     OUT_DIR.mkdir(parents=True, exist_ok=True)
+    with concurrent.futures.ProcessPoolExecutor(WORKERS) as executor:
+        futures = []
+        # Both corpora are exported at the same time, each worker reading its files and building its rows
+        if WRITE_TOKENS:
+            print("Writing token parquet files...")
+            prepare_temporary_dir(OUT_DIR / "abc_tokens")
+            corpus = TokenCorpus(TOKEN_CORPUS_PATH)
+            voice_count = len(corpus)
+            corpus.close()
+            for shard_idx, (start, stop) in enumerate(split_range(voice_count, WORKERS)):
+                futures.append(executor.submit(write_token_shard, shard_idx, start, stop))
+        if WRITE_TEXTS:
+            print("Writing text parquet files...")
+            prepare_temporary_dir(OUT_DIR / "abc_texts")
+            arrangements = get_arrangements(ABC_ROOT)
+            for shard_idx, (start, stop) in enumerate(split_range(len(arrangements), WORKERS)):
+                futures.append(executor.submit(write_text_shard, shard_idx, arrangements[start:stop]))
+
+        row_count = 0
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), unit="shard"):
+            row_count += future.result()
+
     if WRITE_TOKENS:
-        print("Writing token parquet files...")
-        write_parquet_shards(iter_dataset(TOK_ROOT, "voice_*.pkl", VOICE_RE, False), OUT_DIR / "abc_tokens")
+        swap_temporary_dir(OUT_DIR / "abc_tokens")
     if WRITE_TEXTS:
-        print("Writing text parquet files...")
-        write_parquet_shards(iter_dataset(ABC_ROOT, "track *.abc", TRACK_RE, True), OUT_DIR / "abc_texts")
-    print("Done. Parquet shards in ./data/")
-
+        swap_temporary_dir(OUT_DIR / "abc_texts")
+    print(f"Done. {row_count} rows in parquet shards in ./data/")
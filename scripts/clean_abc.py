@@ -5,9 +5,20 @@ import shutil
 import music21
 
 sys.path.append(os.path.dirname("scripts"))
-from data_pipeline_lib import Process, verify_software_dependency
+from data_pipeline_lib import Process, WorkerPool, get_folder_listing, get_resource_limits, get_results_path, parse_process_arguments, verify_software_dependency
+import metadata_index
 
 
+# Parsed by each worker when it starts, so that its first file does not pay for the first use of music21
+WARM_UP_ABC = "X:1\nM: 4/4\nL:1/8\nK:C \nV:1\n%%MIDI program 0\nC D E [CEG]2|z2 C/2D/2|\n"
+
+
+def warm_up():
+    # WorkerPool initializer: music21's ABC parser and the metadata index are initialized once per worker
+    abc = music21.abcFormat.ABCHandler()
+    abc.process(WARM_UP_ABC)
+    metadata_index.get_metadata_index(metadata_index.METADATA_FOLDER_PATH)
+
 def get_metadata_from_midi_path(input_path: str) -> str | None:
     parts = input_path.split(os.sep)
 
@@ -17,71 +28,110 @@ def get_metadata_from_midi_path(input_path: str) -> str | None:
     return os.sep.join(parts[:-3] + ['lmd_matched_flat_metadata', parts[-2], os.path.splitext(parts[-1])[0] + '.json'])
 
 
-def process_function(from_path: str, to_path: str):
-    with open(from_path) as abc_file:
-        data = abc_file.read()
-
+def validate_abc(from_path: str, data: str):
+    # Returns the failure reason (None when valid) with the parsed ABC and its metadata, so that fused stages can reuse them
     M_declaration = data.find("M: ")
 
     if M_declaration == -1:
-        return (False, from_path, "no M declaration")
+        return "no M declaration", None, None
     elif "-" == data[M_declaration + 3]:
-        return (False, from_path, "M declaration is negative")
+        return "M declaration is negative", None, None
 
     K_declaration = data.find("K:C ")
 
     if K_declaration == -1:
-        return (False, from_path, "K declaration is not C")
+        return "K declaration is not C", None, None
 
     try:
         abc = music21.abcFormat.ABCHandler()
         abc.process(data)
 
         if not abc.definesMeasures():
-            return (False, from_path, "not measures defined")
+            return "not measures defined", None, None
 
         if not abc.hasNotes():
-            return (False, from_path, "has no notes")
+            return "has no notes", None, None
 
         metadata_path = get_metadata_from_midi_path(from_path)
 
         if metadata_path == None:
-            return (False, from_path, "could not create associated metadata path")
+            return "could not create associated metadata path", None, None
 
-        if not os.path.exists(metadata_path):
-            return (False, from_path, "metadata path does not exist")
+        metadata = metadata_index.load_metadata(metadata_path)
 
-        with open(metadata_path, "r", encoding="utf8") as metadata_file:
-            metadata = json.load(metadata_file)
+        if metadata is None:
+            return "metadata path does not exist", None, None
 
         part_number = len(metadata["metadata"]["parts"])
         voice_number = len([None for string in data.split("V:") if string.find("%%MIDI program ") + string.find("%%MIDI channel ") != -2])
 
         if part_number != voice_number:
-            return (False, from_path, "not the same amount of voices ({} - {})".format(voice_number, part_number))
+            return "not the same amount of voices ({} - {})".format(voice_number, part_number), None, None
 
     except Exception as e:
         import traceback
-        return (False, from_path, "Error \"{}\" : ".format(e) + traceback.format_exc())
+        return "Error \"{}\" : ".format(e) + traceback.format_exc(), None, None
+
+    return None, abc, metadata
+
+
+def process_function(from_path: str, to_path: str):
+    with open(from_path) as abc_file:
+        data = abc_file.read()
+
+    reason, _, _ = validate_abc(from_path, data)
+
+    if reason is not None:
+        return (False, from_path, reason)
 
     shutil.copy2(from_path, to_path)
 
     return (True, from_path, "OK")
 
 
+def convert_wrong_abc_from_unsanitized(wrong_abc_files: dict, resume: bool = False, shard: tuple = None, resource_limits: dict = None):
+    def path_converter(from_path: str, is_folder: bool):
+        return os.path.basename(from_path) if is_folder else os.path.basename(from_path).replace(".mid", ".abc")
+
+    job_args = []
+
+    process = Process("convert_wrong_abc_midi_back_to_abc_from_unsanitized", "./midi/lmd_matched_flat", "./midi/lmd_matched_flat_abc", resume=resume, shard=shard)
+
+    # Only a few files are wrong: they are looked up in the listing of the unsanitized MIDI folder instead of walking it
+    for root, file_paths in get_folder_listing(process.from_folder_path).walk():
+        new_folder_path = os.path.abspath(os.path.join(process.to_folder_path, path_converter(root, True)))
+        for from_path in file_paths:
+            to_path = os.path.join(new_folder_path, path_converter(from_path, False))
+            path = to_path.replace("lmd_matched_flat_abc", "lmd_matched_flat_sanitized_abc")
+            if path in wrong_abc_files:
+                os.makedirs(new_folder_path, exist_ok=True)
+                job_args.append((from_path if os.name == "posix" else from_path.replace("/", "\\"), to_path if os.name == "posix" else to_path.replace("/", "\\")))
+                del wrong_abc_files[path]
+
+    midi2abc_path = verify_software_dependency(os.path.join("abcmidi", "midi2abc.exe" if os.name == "nt" else "midi2abc"))
+    midi2abc_path = midi2abc_path if os.name == "posix" else midi2abc_path.replace('/', '\\')
+
+    command = midi2abc_path + " -f {} -k 0 -obpl -nogr -noly -o {}"
+
+    process.step_by_popen(command, job_args, [bytearray(), bytearray()], True, True, 10, scheduler_tick_rate=0, allocated_cores=64, adaptive_concurrency=True, job_timeout=600, relative_job_timeout=20, **(resource_limits or {}))
+
+
 if __name__ == "__main__":
+    arguments = parse_process_arguments(resource_limits=True, sharding=True)
+
     wrong_abc_files = {}
 
     def wrong_abc(from_path: str, reason: str):
         wrong_abc_files.update({from_path: reason})
         print("[clean_abc]", from_path, "is a wrong abc file:", reason)
 
-# region First pass on sanitized abc
+    # Both passes share the same warm workers
+    pool = WorkerPool("clean_abc", initializers=[warm_up])
 
-    process = Process("clean_abc", "./midi/lmd_matched_flat_sanitized_abc", "./midi/lmd_matched_flat_sanitized_abc_clean")
-    results = process.step_by_function(process_function, useProcessExecutor=True)
+# region First pass on sanitized abc
 
-    for res in results:
+    process = Process("clean_abc", "./midi/lmd_matched_flat_sanitized_abc", "./midi/lmd_matched_flat_sanitized_abc_clean", resume=arguments.resume, shard=arguments.shard)
+    for res in process.iter_by_function(process_function, adaptive_chunking=True, executor=pool):
         is_success, from_path, reason = res
         if not is_success:
             wrong_abc(from_path, reason)
@@ -91,46 +141,27 @@ if __name__ == "__main__":
 
 # region Try to use unsanitized midi for wrong abc
 
-    def path_converter(from_path: str, is_folder: bool):
-        return os.path.basename(from_path) if is_folder else os.path.basename(from_path).replace(".mid", ".abc")
-
-    job_args = []
-
-    def process_function2(from_path: str, to_path: str):
-        path = to_path.replace("lmd_matched_flat_abc", "lmd_matched_flat_sanitized_abc")
-        if path in wrong_abc_files:
-            job_args.append((from_path if os.name == "posix" else from_path.replace("/", "\\"), to_path if os.name == "posix" else to_path.replace("/", "\\")))
-            del wrong_abc_files[path]
-
-    process = Process("convert_wrong_abc_midi_back_to_abc_from_unsanitized", "./midi/lmd_matched_flat", "./midi/lmd_matched_flat_abc")
-    process.step_by_function(process_function2, path_converter, folder_exist_ok=True, file_exist_ok=True)
-
-    midi2abc_path = verify_software_dependency(os.path.join("abcmidi", "midi2abc.exe" if os.name == "nt" else "midi2abc"))
-    midi2abc_path = midi2abc_path if os.name == "posix" else midi2abc_path.replace('/', '\\')
-
-    command = midi2abc_path + " -f {} -k 0 -obpl -nogr -noly -o {}"
-
-    process.step_by_popen(command, job_args, [bytearray(), bytearray()], True, True, 10, scheduler_tick_rate=0, allocated_cores=64)
+    convert_wrong_abc_from_unsanitized(wrong_abc_files, arguments.resume, arguments.shard, get_resource_limits(arguments))
 
 # endregion
 
 
 # region Check these abc and add them if good
 
-    process = Process("clean_abc_second_pass", "./midi/lmd_matched_flat_abc", "./midi/lmd_matched_flat_sanitized_abc_clean", to_folder_exist_ok=True)
-    results = process.step_by_function(process_function, folder_exist_ok=True, useProcessExecutor=True)
-
-    for res in results:
+    process = Process("clean_abc_second_pass", "./midi/lmd_matched_flat_abc", "./midi/lmd_matched_flat_sanitized_abc_clean", to_folder_exist_ok=True, resume=arguments.resume, shard=arguments.shard)
+    for res in process.iter_by_function(process_function, folder_exist_ok=True, adaptive_chunking=True, executor=pool):
         is_success, from_path, reason = res
         if not is_success:
             wrong_abc(from_path, reason)
 
+    pool.shutdown()
+
 # endregion
 
 
 # region Write final wrong abc
 
-    with open("./results/failed_jobs_clean_abc.json", "w") as wrong_file:
+    with open(get_results_path("failed_jobs_clean_abc.json", arguments.shard), "w") as wrong_file:
         json.dump(wrong_abc_files, wrong_file)
 
 # endregion
@@ -0,0 +1,152 @@
+import io
+import os
+import sys
+import json
+import shutil
+
+sys.path.append(os.path.dirname("scripts"))
+from data_pipeline_lib import Process, WorkerPool, get_resource_limits, invalidate_folder_listing, parse_process_arguments
+import clean_abc
+import split_abc_tracks
+import tokenize_abc
+import token_corpus
+
+
+CLEAN_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean"
+SPLIT_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean_split"
+TOKENIZED_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean_tokenized"
+
+
+def get_split_and_tokenized_paths(clean_path: str):
+    track_folder_path, file_name = os.path.split(clean_path)
+    track = os.path.basename(track_folder_path)
+    name = split_abc_tracks.path_converter(file_name, False)
+
+    return os.path.abspath(os.path.join(SPLIT_FOLDER_PATH, track, name)), os.path.abspath(os.path.join(TOKENIZED_FOLDER_PATH, track, name))
+
+
+def process_function(from_path: str, to_path: str):
+    # Same outputs as clean_abc.py, split_abc_tracks.py and tokenize_abc.py, but the ABC is read and parsed once
+    with open(from_path) as abc_file:
+        data = abc_file.read()
+
+    reason, abc, metadata = clean_abc.validate_abc(from_path, data)
+
+    if reason is not None:
+        return (False, from_path, reason), None
+
+    shutil.copy2(from_path, to_path)
+
+    split_path, tokenized_path = get_split_and_tokenized_paths(to_path)
+
+    os.makedirs(split_path, exist_ok=True)
+    split_abc_tracks.write_tracks(split_abc_tracks.split_abc_lines(io.StringIO(data).readlines()), split_path)
+
+    # The tokenizer reports on the cleaned copy, as it would when run on its own
+    os.makedirs(tokenized_path, exist_ok=True)
+    try:
+        data_voice_has_instrument_change = tokenize_abc.get_voice_instrument_changes(data)
+
+        if not data_voice_has_instrument_change[0]:
+            tokenize_result = (False, to_path, "no instrument change at start", None)
+        else:
+            tokenize_result = tokenize_abc.write_voice_tokens(to_path, tokenized_path, tokenize_abc.get_voices_tokens(data, abc), metadata, data_voice_has_instrument_change)
+    except Exception as e:
+        import traceback
+        tokenize_result = (False, to_path, "Error \"{}\" : ".format(e) + traceback.format_exc(), None)
+
+    return (True, from_path, "OK"), tokenize_result
+
+def get_manifest_result(result):
+    clean_result, tokenize_result = result
+    return clean_result, tokenize_abc.get_manifest_result(tokenize_result) if tokenize_result is not None else None
+
+def get_manifest_result_check(corpus_writer: token_corpus.TokenCorpusWriter):
+    tokenize_result_check = tokenize_abc.get_manifest_result_check(corpus_writer)
+    def manifest_result_check(result):
+        clean_result, tokenize_result = result
+        return tokenize_result is None or tokenize_result_check(tokenize_result)
+    return manifest_result_check
+
+
+if __name__ == "__main__":
+    arguments = parse_process_arguments(resource_limits=True)
+
+    wrong_abc_files = {}
+    wrong_tokenized_abc_files = {}
+    unused_tokens = set()
+
+    def wrong_abc(from_path: str, reason: str):
+        wrong_abc_files.update({from_path: reason})
+        print("[clean_abc]", from_path, "is a wrong abc file:", reason)
+
+    def wrong_tokenized_abc(from_path: str, reason: str):
+        wrong_tokenized_abc_files.update({from_path: reason})
+        print("[tokenize_abc]", from_path, "is a wrong abc file:", reason)
+
+    def handle_results(results):
+        for clean_result, tokenize_result in results:
+            is_success, from_path, reason = clean_result
+            if not is_success:
+                wrong_abc(from_path, reason)
+
+            if tokenize_result is not None:
+                is_success, from_path, reason_or_unused_tokens, voices = tokenize_result
+                if not is_success:
+                    wrong_tokenized_abc(from_path, reason_or_unused_tokens)
+                else:
+                    unused_tokens.update(reason_or_unused_tokens)
+                    tokenize_abc.add_voices_to_corpus(corpus_writer, from_path, voices)
+
+    for folder_path in [SPLIT_FOLDER_PATH, TOKENIZED_FOLDER_PATH]:
+        if not arguments.resume and os.path.exists(folder_path):
+            print("[clean_split_tokenize_abc] Target directory ({}) already exists.".format(folder_path))
+            sys.exit(1)
+        os.makedirs(folder_path, exist_ok=True)
+        # Also written by this stage, next to its target folder
+        invalidate_folder_listing(folder_path)
+
+    corpus_writer = token_corpus.TokenCorpusWriter(tokenize_abc.TOKEN_CORPUS_PATH, arguments.resume)
+
+    # Both passes share the same warm workers
+    pool = WorkerPool("clean_split_tokenize_abc", initializers=[clean_abc.warm_up, tokenize_abc.warm_up])
+
+# region First pass on sanitized abc
+
+    process = Process("clean_split_tokenize_abc", "./midi/lmd_matched_flat_sanitized_abc", CLEAN_FOLDER_PATH, resume=arguments.resume)
+    handle_results(process.iter_by_function(process_function, adaptive_chunking=True, executor=pool, manifest_result=get_manifest_result, manifest_result_check=get_manifest_result_check(corpus_writer)))
+
+# endregion
+
+
+# region Try to use unsanitized midi for wrong abc
+
+    clean_abc.convert_wrong_abc_from_unsanitized(wrong_abc_files, arguments.resume, resource_limits=get_resource_limits(arguments))
+
+# endregion
+
+
+# region Check these abc and add them if good
+
+    process = Process("clean_split_tokenize_abc_second_pass", "./midi/lmd_matched_flat_abc", CLEAN_FOLDER_PATH, to_folder_exist_ok=True, resume=arguments.resume)
+    handle_results(process.iter_by_function(process_function, folder_exist_ok=True, adaptive_chunking=True, executor=pool, manifest_result=get_manifest_result, manifest_result_check=get_manifest_result_check(corpus_writer)))
+
+    pool.shutdown()
+
+# endregion
+
+
+# region Write final wrong abc, unused tokens and token corpus index
+
+    corpus_writer.close()
+
+    with open("./results/failed_jobs_clean_abc.json", "w") as wrong_file:
+        json.dump(wrong_abc_files, wrong_file)
+
+    with open("./results/failed_jobs_clean_abc_tokenize.json", "w") as wrong_file:
+        json.dump(wrong_tokenized_abc_files, wrong_file)
+
+    with open("./results/unused_tokens_clean_abc_tokenize.json", "w") as wrong_file:
+        json.dump(list(unused_tokens), wrong_file)
+
+# endregion
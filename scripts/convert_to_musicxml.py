@@ -2,24 +2,22 @@ import os
 import sys
 
 sys.path.append(os.path.dirname("scripts"))
-from data_pipeline_lib import Process, verify_software_dependency
+from data_pipeline_lib import Process, get_resource_limits, load_deduplication_index, parse_process_arguments, verify_software_dependency
 
 def path_converter(from_path: str, is_folder: bool):
     return os.path.basename(from_path) if is_folder else os.path.basename(from_path).replace(".mid", ".musicxml")
 
-job_args = []
-def process_function(from_path: str, to_path: str):
-    job_args.append((from_path if os.name == "posix" else from_path.replace("/", "\\"), to_path if os.name == "posix" else to_path.replace("/", "\\")))
-
 
 if __name__ == "__main__":
-    process = Process("convert_to_musicxml", "./midi/lmd_matched_flat_sanitized", "./midi/lmd_matched_flat_sanitized_musicxml")
+    arguments = parse_process_arguments(resource_limits=True, sharding=True)
 
-    process.step_by_function(process_function, path_converter, folder_exist_ok=True, file_exist_ok=True)
+    process = Process("convert_to_musicxml", "./midi/lmd_matched_flat_sanitized", "./midi/lmd_matched_flat_sanitized_musicxml", resume=arguments.resume, shard=arguments.shard)
 
     musescore_path = verify_software_dependency(os.path.join("musescore", "MuseScore4.exe" if os.name == "nt" else "musescore"))
     musescore_path = musescore_path if os.name == "posix" else musescore_path.replace('/', '\\')
 
     command = musescore_path + " {} -o {}"
+    batch_command = musescore_path + " -j {}"
 
-    process.step_by_popen(command, job_args, [bytearray(), bytearray()], True, True, 10, scheduler_tick_rate=0.1, allocated_cores=64)
+    # MuseScore starts once per batch of files; files that fail within a batch are retried on their own with command
+    process.step_by_popen(command, process.plan_jobs(path_converter), [bytearray(), bytearray()], True, True, 10, scheduler_tick_rate=0.1, allocated_cores=64, adaptive_concurrency=True, job_timeout=600, relative_job_timeout=20, longest_job_first=True, small_job_slots=1, deduplication_index=load_deduplication_index(), batch_size=16, batch_command=batch_command, **get_resource_limits(arguments))
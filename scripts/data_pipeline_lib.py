@@ -1,16 +1,171 @@
+import io
 import os
+import re
 import sys
 import time
 import json
+import math
+import queue
+import heapq
+import base64
+import pickle
+import shutil
+import signal
+import socket
 import psutil
+import bisect
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import threading
+import itertools
+import collections
 import subprocess
+import multiprocessing
 import concurrent.futures
 
+try:
+    import resource
+except ImportError:
+    # Windows: commands run without resource limits
+    resource = None
+
 
 def default_path_converter(from_path: str, is_folder: bool):
     return os.path.basename(from_path)
 
 
+def run_function_jobs(process_function, jobs: list[tuple[str, str]]):
+    # Runs a chunk of jobs in a single executor call, so the pickle round-trip is paid once per chunk
+    start_time = time.perf_counter()
+    worker = psutil.Process()
+    outcomes = []
+    for from_path, to_path in jobs:
+        job_start_time = time.perf_counter()
+        job_start_cpu_time = time.thread_time()
+        try:
+            is_success, res = True, process_function(from_path, to_path)
+        except Exception as e:
+            is_success, res = False, e
+        # Wall time, CPU time of the job and memory of the worker once it ended
+        outcomes.append((is_success, res, time.perf_counter() - job_start_time, time.thread_time() - job_start_cpu_time, worker.memory_info().rss))
+    return outcomes, time.perf_counter() - start_time
+
+
+def start_worker(initializers: list, startup_queue):
+    # Initializer of the workers of a WorkerPool: runs the warm-up hooks, then reports how long the worker took to be ready
+    warm_up_start_time = time.perf_counter()
+    for initializer in initializers:
+        initializer()
+    worker = psutil.Process()
+    startup_queue.put({"pid": worker.pid, "startup_time": time.time() - worker.create_time(), "warm_up_time": time.perf_counter() - warm_up_start_time, "rss": worker.memory_info().rss})
+
+
+class WorkerPool(concurrent.futures.ProcessPoolExecutor):
+    """
+    Process pool living for a whole run, given as executor to the function steps of a script (Process.step_by_function,
+    iter_by_function, StreamingPipeline.run) so that each worker imports and warms up its modules once instead of once per step.
+    initializers are picklable functions run by every worker as it starts (e.g. clean_abc.warm_up). The startup of the workers
+    is reported on shutdown, and written to ./results/telemetry/<name>_workers.json.
+    """
+    def __init__(self, name: str, max_workers: int = None, initializers: list = ()):
+        self.name = name
+        self.max_workers = max_workers if max_workers is not None else psutil.cpu_count()
+        self.startup_queue = multiprocessing.Queue()
+        self.startups = []
+        self.is_reported = False
+        super().__init__(max_workers=self.max_workers, initializer=start_worker, initargs=(list(initializers), self.startup_queue))
+
+    def get_startups(self):
+        # Startups reported by the workers so far
+        while True:
+            try:
+                self.startups.append(self.startup_queue.get_nowait())
+            except queue.Empty:
+                return self.startups
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        super().shutdown(wait=wait, cancel_futures=cancel_futures)
+        if not self.is_reported:
+            self.is_reported = True
+            self.report_startups()
+
+    def report_startups(self):
+        startups = self.get_startups()
+        if len(startups) == 0:
+            return None
+
+        summary = {"worker_count": len(startups)}
+        for key in ["startup_time", "warm_up_time", "rss"]:
+            values = [startup[key] for startup in startups]
+            summary[key] = {"mean": sum(values) / len(values), "max": max(values)}
+        summary["workers"] = startups
+
+        path = "./results/telemetry/{}_workers.json".format(self.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf8") as summary_file:
+            json.dump(summary, summary_file, indent=4)
+
+        print("[{}] {} worker(s) started in {:.2f}s on average (max {:.2f}s), {:.2f}s of which warming up, {:.0f} MB each (see {}).".format(self.name, len(startups), summary["startup_time"]["mean"], summary["startup_time"]["max"], summary["warm_up_time"]["mean"], summary["rss"]["mean"] / 1024 ** 2, path))
+        return summary
+
+
+def parse_process_arguments(resource_limits: bool = False, sharding: bool = False):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="Keep the existing target folders and only process inputs that are new, changed or failed.")
+    if resource_limits:
+        add_resource_limit_arguments(parser)
+    if sharding:
+        parser.add_argument("--shard", type=parse_shard, default=None, metavar="i/N", help="Only process the tracks of shard i (from 0) out of N, see merge_shards.py.")
+    return parser.parse_args()
+
+def parse_shard(value: str):
+    # "i/N" -> (i, N)
+    try:
+        shard_index, shard_count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not of the form i/N".format(value))
+    if not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError("{} is not a shard of 0/N to N-1/N".format(value))
+    return shard_index, shard_count
+
+def get_shard_index(track_id: str, shard_count: int):
+    # Stable across machines and runs, unlike hash()
+    return int(hashlib.md5(track_id.encode("utf8")).hexdigest(), 16) % shard_count
+
+def get_results_path(relative_path: str, shard: tuple = None):
+    # Results of a sharded run are written to the namespace of the shard, until merged by merge_shards.py
+    if shard is None:
+        return "./results/{}".format(relative_path)
+    return "./results/shards/{}-of-{}/{}".format(shard[0], shard[1], relative_path)
+
+def add_resource_limit_arguments(parser: argparse.ArgumentParser):
+    # Hard limits of each external tool instance, see ChildResourceLimits
+    parser.add_argument("--memory-limit", type=int, default=None, metavar="MB", help="Memory limit of each instance of the external tool, in MB.")
+    parser.add_argument("--cpu-time-limit", type=float, default=None, metavar="SECONDS", help="CPU time limit of each instance of the external tool, in seconds.")
+    parser.add_argument("--cgroup", default=None, help="Delegated cgroup v2 to put each instance in, so the memory limit holds for its RSS (RLIMIT_AS otherwise).")
+
+def get_resource_limits(arguments):
+    # step_by_popen arguments of the limits given on the command line
+    return {"memory_limit": arguments.memory_limit * 1024 ** 2 if arguments.memory_limit is not None else None, "cpu_time_limit": arguments.cpu_time_limit, "cgroup_path": arguments.cgroup}
+
+
+def musescore_batch_job(job):
+    # Entry of a MuseScore batch job file (-j): "out" may also be a list of output files
+    return {"in": job[0], "out": job[1]}
+
+
+def load_deduplication_index(path: str = "./results/deduplication_index.json"):
+    # Maps each duplicated file (relative path without extension) to the canonical file with the same content, see flatten.py
+    if not os.path.exists(path):
+        print("Deduplication index ({}) not found, every file will be processed.".format(path))
+        return {}
+    with open(path, "r", encoding="utf8") as index_file:
+        return json.load(index_file)
+
+
 def verify_software_dependency(executable_path):
     abs_executable_path = os.path.abspath(os.path.join("softwares", executable_path))
     if not os.path.exists(abs_executable_path):
@@ -19,23 +174,1135 @@ def verify_software_dependency(executable_path):
     return abs_executable_path
 
 
+PACKED_STORE_MARKER = "packed_store.json"
+
+_packed_stores = {}
+_packed_shard_writers = {}
+# (process id, shard path) -> file the shard is read from
+_packed_shard_files = {}
+# Thread pools share the shards and shard files of their process
+_packed_lock = threading.Lock()
+
+
+class PackedPath(os.PathLike):
+    """
+    Path-like handle on a record (or a folder of records) of a packed store, given to process functions in place of a path.
+
+    os.fspath() gives the path the record would have as a file, so os.path.basename() and path converters work on it,
+    while packed_open(), join_path(), make_folders() and path_exists() handle both handles and plain paths.
+    Handles of existing records carry their location, so they are read without loading the index of their store.
+    """
+    def __init__(self, store_path: str, key: str, location: tuple = None):
+        self.store_path = os.path.abspath(store_path)
+        self.key = key
+        self.location = location
+
+    def __fspath__(self):
+        return os.path.join(self.store_path, *self.key.split("/"))
+
+    def __str__(self):
+        return self.__fspath__()
+
+    def __repr__(self):
+        return "PackedPath({!r}, {!r})".format(self.store_path, self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, PackedPath) and (self.store_path, self.key) == (other.store_path, other.key)
+
+    def __hash__(self):
+        return hash((self.store_path, self.key))
+
+    def join(self, name: str):
+        return PackedPath(self.store_path, self.key + "/" + name)
+
+    def signature(self):
+        # Records are never overwritten in place: a new version of a record has a new location
+        location = self.location if self.location is not None else get_packed_store(self.store_path).get_location(self.key)
+        return None if location is None else "{}:{}:{}".format(*location)
+
+    def read_bytes(self):
+        location = self.location if self.location is not None else get_packed_store(self.store_path).get_location(self.key)
+        if location is None:
+            raise FileNotFoundError("No record {} in packed store {}".format(self.key, self.store_path))
+
+        shard_name, offset, length = location
+        shard_path = os.path.join(self.store_path, shard_name + ".bin")
+        with _packed_lock:
+            # Like the writers, files are opened by each process: a forked worker would share the offset of its parent's file
+            shard_key = (os.getpid(), shard_path)
+            if shard_key not in _packed_shard_files:
+                _packed_shard_files[shard_key] = open(shard_path, "rb")
+
+            shard_file = _packed_shard_files[shard_key]
+            shard_file.seek(offset)
+            return shard_file.read(length)
+
+    def write_bytes(self, data: bytes):
+        with _packed_lock:
+            get_packed_shard_writer(self.store_path).write(self.key, data)
+
+
+class PackedShardWriter:
+    """
+    Append-only shard of a packed store, owned by one process: records go to <shard>.bin and their locations to <shard>.idx.
+    """
+    def __init__(self, store_path: str):
+        self.pid = os.getpid()
+        self.shard_name = "{}-{}".format(self.pid, time.time_ns())
+        self.data_file = open(os.path.join(store_path, self.shard_name + ".bin"), "ab")
+        self.index_file = open(os.path.join(store_path, self.shard_name + ".idx"), "a", encoding="utf8")
+
+    def write(self, key: str, data: bytes):
+        offset = self.data_file.tell()
+        self.data_file.write(data)
+        self.data_file.flush()
+
+        # Flushed once the record is complete, so that an interrupted run never indexes a partial record
+        self.index_file.write(json.dumps([key, offset, len(data), time.time_ns()]) + "\n")
+        self.index_file.flush()
+
+
+class PackedRecordBuffer(io.BytesIO):
+    # Written to the shard of the current process when closed
+    def __init__(self, path: PackedPath):
+        super().__init__()
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.path.write_bytes(self.getvalue())
+        super().close()
+
+
+class PackedStore:
+    """
+    Folder of append-only shards holding the records of a stage, keyed by their path relative to the folder
+    (e.g. "<track>/<arrangement>/track 1.abc"). The last written version of a key is the valid one.
+    """
+    def __init__(self, store_path: str):
+        self.store_path = os.path.abspath(store_path)
+        self.locations = None
+        self.folders = None
+
+    @staticmethod
+    def is_packed_store(folder_path: str):
+        return os.path.exists(os.path.join(folder_path, PACKED_STORE_MARKER))
+
+    @staticmethod
+    def create(store_path: str):
+        os.makedirs(store_path, exist_ok=True)
+        with open(os.path.join(store_path, PACKED_STORE_MARKER), "w", encoding="utf8") as marker_file:
+            json.dump({"version": 1}, marker_file)
+
+    def load_index(self):
+        latest = {}
+        for file_name in os.listdir(self.store_path):
+            if not file_name.endswith(".idx"):
+                continue
+            shard_name = file_name[:-len(".idx")]
+            with open(os.path.join(self.store_path, file_name), "r", encoding="utf8") as index_file:
+                for line in index_file:
+                    try:
+                        key, offset, length, write_time = json.loads(line)
+                    except (json.JSONDecodeError, ValueError):  # Line cut by an interrupted run
+                        continue
+                    if key not in latest or latest[key][0] < write_time:
+                        latest[key] = (write_time, (shard_name, offset, length))
+
+        self.locations = {key: location for key, (_, location) in latest.items()}
+        self.folders = {key.rsplit("/", i)[0] for key in self.locations for i in range(1, key.count("/") + 1)}
+
+    def get_location(self, key: str):
+        if self.locations is None:
+            self.load_index()
+        return self.locations.get(key)
+
+    def exists(self, key: str):
+        if self.locations is None:
+            self.load_index()
+        return key in self.locations or key in self.folders
+
+    def walk(self):
+        # Same (folder, files) grouping as os.walk(), with handles instead of file names
+        if self.locations is None:
+            self.load_index()
+
+        folders = {}
+        for key in sorted(self.locations):
+            folder_key, _, _ = key.rpartition("/")
+            folders.setdefault(folder_key, []).append(PackedPath(self.store_path, key, self.locations[key]))
+
+        for folder_key, file_paths in folders.items():
+            yield os.path.join(self.store_path, *folder_key.split("/")) if folder_key else self.store_path, file_paths
+
+
+def get_packed_store(store_path: str):
+    store_path = os.path.abspath(store_path)
+    if store_path not in _packed_stores:
+        _packed_stores[store_path] = PackedStore(store_path)
+    return _packed_stores[store_path]
+
+def get_packed_shard_writer(store_path: str):
+    # One shard per process: forked workers do not inherit the shard of their parent
+    writer = _packed_shard_writers.get(store_path)
+    if writer is None or writer.pid != os.getpid():
+        writer = PackedShardWriter(store_path)
+        _packed_shard_writers[store_path] = writer
+    return writer
+
+def packed_open(path, mode: str = "r", encoding: str = None):
+    # open() for plain paths and packed store handles alike
+    if not isinstance(path, PackedPath):
+        return open(path, mode, encoding=encoding)
+
+    if "r" in mode:
+        buffer = io.BytesIO(path.read_bytes())
+    elif "w" in mode:
+        buffer = PackedRecordBuffer(path)
+    else:
+        raise ValueError("Unsupported mode for a packed record: {}".format(mode))
+
+    return buffer if "b" in mode else io.TextIOWrapper(buffer, encoding=encoding)
+
+def join_path(path, name: str):
+    return path.join(name) if isinstance(path, PackedPath) else os.path.join(path, name)
+
+def make_folders(path):
+    # Packed stores have no folders to create
+    if not isinstance(path, PackedPath):
+        os.makedirs(path, exist_ok=True)
+
+def path_exists(path):
+    return get_packed_store(path.store_path).exists(path.key) if isinstance(path, PackedPath) else os.path.exists(path)
+
+class FolderListing:
+    """
+    Files of a folder with their size and modification time, persisted next to it (<folder>.listing.json), so that
+    the stages reading the folder plan their jobs without walking it.
+
+    A saved listing is used as long as the modification time of each of its folders is unchanged (a file was neither
+    added, removed nor renamed). Processes delete the listing of their target folder, whose files they rewrite.
+    A file rewritten in place does not change its folder, so the file stats of a listing do not tell whether an input changed.
+    """
+    def __init__(self, folder_path: str, folders: dict, files: dict):
+        self.folder_path = os.path.abspath(folder_path)
+        self.folders = folders  # Relative folder path -> mtime_ns
+        self.files = files  # Relative file path -> (size, mtime_ns)
+
+    @staticmethod
+    def get_listing_path(folder_path: str):
+        return os.path.normpath(os.path.abspath(folder_path)) + ".listing.json"
+
+    @staticmethod
+    def scan(folder_path: str):
+        # os.scandir() gives the file stats of a folder with its entries (for free on Windows)
+        folder_path = os.path.abspath(folder_path)
+        folders = {}
+        files = {}
+        pending = [""]
+        while len(pending) > 0:
+            relative_folder_path = pending.pop()
+            absolute_folder_path = os.path.join(folder_path, relative_folder_path)
+            folders[relative_folder_path] = os.stat(absolute_folder_path).st_mtime_ns
+            with os.scandir(absolute_folder_path) as entries:
+                for entry in entries:
+                    relative_path = os.path.join(relative_folder_path, entry.name)
+                    if entry.is_dir():
+                        pending.append(relative_path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files[relative_path] = (stat.st_size, stat.st_mtime_ns)
+        return FolderListing(folder_path, folders, files)
+
+    @staticmethod
+    def load(folder_path: str):
+        # None when there is no saved listing or when it is outdated
+        listing_path = FolderListing.get_listing_path(folder_path)
+        if not os.path.exists(listing_path):
+            return None
+
+        try:
+            with open(listing_path, "r", encoding="utf8") as listing_file:
+                data = json.load(listing_file)
+        except (json.JSONDecodeError, OSError):
+            return None
+
+        listing = FolderListing(folder_path, data["folders"], {relative_path: tuple(stat) for relative_path, *stat in data["files"]})
+        for relative_folder_path, mtime_ns in listing.folders.items():
+            try:
+                if os.stat(os.path.join(listing.folder_path, relative_folder_path)).st_mtime_ns != mtime_ns:
+                    return None
+            except OSError:
+                return None
+        return listing
+
+    def save(self):
+        data = {"folders": self.folders, "files": [[relative_path, size, mtime_ns] for relative_path, (size, mtime_ns) in sorted(self.files.items())]}
+        # Shards on several machines may save the same listing at once
+        listing_path = self.get_listing_path(self.folder_path)
+        temporary_path = "{}.{}.{}.tmp".format(listing_path, socket.gethostname(), os.getpid())
+        with open(temporary_path, "w", encoding="utf8") as listing_file:
+            json.dump(data, listing_file)
+        os.replace(temporary_path, listing_path)
+
+    def walk(self):
+        # Same (folder, files) grouping and top-down order as os.walk(), with absolute file paths
+        files_by_folder = {relative_folder_path: [] for relative_folder_path in self.folders}
+        for relative_path in self.files:
+            files_by_folder[os.path.dirname(relative_path)].append(os.path.join(self.folder_path, relative_path))
+
+        for relative_folder_path in sorted(files_by_folder):
+            yield os.path.join(self.folder_path, relative_folder_path) if relative_folder_path else self.folder_path, sorted(files_by_folder[relative_folder_path])
+
+
+def get_folder_listing(folder_path: str):
+    listing = FolderListing.load(folder_path)
+    if listing is None:
+        listing = FolderListing.scan(folder_path)
+        listing.save()
+    return listing
+
+def invalidate_folder_listing(folder_path: str):
+    # Also drops the index of a packed store, loaded once per process
+    _packed_stores.pop(os.path.abspath(folder_path), None)
+    try:
+        os.remove(FolderListing.get_listing_path(folder_path))
+    except FileNotFoundError:  # Never saved, or removed by another shard
+        pass
+
+def walk_folder(folder_path: str):
+    # (folder, file paths) of a folder of files (from its listing) or of a packed store
+    if PackedStore.is_packed_store(folder_path):
+        yield from get_packed_store(folder_path).walk()
+        return
+
+    yield from get_folder_listing(folder_path).walk()
+
+
+# Interval between two samples of the process tree of a running command, only sampled when a CPU timeout or RLIMIT_AS needs it
+RESOURCE_SAMPLING_INTERVAL = 2
+
+
+def sample_process_tree(pid: int):
+    # (RSS, CPU time, largest virtual memory size of one process) of a process and its children, None once it exited
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return None
+
+    rss = 0
+    cpu_time = 0
+    vms = 0
+    for process in processes:
+        try:
+            cpu_times = process.cpu_times()
+            memory_info = process.memory_info()
+            rss += memory_info.rss
+            vms = max(vms, memory_info.vms)
+            cpu_time += cpu_times.user + cpu_times.system
+        except psutil.Error:
+            continue
+    return rss, cpu_time, vms
+
+
+def kill_process_tree(pid: int):
+    # Commands run in their own session on POSIX: their process group is killed, then any child that left it
+    try:
+        process = psutil.Process(pid)
+        processes = process.children(recursive=True) + [process]
+    except psutil.Error:
+        processes = []
+
+    if os.name == "posix":
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    for process in processes:
+        try:
+            process.kill()
+        except psutil.Error:
+            continue
+
+
+def reap_command(proc: subprocess.Popen, block: bool = True):
+    # Reaps an exited command with os.wait4, whose rusage gives its exact CPU time and peak RSS (the children it waited for included)
+    # None while it runs (without block), and where os.wait4 is missing (proc.returncode being set by Popen)
+    if not hasattr(os, "wait4"):
+        if block:
+            proc.wait()
+        else:
+            proc.poll()
+        return None
+
+    pid, status, rusage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+def get_rusage_peak_rss(rusage):
+    # ru_maxrss is in kilobytes on Linux
+    return rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def add_rusage(usage: dict, rusage):
+    # Adds the CPU time and peak RSS of a reaped command to its usage. A killed command is reaped without the children
+    # its shell did not wait for, their sampled usage (if any) is then kept
+    if rusage is None:
+        return
+    usage["cpu_time"] = max(usage["cpu_time"] or 0, rusage.ru_utime + rusage.ru_stime)
+    # A forked command starts with the peak RSS of the scheduler, so a peak under it is not the command's own
+    peak_rss = get_rusage_peak_rss(rusage)
+    if peak_rss > get_rusage_peak_rss(resource.getrusage(resource.RUSAGE_SELF)):
+        usage["peak_rss"] = max(usage["peak_rss"] or 0, peak_rss)
+
+async def wait_command(proc: subprocess.Popen):
+    # Waits for a command on the event loop through a pidfd, or in a thread of its own where there are none, then reaps it
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+
+    exited = loop.create_future()
+    if pidfd is not None:
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        return reap_command(proc)
+
+    def wait():
+        try:
+            rusage = reap_command(proc)
+        except BaseException as e:
+            loop.call_soon_threadsafe(lambda: exited.done() or exited.set_exception(e))
+            return
+        loop.call_soon_threadsafe(lambda: exited.done() or exited.set_result(rusage))
+    threading.Thread(target=wait, daemon=True).start()
+    return await exited
+
+def spawn_command(cmd: str, outputs, resource_limits = None):
+    # (process, cgroup) of a command started in its own session, its output files and cgroup being removed if it cannot start
+    cgroup = None
+    try:
+        cgroup = resource_limits.create_cgroup() if resource_limits is not None else None
+        proc = subprocess.Popen(cmd, shell=True, stdout=outputs.stdout, stderr=outputs.stderr, start_new_session=True, preexec_fn=resource_limits.get_preexec_function(cgroup) if resource_limits is not None else None)
+    except BaseException:
+        outputs.discard()
+        if resource_limits is not None:
+            resource_limits.remove_cgroup(cgroup)
+        raise
+    return proc, cgroup
+
+
+class CommandOutputs:
+    """
+    Files the stdout and stderr of a command are written to by the command itself, so no output goes through the scheduler.
+    stdout goes to a temporary file next to stdout_path (moved onto it once the command succeeded), to an anonymous
+    temporary file when kept for the debug logs, or to DEVNULL. stderr goes to an anonymous temporary file unless discarded.
+    Only the last OUTPUT_TAIL_SIZE bytes of each are read back.
+    """
+    def __init__(self, stdout_path: str = None, keep_stdout: bool = False, keep_stderr: bool = True):
+        self.stdout_path = stdout_path
+        self.stdout = self.stderr = subprocess.DEVNULL
+        try:
+            if stdout_path is not None:
+                self.stdout = open("{}.{}.tmp".format(stdout_path, os.getpid()), "w+b")
+            elif keep_stdout:
+                self.stdout = tempfile.TemporaryFile()
+            if keep_stderr:
+                self.stderr = tempfile.TemporaryFile()
+        except BaseException:
+            self.discard()
+            raise
+
+    @staticmethod
+    def read_tail(output):
+        if output == subprocess.DEVNULL:
+            return None
+        output.seek(0, os.SEEK_END)
+        output.seek(max(0, output.tell() - OUTPUT_TAIL_SIZE))
+        return output.read()
+
+    def close(self, is_success: bool):
+        # (stdout, stderr) tails, the stdout file atomically replacing stdout_path if the command succeeded
+        stdout, stderr = self.read_tail(self.stdout), self.read_tail(self.stderr)
+        for output in (self.stdout, self.stderr):
+            if output != subprocess.DEVNULL:
+                output.close()
+
+        if self.stdout_path is not None:
+            if is_success:
+                os.replace(self.stdout.name, self.stdout_path)
+            else:
+                os.remove(self.stdout.name)
+        return stdout, stderr
+
+    def discard(self):
+        # Closes and removes the files of a command that could not be started
+        for output in (self.stdout, self.stderr):
+            if output != subprocess.DEVNULL:
+                output.close()
+        if self.stdout_path is not None and self.stdout != subprocess.DEVNULL:
+            os.remove(self.stdout.name)
+
+
+class JobTimeoutPolicy:
+    """
+    Wall-clock and CPU time limits of a command, per job (a batch of n jobs gets n times the limits):
+    absolute (wall_timeout, cpu_timeout, in seconds) and/or relative_timeout times the p95 latency of the successful jobs,
+    once min_samples of them ended (never under min_timeout).
+    A timed out job is retried up to max_retry_count times, after a backoff doubling from backoff seconds.
+    """
+    def __init__(self, wall_timeout: float = None, cpu_timeout: float = None, relative_timeout: float = None, min_samples: int = 20, min_timeout: float = 10, max_retry_count: int = 1, backoff: float = 5, max_backoff: float = 300):
+        self.wall_timeout = wall_timeout
+        self.cpu_timeout = cpu_timeout
+        self.relative_timeout = relative_timeout
+        self.min_samples = min_samples
+        self.min_timeout = min_timeout
+        self.max_retry_count = max_retry_count
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Sorted latencies of the successful jobs
+        self.latencies = []
+
+    def add_latency(self, latency: float):
+        if self.relative_timeout is not None:
+            bisect.insort(self.latencies, latency)
+
+    def get_wall_timeout(self, job_count: int = 1):
+        timeouts = []
+        if self.wall_timeout is not None:
+            timeouts.append(self.wall_timeout)
+        if self.relative_timeout is not None and len(self.latencies) >= self.min_samples:
+            timeouts.append(max(self.min_timeout, self.relative_timeout * self.latencies[round(0.95 * (len(self.latencies) - 1))]))
+        return min(timeouts) * job_count if timeouts else None
+
+    def get_timeout_kind(self, wall_time: float, cpu_time: float, wall_timeout: float):
+        # "wall" or "cpu" when the command went over one of its limits, None otherwise
+        if wall_timeout is not None and wall_time > wall_timeout:
+            return "wall"
+        if self.cpu_timeout is not None and cpu_time is not None and cpu_time > self.cpu_timeout:
+            return "cpu"
+        return None
+
+    def get_backoff(self, timeout_count: int):
+        return min(self.max_backoff, self.backoff * 2 ** (timeout_count - 1))
+
+
+# Failure classes worth retrying: the same command may succeed on a less loaded machine
+TRANSIENT_FAILURE_CLASSES = {"timeout", "oom", "killed"}
+OOM_STDERR_PATTERNS = [rb"out of memory", rb"bad_alloc", rb"MemoryError", rb"cannot allocate memory"]
+CRASH_SIGNALS = {getattr(signal, name) for name in ["SIGSEGV", "SIGABRT", "SIGBUS", "SIGFPE", "SIGILL"] if hasattr(signal, name)}
+KILL_SIGNALS = {getattr(signal, name) for name in ["SIGKILL", "SIGTERM", "SIGINT"] if hasattr(signal, name)}
+# Seconds of CPU time between the SIGXCPU and the SIGKILL of a command over its CPU time limit
+CPU_LIMIT_GRACE = 5
+# Share of RLIMIT_AS from which a command that crashed is taken for one whose allocation failed
+MEMORY_LIMIT_CRASH_RATIO = 0.9
+# End of the stdout and stderr of a command read back by the scheduler (failure store, debug logs)
+OUTPUT_TAIL_SIZE = 2000
+
+
+def get_signal_number(returncode: int):
+    # A command killed by a signal exits with -signal, or 128 + signal when run through a shell
+    return -returncode if returncode < 0 else returncode - 128 if returncode > 128 else None
+
+def classify_popen_failure(returncode: int, stderr: bytes, timeout: str = None, limit: str = None):
+    """
+    Failure class of a command: "timeout", "oom" (out of memory in stderr) and "killed" (e.g. by the OOM killer) are transient,
+    "memory_limit" and "cpu_limit" (stopped by its ChildResourceLimits), "crash" (killed by a fault signal),
+    "missing_output" (exit code 0 without its outputs) and "error" are permanent.
+    Another classifier with the same signature can be given to step_by_popen, its transient classes being in TRANSIENT_FAILURE_CLASSES.
+    """
+    if timeout is not None:
+        return "timeout"
+    if limit is not None:
+        return "{}_limit".format(limit)
+    if stderr and any(re.search(pattern, stderr, re.IGNORECASE) for pattern in OOM_STDERR_PATTERNS):
+        return "oom"
+    if returncode == 0:
+        return "missing_output"
+
+    signal_number = get_signal_number(returncode)
+    if signal_number in KILL_SIGNALS:
+        return "killed"
+    if signal_number in CRASH_SIGNALS:
+        return "crash"
+    return "error"
+
+
+class ChildResourceLimits:
+    """
+    Hard memory and CPU time limits of every command of a stage (POSIX only), a command over one of them being stopped.
+    Memory is capped per command, process tree included, by a cgroup v2 of its own (memory.max, without swap) when cgroup_path
+    is a writable cgroup v2 with the memory controller enabled for its children, and by RLIMIT_AS on each process otherwise.
+    RLIMIT_AS caps virtual memory, so it should be well above the expected RSS. CPU time is capped by RLIMIT_CPU on each process.
+    """
+    def __init__(self, name: str, memory_limit: int = None, cpu_time_limit: float = None, cgroup_path: str = None):
+        if resource is None:
+            print("[{}] Child resource limits are not supported on this platform.".format(name))
+            sys.exit(1)
+
+        self.name = name
+        self.memory_limit = memory_limit
+        self.cpu_time_limit = cpu_time_limit
+        self.cgroup_path = None
+        self.cgroup_ids = itertools.count()
+
+        if cgroup_path is not None and memory_limit is not None:
+            if self.has_memory_controller(cgroup_path):
+                self.cgroup_path = cgroup_path
+            else:
+                print("[{}] {} is not a writable cgroup v2 with the memory controller, memory is limited by RLIMIT_AS.".format(name, cgroup_path))
+
+    @staticmethod
+    def has_memory_controller(cgroup_path: str):
+        try:
+            with open(os.path.join(cgroup_path, "cgroup.subtree_control"), "r") as controllers_file:
+                return "memory" in controllers_file.read().split() and os.access(cgroup_path, os.W_OK)
+        except OSError:
+            return False
+
+    def create_cgroup(self):
+        # Cgroup of the next command, None when memory is not limited by cgroups
+        if self.cgroup_path is None:
+            return None
+
+        cgroup = os.path.join(self.cgroup_path, "{}-{}-{}".format(self.name, os.getpid(), next(self.cgroup_ids)))
+        os.makedirs(cgroup, exist_ok=True)
+        with open(os.path.join(cgroup, "memory.max"), "w") as limit_file:
+            limit_file.write(str(int(self.memory_limit)))
+        if os.path.exists(os.path.join(cgroup, "memory.swap.max")):
+            with open(os.path.join(cgroup, "memory.swap.max"), "w") as limit_file:
+                limit_file.write("0")
+        return cgroup
+
+    def get_preexec_function(self, cgroup: str = None):
+        # Run in the child between fork and exec, so the limits hold for the command and everything it starts
+        def preexec():
+            if cgroup is not None:
+                with open(os.path.join(cgroup, "cgroup.procs"), "w") as procs_file:
+                    procs_file.write("0")
+            elif self.memory_limit is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (int(self.memory_limit), int(self.memory_limit)))
+            if self.cpu_time_limit is not None:
+                # SIGXCPU at the soft limit, SIGKILL at the hard one for commands that ignore it
+                cpu_time_limit = max(1, int(self.cpu_time_limit))
+                resource.setrlimit(resource.RLIMIT_CPU, (cpu_time_limit, cpu_time_limit + CPU_LIMIT_GRACE))
+        return preexec
+
+    def samples_peak_vms(self):
+        # A crash near RLIMIT_AS is only told from the virtual memory sampled while the command ran
+        return self.memory_limit is not None and self.cgroup_path is None
+
+    def get_exceeded_limit(self, cgroup: str, returncode: int, stderr: bytes, cpu_time: float = None, peak_vms: int = None, peak_rss: int = None):
+        # "memory" or "cpu" when the command was stopped by one of the limits, None otherwise
+        # cpu_time and peak_rss are the ones of its rusage, peak_vms the largest sampled while it ran (see monitor_command)
+        if returncode == 0:
+            return None
+        # The virtual memory of a process is at least its RSS, known even for commands that ended before being sampled
+        if peak_rss is not None:
+            peak_vms = max(peak_vms or 0, peak_rss)
+
+        signal_number = get_signal_number(returncode)
+        if self.cpu_time_limit is not None:
+            if signal_number == signal.SIGXCPU:
+                return "cpu"
+            # A command that ignores SIGXCPU is killed at the hard limit (or crashes handling it) after using up its CPU time
+            if (signal_number in KILL_SIGNALS or signal_number in CRASH_SIGNALS) and cpu_time is not None and cpu_time >= self.cpu_time_limit:
+                return "cpu"
+
+        if cgroup is not None:
+            try:
+                with open(os.path.join(cgroup, "memory.events"), "r") as events_file:
+                    events = dict(line.split() for line in events_file if line.strip())
+            except OSError:
+                events = {}
+            if int(events.get("oom_kill", 0)) > 0:
+                return "memory"
+        elif self.memory_limit is not None:
+            # Allocations over RLIMIT_AS fail inside the command, which reports them, or crashes or exits with an error near the limit
+            if stderr and any(re.search(pattern, stderr, re.IGNORECASE) for pattern in OOM_STDERR_PATTERNS):
+                return "memory"
+            if (signal_number is None or signal_number in CRASH_SIGNALS) and peak_vms is not None and peak_vms >= MEMORY_LIMIT_CRASH_RATIO * self.memory_limit:
+                return "memory"
+        return None
+
+    def remove_cgroup(self, cgroup: str):
+        if cgroup is None:
+            return
+        try:
+            os.rmdir(cgroup)
+        except OSError:
+            pass
+
+    @staticmethod
+    def get_failure_parameters(command: str, resource_limits = None):
+        # Permanent failures are known for a command and its limits, so raising a limit tries the jobs over it again
+        if resource_limits is None:
+            return CompletionManifest.hash_parameters(command)
+        return CompletionManifest.hash_parameters("{}|memory_limit={}|cpu_time_limit={}".format(command, resource_limits.memory_limit, resource_limits.cpu_time_limit))
+
+
+class FailureStore:
+    """
+    Failed jobs of a stage in ./results/failures/<name>.jsonl (input, signature, stage parameters, failure class, exit code, end of stderr),
+    the last line of an input being its current state. Besides the classes of classify_popen_failure, "callback_error" is a job whose
+    command succeeded but whose job_success_callback raised (its exception taking the place of stderr). Inputs whose last failure is permanent are skipped by later runs,
+    until the input or the stage parameters change.
+    """
+    def __init__(self, name: str, shard: tuple = None):
+        self.path = get_results_path("failures/{}.jsonl".format(name), shard)
+        self.failures = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf8") as failure_file:
+                for line in failure_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of an interrupted run
+                        continue
+                    if record["failure"] is None:
+                        self.failures.pop(record["input"], None)
+                    else:
+                        self.failures[record["input"]] = record
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.failure_file = open(self.path, "a", encoding="utf8")
+
+    def __len__(self):
+        return len(self.failures)
+
+    def get_permanent_failure(self, input_path: str, parameters: str, signature: str):
+        record = self.failures.get(os.fspath(input_path))
+        if record is None or record["transient"] or record["parameters"] != parameters or record["signature"] != signature:
+            return None
+        return record
+
+    def write(self, record: dict):
+        self.failure_file.write(json.dumps(record) + "\n")
+        self.failure_file.flush()
+
+    def add(self, input_path: str, parameters: str, signature: str, failure_class: str, returncode: int, stderr: bytes):
+        record = {
+            "input": os.fspath(input_path),
+            "signature": signature,
+            "parameters": parameters,
+            "failure": failure_class,
+            "transient": failure_class in TRANSIENT_FAILURE_CLASSES,
+            "returncode": returncode,
+            "stderr": stderr[-OUTPUT_TAIL_SIZE:].decode("utf8", errors="replace") if stderr else None,
+            "time": time.time()
+        }
+        self.failures[record["input"]] = record
+        self.write(record)
+
+    def resolve(self, input_path: str):
+        # A success clears the failure of the input
+        if os.fspath(input_path) in self.failures:
+            del self.failures[os.fspath(input_path)]
+            self.write({"input": os.fspath(input_path), "failure": None})
+
+
+async def monitor_command(pid: int, usage: dict, timeout_policy: JobTimeoutPolicy, wall_timeout: float, sample_vms: bool = False):
+    # Kills a running command once over its time limits. The wall timeout is a timer: the process tree is only sampled
+    # (in a thread, every RESOURCE_SAMPLING_INTERVAL) for a CPU timeout, and for the peak VMS with sample_vms
+    command_start_time = time.perf_counter()
+    is_sampled = timeout_policy.cpu_timeout is not None or sample_vms
+    if not is_sampled and wall_timeout is None:
+        return
+
+    while True:
+        delay = RESOURCE_SAMPLING_INTERVAL if is_sampled else None
+        if wall_timeout is not None:
+            remaining_time = max(0, wall_timeout - (time.perf_counter() - command_start_time))
+            delay = remaining_time if delay is None else min(delay, remaining_time)
+        await asyncio.sleep(delay)
+
+        if is_sampled:
+            sample = await asyncio.to_thread(sample_process_tree, pid)
+            if sample is not None:
+                usage["peak_rss"] = max(usage["peak_rss"] or 0, sample[0])
+                usage["cpu_time"] = max(usage["cpu_time"] or 0, sample[1])
+                usage["peak_vms"] = max(usage["peak_vms"] or 0, sample[2])
+
+        timeout = timeout_policy.get_timeout_kind(time.perf_counter() - command_start_time, usage["cpu_time"], wall_timeout)
+        if timeout is not None:
+            usage["timeout"] = timeout
+            kill_process_tree(pid)
+            return
+
+
+# Relative error of the latency percentiles of a telemetry summary (width of the buckets of its latency histogram)
+LATENCY_PRECISION = 0.01
+
+
+def get_latency_bucket(latency: float):
+    # Latencies under a microsecond share the first bucket
+    return max(0, math.ceil(math.log(max(latency, 1e-6) / 1e-6, 1 + LATENCY_PRECISION)))
+
+def get_latency_bucket_bound(bucket: int):
+    return 1e-6 * (1 + LATENCY_PRECISION) ** bucket
+
+
+class StageTelemetry:
+    """
+    One JSON line per job of a stage in ./results/telemetry/<name>.jsonl (wall time, CPU time, memory, retries, exit code, timeout),
+    and a summary of the latencies, throughput and slowest inputs in ./results/telemetry/<name>_summary.json.
+
+    Commands are measured from their rusage once reaped (see reap_command): their CPU time is exact, and their peak RSS
+    is the one of their largest process, unknown when under the peak RSS of the scheduler (which a forked child starts from).
+    Those killed on a timeout only have their usage up to the last sample.
+
+    Records are only written to the file: the summary comes from running aggregates, with percentiles within
+    LATENCY_PRECISION of the exact ones.
+    """
+    def __init__(self, name: str, resume: bool = False, top_count: int = 20, shard: tuple = None):
+        self.name = name
+        self.path = get_results_path("telemetry/{}.jsonl".format(name), shard)
+        self.previous_path = get_results_path("telemetry/{}.previous.jsonl".format(name), shard)
+        self.summary_path = get_results_path("telemetry/{}_summary.json".format(name), shard)
+        self.top_count = top_count
+        self.start_time = time.time()
+        # Aggregates of the jobs of this run: latency histogram (see get_latency_bucket), jobs ended per minute
+        # since the start of the stage, and (wall time, job index, record) heap of the slowest jobs
+        self.job_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = collections.Counter()
+        self.throughput = collections.Counter()
+        self.slowest = []
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # The records of the previous run are kept aside, as timings to plan this one with
+        if not resume and os.path.exists(self.path):
+            os.replace(self.path, self.previous_path)
+        self.telemetry_file = open(self.path, "a" if resume else "w", encoding="utf8")
+
+    def load_latencies(self):
+        # Latency of each input that succeeded in the previous run or so far in this one (batches being split evenly)
+        latencies = {}
+        for path in [self.previous_path, self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf8") as telemetry_file:
+                for line in telemetry_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record["returncode"] != 0 or record.get("timeout") is not None:
+                        continue
+                    inputs = record["input"] if isinstance(record["input"], list) else [record["input"]]
+                    for input_path in inputs:
+                        latencies[input_path] = record["wall_time"] / len(inputs)
+        return latencies
+
+    def record(self, input_path, wall_time: float, cpu_time: float = None, peak_rss: int = None, worker_rss: int = None, retries: int = 0, returncode: int = None, job_count: int = 1, timeout: str = None, limit: str = None):
+        # input_path is the list of the inputs of a batch when job_count > 1
+        record = {
+            "input": [os.fspath(path) for path in input_path] if isinstance(input_path, list) else os.fspath(input_path),
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "peak_rss": peak_rss,
+            "worker_rss": worker_rss,
+            "retries": retries,
+            "returncode": returncode,
+            "timeout": timeout,
+            "limit": limit,
+            "end_time": time.time()
+        }
+        self.add_record(record, job_count)
+
+    def add_record(self, record: dict, job_count: int = 1):
+        # Also used to merge the telemetry of shards (see merge_shards.py)
+        latency = record["wall_time"] / job_count
+        self.job_count += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.latency_buckets[get_latency_bucket(latency)] += 1
+        self.throughput[int((record["end_time"] - self.start_time) // 60)] += 1
+
+        job = (record["wall_time"], self.job_count, record)
+        if len(self.slowest) < self.top_count:
+            heapq.heappush(self.slowest, job)
+        elif job > self.slowest[0]:
+            heapq.heapreplace(self.slowest, job)
+
+        self.telemetry_file.write(json.dumps(record) + "\n")
+        self.telemetry_file.flush()
+
+    def get_percentile(self, q: int):
+        # Upper bound of the bucket holding the job of rank q% (the max for the last bucket)
+        rank = min(self.job_count - 1, round(q / 100 * (self.job_count - 1)))
+        for bucket in sorted(self.latency_buckets):
+            rank -= self.latency_buckets[bucket]
+            if rank < 0:
+                return min(self.latency_max, get_latency_bucket_bound(bucket))
+        return self.latency_max
+
+    def summarize(self):
+        if self.job_count == 0:
+            return None
+
+        percentiles = {"p{}".format(q): self.get_percentile(q) for q in (50, 95, 99)}
+        slowest = [record for _, _, record in sorted(self.slowest, reverse=True)]
+
+        summary = {
+            "job_count": self.job_count,
+            "latency": dict(percentiles, mean=self.latency_sum / self.job_count, max=self.latency_max),
+            "jobs_per_minute": [self.throughput.get(minute, 0) for minute in range(max(self.throughput) + 1)],
+            "slowest": slowest
+        }
+
+        with open(self.summary_path, "w", encoding="utf8") as summary_file:
+            json.dump(summary, summary_file, indent=4)
+
+        print("[{}] Telemetry: {} job(s), latency p50 {:.3f}s | p95 {:.3f}s | p99 {:.3f}s | max {:.3f}s, slowest: {} (see {}).".format(self.name, self.job_count, percentiles["p50"], percentiles["p95"], percentiles["p99"], self.latency_max, slowest[0]["input"], self.summary_path))
+        return summary
+
+
+# Adaptive concurrency: interval between two updates of the limit, thresholds of the machine resources
+CONCURRENCY_UPDATE_INTERVAL = 2
+# Finished instances whose peak RSS gives the memory of the next ones
+PEAK_RSS_SAMPLE_COUNT = 64
+TARGET_CPU_PERCENT = 90
+MIN_AVAILABLE_MEMORY_PERCENT = 10
+MAX_SWAP_RATE = 16 * 1024 * 1024  # bytes swapped in or out per second
+
+
+class ConcurrencyController:
+    """
+    Number of commands allowed to run at once, between min_limit and max_limit.
+    The limit starts at min_limit, as the memory an instance needs is unknown before the first ones run, and grows
+    while the CPUs are not saturated by as many instances as the memory fits (estimated from the peak RSS of the last
+    finished ones, see add_peak_rss), at most doubling at once. It is halved when available memory runs low or the machine swaps.
+    Running commands are never killed: a lower limit only holds back the next ones.
+    """
+    def __init__(self, name: str, min_limit: int, max_limit: int):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = self.min_limit
+        self.peak_rss = collections.deque(maxlen=PEAK_RSS_SAMPLE_COUNT)
+
+        self.last_update_time = time.time()
+        self.last_swap = self.get_swapped_bytes()
+        # Starts the CPU utilization measure of the first interval
+        psutil.cpu_percent(interval=None)
+
+    @staticmethod
+    def get_swapped_bytes():
+        swap = psutil.swap_memory()
+        return swap.sin + swap.sout
+
+    def add_peak_rss(self, peak_rss: int):
+        # Peak RSS of a finished instance (from its rusage)
+        self.peak_rss.append(peak_rss)
+
+    def update(self, running_count: int):
+        # Called on every scheduler tick, only acts once per CONCURRENCY_UPDATE_INTERVAL; returns the current limit
+        now = time.time()
+        if now - self.last_update_time < CONCURRENCY_UPDATE_INTERVAL:
+            return self.limit
+
+        swapped_bytes = self.get_swapped_bytes()
+        swap_rate = (swapped_bytes - self.last_swap) / (now - self.last_update_time)
+        self.last_update_time = now
+        self.last_swap = swapped_bytes
+
+        cpu_percent = psutil.cpu_percent(interval=None)
+        memory = psutil.virtual_memory()
+        reserved_memory = memory.total * MIN_AVAILABLE_MEMORY_PERCENT / 100
+        instance_rss = sum(self.peak_rss) / len(self.peak_rss) if self.peak_rss else 0
+
+        limit = self.limit
+        if memory.available < reserved_memory or swap_rate > MAX_SWAP_RATE:
+            limit = max(self.min_limit, self.limit // 2)
+        elif cpu_percent < TARGET_CPU_PERCENT and running_count >= self.limit and memory.available - instance_rss > reserved_memory:
+            # Only grown when the limit is what holds the jobs back
+            fitting_count = int((memory.available - reserved_memory) // instance_rss) if instance_rss > 0 else self.limit
+            limit = min(self.max_limit, self.limit + max(1, min(self.limit, fitting_count)))
+
+        if limit != self.limit:
+            print("[{}] Concurrency {} -> {} (CPU {:.0f}%, {:.1f} GB available, swap {:.1f} MB/s).".format(self.name, self.limit, limit, cpu_percent, memory.available / 1024 ** 3, swap_rate / 1024 ** 2), flush=True)
+            self.limit = limit
+        return self.limit
+
+
+class JobCostModel:
+    """
+    Predicted cost of a step_by_popen job, for longest job first ordering: the latency of its input in a previous run
+    when known (see StageTelemetry.load_latencies), otherwise the size of its input times the median latency per byte
+    of the known inputs (or its size alone when there are none).
+    """
+    def __init__(self, latencies: dict):
+        self.latencies = latencies
+
+        ratios = []
+        for input_path, latency in latencies.items():
+            try:
+                size = os.stat(input_path).st_size
+            except OSError:
+                continue
+            if size > 0:
+                ratios.append(latency / size)
+        ratios.sort()
+        self.latency_per_byte = ratios[len(ratios) // 2] if ratios else 1
+
+    def __call__(self, job):
+        latency = self.latencies.get(os.fspath(job[0]))
+        if latency is not None:
+            return latency
+        try:
+            return os.stat(job[0]).st_size * self.latency_per_byte
+        except OSError:
+            return 0
+
+
+class JobQueue:
+    """
+    Jobs of step_by_popen in launch order: the planned order (consumed lazily), or decreasing cost with cost_function
+    (longest job first, so that the longest jobs do not start at the end of the run). In that order, workers taking from
+    the cheapest end (see take) keep small jobs flowing while the longest ones run.
+    """
+    def __init__(self, job_args, cost_function = None):
+        self.jobs = iter(job_args) if cost_function is None else None
+        self.ordered_jobs = collections.deque(sorted(job_args, key=cost_function, reverse=True)) if cost_function is not None else None
+
+    def __len__(self):
+        return len(self.ordered_jobs)
+
+    def take(self, count: int, cheapest: bool = False):
+        if self.ordered_jobs is None:
+            return list(itertools.islice(self.jobs, count))
+        take_job = self.ordered_jobs.pop if cheapest else self.ordered_jobs.popleft
+        return [take_job() for _ in range(min(count, len(self.ordered_jobs)))]
+
+
+class CompletionManifest:
+    """
+    Append-only record of the jobs a stage completed, keyed by input path and stage parameters.
+
+    A job is considered done when its input signature (size/mtime or content hash) and its parameters match the
+    recorded ones and its recorded output still exists.
+    """
+    def __init__(self, path: str, resume: bool = False, content_hash: bool = False):
+        self.path = path
+        self.content_hash = content_hash
+        self.records = {}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        if resume and os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf8") as manifest_file:
+                for line in manifest_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:  # Line cut by an interrupted run
+                        continue
+                    self.records[(record["input"], record["parameters"])] = record
+
+        self.manifest_file = open(self.path, "a" if resume else "w", encoding="utf8")
+
+    @staticmethod
+    def hash_parameters(parameters: str):
+        return hashlib.md5(parameters.encode("utf8")).hexdigest()
+
+    def signature(self, input_path: str):
+        if isinstance(input_path, PackedPath):
+            return input_path.signature()
+        if not os.path.exists(input_path):
+            return None
+        if self.content_hash:
+            with open(input_path, "rb") as input_file:
+                return hashlib.file_digest(input_file, "md5").hexdigest()
+        # Always a fresh stat: a FolderListing does not see files rewritten in place
+        stat = os.stat(input_path)
+        return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+    def get_completed(self, input_path: str, parameters: str, signature: str):
+        record = self.records.get((os.fspath(input_path), parameters))
+        if record is None or signature is None or record["signature"] != signature:
+            return None
+        if record["output_exists"] and not os.path.exists(record["output"]):
+            return None
+        return record
+
+    @staticmethod
+    def get_result(record):
+        return None if record["result"] is None else pickle.loads(base64.b64decode(record["result"]))
+
+    def add(self, input_path: str, parameters: str, signature: str, output_path: str, result = None):
+        try:
+            encoded_result = None if result is None else base64.b64encode(pickle.dumps(result)).decode("ascii")
+        except Exception:
+            encoded_result = None
+
+        # Records of packed stores are never removed, so only the outputs written as files are checked on resume
+        record = {"input": os.fspath(input_path), "parameters": parameters, "signature": signature, "output": os.fspath(output_path), "output_exists": not isinstance(output_path, PackedPath) and os.path.exists(output_path), "result": encoded_result}
+        self.records[(record["input"], parameters)] = record
+
+        self.manifest_file.write(json.dumps(record) + "\n")
+        self.manifest_file.flush()
+
+
 class Process:
-    def __init__(self, name: str, from_folder_path: str, to_folder_path: str, to_folder_exist_ok: bool = False):
+    # storage="packed" writes the outputs of step_by_function to a packed store (see PackedStore) instead of one file per output
+    # shard=(i, N) only processes the tracks of shard i out of N (see is_in_shard), its results going to its own namespace (see get_results_path)
+    def __init__(self, name: str, from_folder_path: str, to_folder_path: str, to_folder_exist_ok: bool = False, resume: bool = False, content_hash: bool = False, storage: str = "files", shard: tuple = None):
         self.name = name
         self.from_folder_path = from_folder_path
         self.to_folder_path = to_folder_path
+        self.resume = resume
+        self.storage = storage
+        self.shard = shard
+
+        if self.storage not in ("files", "packed"):
+            print("[{}] Unknown storage ({}).".format(self.name, self.storage))
+            sys.exit(1)
 
         if not os.path.exists(self.from_folder_path):
             print("[{}] Source directory ({}) not found.".format(self.name, self.from_folder_path))
             sys.exit(1)
 
-        if not to_folder_exist_ok and os.path.exists(self.to_folder_path):
+        # The shards of a run share the target folder, each one writing the folders of its tracks
+        if not (to_folder_exist_ok or resume or shard is not None) and os.path.exists(self.to_folder_path):
             print("[{}] Target directory ({}) already exists.".format(self.name, self.to_folder_path))
             sys.exit(1)
 
-        os.makedirs(self.to_folder_path, exist_ok=to_folder_exist_ok)
+        self.to_folder_existed = os.path.exists(self.to_folder_path)
+        os.makedirs(self.to_folder_path, exist_ok=to_folder_exist_ok or resume or shard is not None)
+
+        # The files of the target folder are about to change
+        invalidate_folder_listing(self.to_folder_path)
 
-        print("[{}] Process from {} to {} created.".format(self.name, self.from_folder_path, self.to_folder_path))
+        if self.storage == "packed" and not PackedStore.is_packed_store(self.to_folder_path):
+            PackedStore.create(self.to_folder_path)
+
+        # Written on every run so that an interrupted run can be resumed with resume=True
+        self.manifest = CompletionManifest(get_results_path("manifests/{}.jsonl".format(self.name), shard), resume, content_hash)
+
+        self.telemetry = StageTelemetry(self.name, resume, shard=shard)
+
+        # Duplicates belong to the shard of their canonical file, so that they are filled from its outputs
+        self.shard_deduplication_index = load_deduplication_index() if shard is not None else None
+
+        print("[{}] Process from {} to {} created{}.".format(self.name, self.from_folder_path, self.to_folder_path, "" if shard is None else " (shard {} of {})".format(*shard)))
+
+    def is_in_shard(self, path):
+        # Jobs are partitioned by track, the folder of their input (or of its canonical file)
+        if self.shard is None:
+            return True
+        key = self.get_relative_key(path)
+        key = self.shard_deduplication_index.get(key, key)
+        return get_shard_index(key.split("/")[0], self.shard[1]) == self.shard[0]
 
 
     def step_by_function(self,
@@ -47,74 +1314,231 @@ class Process:
                          consider_empty_folders: bool = False,
                          empty_folder_ok: bool = False,
                          allocated_cores: int = None,
-                         status_update_time_delta_threshold: float = 1):
+                         status_update_time_delta_threshold: float = 1,
+                         max_pending_jobs: int = None,
+                         chunk_size: int = 1,
+                         adaptive_chunking: bool = False,
+                         chunk_target_duration: float = 0.2,
+                         max_chunk_size: int = 512,
+                         use_manifest: bool = True,
+                         executor: concurrent.futures.Executor = None,
+                         manifest_result = None,
+                         manifest_result_check = None):
+        return list(self.iter_by_function(process_function, path_converter, useProcessExecutor, folder_exist_ok, file_exist_ok, consider_empty_folders, empty_folder_ok, allocated_cores, status_update_time_delta_threshold, max_pending_jobs, chunk_size, adaptive_chunking, chunk_target_duration, max_chunk_size, use_manifest, executor, manifest_result, manifest_result_check))
+
+    def iter_by_function(self,
+                         process_function,
+                         path_converter = default_path_converter,
+                         useProcessExecutor: bool = False,
+                         folder_exist_ok: bool = False,
+                         file_exist_ok: bool = False,
+                         consider_empty_folders: bool = False,
+                         empty_folder_ok: bool = False,
+                         allocated_cores: int = None,
+                         status_update_time_delta_threshold: float = 1,
+                         max_pending_jobs: int = None,
+                         chunk_size: int = 1,
+                         adaptive_chunking: bool = False,
+                         chunk_target_duration: float = 0.2,
+                         max_chunk_size: int = 512,
+                         use_manifest: bool = True,
+                         executor: concurrent.futures.Executor = None,
+                         manifest_result = None,
+                         manifest_result_check = None):
+        # manifest_result reduces a result to what the manifest records and yields back on resume (e.g. without a large payload)
+        # manifest_result_check(result) tells whether such a result can still be used, the job running again otherwise (e.g. its payload was lost)
         if allocated_cores is None:
-            allocated_cores = psutil.cpu_count()
+            allocated_cores = executor.max_workers if isinstance(executor, WorkerPool) else psutil.cpu_count()
+
+        # Jobs whose only purpose is a side effect in the calling process (e.g. collecting job arguments) must not be skipped
+        parameters = CompletionManifest.hash_parameters("{}.{}|{}.{}".format(process_function.__module__, process_function.__qualname__, path_converter.__module__, path_converter.__qualname__))
+        skipped = 0
+
+        # Bounds the number of in-flight futures (one per chunk): the walk waits for a result once the window is full
+        if max_pending_jobs is None:
+            max_pending_jobs = allocated_cores * 4
+
+        # With adaptive chunking, chunk_size is only the starting size: it then tracks chunk_target_duration / measured per-file latency
+        file_latency = None
 
         print("[{}] Process from {} to {} running {} on {} cores.".format(self.name, self.from_folder_path, self.to_folder_path, process_function.__name__, allocated_cores))
 
-        i = 0
+        registered = 0
+        completed = 0
         last_status_update_time = time.time()
 
-        futures = []
-        with (concurrent.futures.ProcessPoolExecutor if useProcessExecutor else concurrent.futures.ThreadPoolExecutor)(max_workers=allocated_cores) as executor:
-            for root, folders, files in os.walk(self.from_folder_path):
-                if not consider_empty_folders and len(files) == 0:
-                    if empty_folder_ok:
-                        print("[{}] Empty folder ({}) found.".format(self.name, root))
-                        sys.exit(1)
+        pending = set()
+        submitted = {}
+        chunk = []
+        chunk_signatures = []
+
+        def submit(executor):
+            future = executor.submit(run_function_jobs, process_function, chunk)
+            pending.add(future)
+            submitted[future] = (chunk, chunk_signatures)
+
+        def collect(done):
+            nonlocal completed, last_status_update_time, file_latency, chunk_size
+            for future in done:
+                jobs, signatures = submitted.pop(future)
+                try:
+                    outcomes, elapsed = future.result()
+                except Exception as e:
+                    print("[{}] Exception during processing: {}".format(self.name, e))
                     continue
 
-                folder_path = root
-                new_folder_path = os.path.join(self.to_folder_path, path_converter(os.path.abspath(folder_path), True))
+                if adaptive_chunking:
+                    chunk_latency = elapsed / len(outcomes)
+                    file_latency = chunk_latency if file_latency is None else 0.8 * file_latency + 0.2 * chunk_latency
+                    chunk_size = max(1, min(max_chunk_size, round(chunk_target_duration / max(file_latency, 1e-6))))
 
-                if not folder_exist_ok and os.path.exists(new_folder_path):
-                    print("[{}] Folder path ({}) already exists.".format(self.name, new_folder_path))
+                for (from_path, to_path), signature, (is_success, res, wall_time, cpu_time, worker_rss) in zip(jobs, signatures, outcomes):
+                    completed += 1
+                    self.telemetry.record(from_path, wall_time, cpu_time, worker_rss=worker_rss, returncode=0 if is_success else 1)
+                    if time.time() - last_status_update_time > status_update_time_delta_threshold:
+                        print("[{}] Processing: {}/{} jobs pending.".format(self.name, completed, registered), flush=True)
+                        last_status_update_time = time.time()
+
+                    if is_success:
+                        if use_manifest:
+                            self.manifest.add(from_path, parameters, signature, to_path, manifest_result(res) if manifest_result is not None else res)
+                        yield res
+                    else:
+                        print("[{}] Exception during processing: {}".format(self.name, res))
+
+        # A given executor (e.g. a WorkerPool shared by the steps of a script) is left running for the next steps
+        with contextlib.nullcontext(executor) if executor is not None else (concurrent.futures.ProcessPoolExecutor if useProcessExecutor else concurrent.futures.ThreadPoolExecutor)(max_workers=allocated_cores) as executor:
+            for file_path, new_file_path in self.walk_jobs(path_converter, folder_exist_ok, file_exist_ok, consider_empty_folders, empty_folder_ok, status_update_time_delta_threshold):
+                registered += 1
+
+                signature = None
+                if use_manifest:
+                    signature = self.manifest.signature(file_path)
+                    record = self.manifest.get_completed(file_path, parameters, signature) if self.resume else None
+                    if record is not None and (manifest_result_check is None or manifest_result_check(CompletionManifest.get_result(record))):
+                        completed += 1
+                        skipped += 1
+                        yield CompletionManifest.get_result(record)
+                        continue
+
+                chunk.append((file_path, new_file_path))
+                chunk_signatures.append(signature)
+
+                if len(chunk) >= chunk_size:
+                    if len(pending) >= max_pending_jobs:
+                        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        yield from collect(done)
+
+                    submit(executor)
+                    chunk = []
+                    chunk_signatures = []
+
+            if len(chunk) > 0:
+                submit(executor)
+
+            yield from collect(concurrent.futures.as_completed(pending))
+
+        print("[{}] Processing: {}/{} jobs pending.".format(self.name, completed, registered))
+
+        if skipped > 0:
+            print("[{}] {} job(s) skipped as already completed.".format(self.name, skipped))
+
+        self.telemetry.summarize()
+
+        invalidate_folder_listing(self.to_folder_path)
+
+    def walk_jobs(self,
+                  path_converter = default_path_converter,
+                  folder_exist_ok: bool = False,
+                  file_exist_ok: bool = False,
+                  consider_empty_folders: bool = False,
+                  empty_folder_ok: bool = False,
+                  status_update_time_delta_threshold: float = 1):
+        # Yields the (input path, output path) of each job, creating the output folders on the way
+        # Outputs of the interrupted run are expected to be there
+        if self.resume:
+            folder_exist_ok = True
+            file_exist_ok = True
+
+        # Outputs are checked against the target folder as it was before this walk and the outputs planned so far
+        existing_folder_paths = set()
+        existing_file_paths = set()
+        if self.storage == "files" and self.to_folder_existed and not (folder_exist_ok and file_exist_ok):
+            to_folder_listing = FolderListing.scan(self.to_folder_path)
+            existing_folder_paths = {os.path.join(to_folder_listing.folder_path, relative_path) for relative_path in to_folder_listing.folders}
+            existing_file_paths = {os.path.join(to_folder_listing.folder_path, relative_path) for relative_path in to_folder_listing.files}
+
+        registered = 0
+        last_status_update_time = time.time()
+
+        for root, file_paths in walk_folder(self.from_folder_path):
+            if not consider_empty_folders and len(file_paths) == 0:
+                if empty_folder_ok:
+                    print("[{}] Empty folder ({}) found.".format(self.name, root))
                     sys.exit(1)
+                continue
 
-                os.makedirs(new_folder_path, exist_ok=folder_exist_ok)
+            # Folders of the tracks of other shards are left to them
+            if self.shard is not None:
+                file_paths = [file_path for file_path in file_paths if self.is_in_shard(file_path)]
+                if len(file_paths) == 0:
+                    continue
 
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    new_file_path = os.path.join(new_folder_path, path_converter(os.path.abspath(file_path), False))
+            folder_path = root
+            new_folder_path = os.path.join(self.to_folder_path, path_converter(os.path.abspath(folder_path), True))
 
-                    if not file_exist_ok and os.path.exists(new_file_path):
-                        print("[{}] File path ({}) already exists.".format(self.name, new_file_path))
-                        sys.exit(1)
+            if self.storage == "files":
+                if not folder_exist_ok and os.path.abspath(new_folder_path) in existing_folder_paths:
+                    print("[{}] Folder path ({}) already exists.".format(self.name, new_folder_path))
+                    sys.exit(1)
 
-                    future = executor.submit(process_function, os.path.abspath(file_path), os.path.abspath(new_file_path))
-                    futures.append(future)
-                    i += 1
+                os.makedirs(new_folder_path, exist_ok=folder_exist_ok)
+                existing_folder_paths.add(os.path.abspath(new_folder_path))
 
-                if time.time() - last_status_update_time > status_update_time_delta_threshold and i != 0:
-                    print("[{}] Registering jobs: {}.".format(self.name, i))
-                    last_status_update_time = time.time()
+            for file_path in file_paths:
+                new_file_path = os.path.join(new_folder_path, path_converter(os.path.abspath(file_path), False))
 
-            completed = 0
-            total = len(futures)
-            last_status_update_time = time.time()
+                if self.storage == "packed":
+                    new_file_path = PackedPath(self.to_folder_path, os.path.relpath(new_file_path, self.to_folder_path).replace(os.sep, "/"))
 
-            results = []
+                if not isinstance(file_path, PackedPath):
+                    file_path = os.path.abspath(file_path)
+                if not isinstance(new_file_path, PackedPath):
+                    new_file_path = os.path.abspath(new_file_path)
 
-            for future in concurrent.futures.as_completed(futures):
-                completed += 1
-                if time.time() - last_status_update_time > status_update_time_delta_threshold:
-                    print("[{}] Processing: {}/{} jobs pending.".format(self.name, completed, total), flush=True)
-                    last_status_update_time = time.time()
+                if not file_exist_ok:
+                    if path_exists(new_file_path) if isinstance(new_file_path, PackedPath) else new_file_path in existing_file_paths:
+                        print("[{}] File path ({}) already exists.".format(self.name, new_file_path))
+                        sys.exit(1)
+                    if not isinstance(new_file_path, PackedPath):
+                        existing_file_paths.add(new_file_path)
 
-                try:
-                    res = future.result()
-                    results.append(res)
-                except Exception as e:
-                    print("[{}] Exception during processing: {}".format(self.name, e))
+                registered += 1
+                yield file_path, new_file_path
 
-        print("[{}] Processing: {}/{} jobs pending.".format(self.name, completed, total))
+            if time.time() - last_status_update_time > status_update_time_delta_threshold and registered != 0:
+                print("[{}] Registering jobs: {}.".format(self.name, registered))
+                last_status_update_time = time.time()
 
-        return results
+    def plan_jobs(self,
+                  path_converter = default_path_converter,
+                  job_converter = None,
+                  folder_exist_ok: bool = True,
+                  file_exist_ok: bool = True,
+                  consider_empty_folders: bool = False,
+                  empty_folder_ok: bool = False):
+        """
+        Lazily yields the job of each input file for step_by_popen: (input path, output path) in the native path format,
+        or job_converter(input path, output path) when given (e.g. to add outputs). Output folders are created on the way.
+        """
+        for from_path, to_path in self.walk_jobs(path_converter, folder_exist_ok, file_exist_ok, consider_empty_folders, empty_folder_ok):
+            if os.name != "posix":
+                from_path, to_path = from_path.replace("/", "\\"), to_path.replace("/", "\\")
+            yield (from_path, to_path) if job_converter is None else job_converter(from_path, to_path)
 
     def step_by_popen(self,
                       process_command: str,
-                      job_args: list[str],
+                      job_args,
                       default_data: list,
                       print_stdout: bool,
                       print_stderr: bool,
@@ -124,98 +1548,922 @@ class Process:
                       allocated_cores: int = None,
                       status_update_time_delta_threshold: float = 1,
                       scheduler_tick_rate: float = 0.1,
-                      debug: bool = False):
+                      debug: bool = False,
+                      event_driven: bool = True,
+                      deduplication_index: dict = None,
+                      duplicate_output_substitution: bool = False,
+                      batch_size: int = 1,
+                      batch_command: str = None,
+                      batch_job_converter = musescore_batch_job,
+                      job_success_callback = None,
+                      adaptive_concurrency: bool = False,
+                      min_allocated_cores: int = 1,
+                      job_timeout: float = None,
+                      job_cpu_timeout: float = None,
+                      relative_job_timeout: float = None,
+                      max_timeout_retry_count: int = 1,
+                      timeout_backoff: float = 5,
+                      failure_classifier = classify_popen_failure,
+                      skip_known_failures: bool = True,
+                      keep_stderr: bool = True,
+                      longest_job_first: bool = False,
+                      job_cost_function = None,
+                      small_job_slots: int = 0,
+                      memory_limit: int = None,
+                      cpu_time_limit: float = None,
+                      cgroup_path: str = None):
         if allocated_cores is None:
             allocated_cores = psutil.cpu_count()
 
+        # With adaptive_concurrency, allocated_cores is the ceiling of the number of instances and min_allocated_cores its floor
+        concurrency = ConcurrencyController(self.name, min_allocated_cores, allocated_cores) if adaptive_concurrency else None
+        # Commands over their wall-clock or CPU time limit are killed with their children and requeued after a backoff
+        timeout_policy = JobTimeoutPolicy(job_timeout, job_cpu_timeout, relative_job_timeout, max_retry_count=max_timeout_retry_count, backoff=timeout_backoff)
+        # Hard memory (bytes) and CPU time (seconds) limits of each command, a command over them failing for good
+        resource_limits = ChildResourceLimits(self.name, memory_limit, cpu_time_limit, cgroup_path) if memory_limit is not None or cpu_time_limit is not None else None
+
         if print_stdout_to_file and job_args_stdout_file_name_index is None:
             print("[{}] print_stdout_to_file is True but job_args_stdout_file_name is None.".format(self.name))
             sys.exit(1)
 
-        print("[{}] Process from {} to {} running {} with {} cores.".format(self.name, self.from_folder_path, self.to_folder_path, process_command, allocated_cores))
+        if self.storage == "packed" or PackedStore.is_packed_store(self.from_folder_path):
+            print("[{}] External commands need files, packed stores are only supported by step_by_function.".format(self.name))
+            sys.exit(1)
+
+        if process_command is None and batch_command is None:
+            print("[{}] Neither process_command nor batch_command is set.".format(self.name))
+            sys.exit(1)
+
+        if (batch_command is not None or job_success_callback is not None) and not event_driven:
+            print("[{}] batch_command and job_success_callback require event_driven.".format(self.name))
+            sys.exit(1)
+
+        if small_job_slots > 0 and not (event_driven and longest_job_first):
+            print("[{}] small_job_slots requires event_driven and longest_job_first.".format(self.name))
+            sys.exit(1)
+
+        if batch_command is not None and print_stdout_to_file:
+            print("[{}] batch_command is not compatible with print_stdout_to_file.".format(self.name))
+            sys.exit(1)
+
+        # Batches are only used when given a batch command: a batch job file is then written for up to batch_size jobs
+        if batch_command is None:
+            batch_size = 1
+
+        # Identifies the stage parameters in the completion manifest
+        stage_command = process_command if process_command is not None else batch_command
+
+        print("[{}] Process from {} to {} running {} with {} cores.".format(self.name, self.from_folder_path, self.to_folder_path, stage_command if batch_size == 1 else "{} (batches of {})".format(batch_command, batch_size), allocated_cores if concurrency is None else "{} to {} (adaptive)".format(concurrency.min_limit, concurrency.max_limit)))
+
+        # Failures of the previous runs: inputs that failed permanently with the same command are not run again
+        self.failures = FailureStore(self.name, self.shard)
+        known_failed_jobs = []
+
+        # job_args may be a list or a lazy iterable (e.g. Process.plan_jobs()): it is only consumed as slots free up
+        skipped = 0
+
+        def skip_completed_jobs(jobs):
+            nonlocal skipped
+            for job in jobs:
+                if self.get_completed_popen_job(stage_command, job) is not None:
+                    skipped += 1
+                    continue
+                yield job
+
+        def skip_known_failed_jobs(jobs):
+            parameters = ChildResourceLimits.get_failure_parameters(stage_command, resource_limits)
+            for job in jobs:
+                if self.failures.get_permanent_failure(job[0], parameters, self.manifest.signature(job[0])) is not None:
+                    known_failed_jobs.append(job)
+                    continue
+                yield job
+
+        # Longest job first: the whole job list is planned, then sorted by predicted cost (from the timings of the previous run or the input sizes)
+        cost_function = None
+        if longest_job_first:
+            cost_function = job_cost_function if job_cost_function is not None else JobCostModel(self.telemetry.load_latencies())
+
+        def run_jobs(jobs):
+            if self.resume:
+                jobs = skip_completed_jobs(jobs)
+            if skip_known_failures and len(self.failures) > 0:
+                jobs = skip_known_failed_jobs(jobs)
+            if cost_function is not None:
+                jobs = JobQueue(jobs, cost_function)
+                print("[{}] {} job(s) ordered longest first{}.".format(self.name, len(jobs), "" if small_job_slots == 0 else ", {} worker(s) taking the shortest ones".format(small_job_slots)))
+
+            if event_driven:
+                # Children are awaited by the event loop, so a slot is refilled as soon as its job exits
+                return asyncio.run(self.run_popen_jobs_event_driven(process_command, jobs, print_stdout, print_stderr, max_retry_count, print_stdout_to_file, job_args_stdout_file_name_index, allocated_cores, status_update_time_delta_threshold, debug, batch_size, batch_command, batch_job_converter, job_success_callback, concurrency, timeout_policy, failure_classifier, keep_stderr, small_job_slots, resource_limits))
+            return self.run_popen_jobs_polling(process_command, list(jobs.ordered_jobs) if isinstance(jobs, JobQueue) else list(jobs), default_data, print_stdout, print_stderr, max_retry_count, print_stdout_to_file, job_args_stdout_file_name_index, allocated_cores, status_update_time_delta_threshold, scheduler_tick_rate, debug, concurrency, timeout_policy, failure_classifier, keep_stderr, resource_limits)
+
+        duplicate_jobs = {}
+        canonical_jobs = {}
+        if deduplication_index:
+            job_args = self.deduplicate_popen_jobs(job_args, deduplication_index, duplicate_jobs, canonical_jobs)
+
+        failed_jobs, timed_out_jobs = run_jobs(job_args)
+
+        if len(duplicate_jobs) > 0:
+            # Duplicates whose canonical file was not part of the jobs are run on their own
+            orphan_jobs = [job for canonical_key, jobs in duplicate_jobs.items() if canonical_key not in canonical_jobs for job in jobs]
+            filled_jobs = {tuple(canonical_jobs[canonical_key]): jobs for canonical_key, jobs in duplicate_jobs.items() if canonical_key in canonical_jobs}
+            if self.resume:
+                # Duplicates already filled by a previous run are skipped like completed jobs
+                filled_jobs = {canonical_job: remaining_jobs for canonical_job, remaining_jobs in ((canonical_job, list(skip_completed_jobs(jobs))) for canonical_job, jobs in filled_jobs.items()) if len(remaining_jobs) > 0}
+
+            print("[{}] {} duplicate job(s) will be filled from {} canonical job(s).".format(self.name, sum(len(jobs) for jobs in filled_jobs.values()), len(filled_jobs)))
+
+            if len(orphan_jobs) > 0:
+                orphan_failed_jobs, orphan_timed_out_jobs = run_jobs(orphan_jobs)
+                failed_jobs += orphan_failed_jobs
+                timed_out_jobs += orphan_timed_out_jobs
+
+            failed_jobs += self.fill_duplicate_popen_jobs(stage_command, filled_jobs, duplicate_output_substitution)
+
+        if skipped > 0:
+            print("[{}] {} job(s) skipped as already completed.".format(self.name, skipped))
+
+        # Known failures stay part of the failed jobs of the stage
+        if len(known_failed_jobs) > 0:
+            print("[{}] {} job(s) skipped as failed permanently in a previous run (see {}).".format(self.name, len(known_failed_jobs), self.failures.path))
+            failed_jobs += known_failed_jobs
+
+        print("[{}] Failed jobs:".format(self.name), failed_jobs)
+
+        with open(get_results_path("failed_jobs_{}.json".format(self.name), self.shard), "w") as wrong_file:
+            json.dump(failed_jobs, wrong_file)
+
+        # Timed out jobs are part of the failed jobs, and also listed on their own
+        if len(timed_out_jobs) > 0:
+            print("[{}] {} job(s) timed out.".format(self.name, len(timed_out_jobs)))
+        with open(get_results_path("timed_out_jobs_{}.json".format(self.name), self.shard), "w") as timed_out_file:
+            json.dump(timed_out_jobs, timed_out_file)
+
+        self.telemetry.summarize()
+
+        invalidate_folder_listing(self.to_folder_path)
+
+    def get_relative_key(self, path: str):
+        relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(self.from_folder_path))
+        return os.path.splitext(relative_path)[0].replace(os.sep, "/")
+
+    def deduplicate_popen_jobs(self, job_args, deduplication_index: dict, duplicate_jobs: dict, canonical_jobs: dict):
+        # Keeps one job per content: duplicates are held back in duplicate_jobs, to be filled from the output of their canonical job
+        canonical_keys = set(deduplication_index.values())
+        for job in job_args:
+            key = self.get_relative_key(job[0])
+            canonical_key = deduplication_index.get(key)
+            if canonical_key is not None:
+                duplicate_jobs.setdefault(canonical_key, []).append(job)
+                continue
+            if key in canonical_keys:
+                canonical_jobs[key] = job
+            yield job
+
+    def fill_duplicate_popen_jobs(self, process_command: str, duplicate_jobs: dict, duplicate_output_substitution: bool):
+        failed_jobs = []
+        for canonical_job, jobs in duplicate_jobs.items():
+            for job in jobs:
+                if not all(os.path.exists(output) for output in canonical_job[1:]):
+                    failed_jobs.append(job)
+                    continue
+
+                for canonical_output, output in zip(canonical_job[1:], job[1:]):
+                    if duplicate_output_substitution:
+                        # Outputs that embed their input path (e.g. midi2abc's "T: from <path>") get the path of the duplicate
+                        with open(canonical_output, "rb") as canonical_file:
+                            data = canonical_file.read()
+                        with open(output, "wb") as duplicate_file:
+                            duplicate_file.write(data.replace(canonical_job[0].encode(), job[0].encode()))
+                    else:
+                        shutil.copyfile(canonical_output, output)
+
+                self.add_completed_popen_job(process_command, job, self.manifest.signature(job[0]))
+
+        return failed_jobs
+
+    # Popen jobs are (input, outputs...) tuples: the first element is the input and the last one the main output
+    def get_completed_popen_job(self, process_command: str, job):
+        return self.manifest.get_completed(job[0], CompletionManifest.hash_parameters(process_command), self.manifest.signature(job[0]))
+
+    def add_completed_popen_job(self, process_command: str, job, signature: str):
+        self.manifest.add(job[0], CompletionManifest.hash_parameters(process_command), signature, job[-1])
+
+    def print_popen_outcome(self, pid: int, cmd: str, retry_count: int, returncode: int, stdout: bytes, stderr: bytes, print_stdout: bool, print_stderr: bool):
+        print("[{}] Outcome for process {}:\n\t• Command: {}\n\t• Number of fails: {}".format(self.name, pid, cmd, retry_count))
+        if print_stdout or print_stderr:
+            print("\t• Logs:")
+            if print_stdout:
+                print("___________stdout___________\n\n{}\n____________________________".format(stdout))
+            if print_stderr:
+                print("___________stderr___________\n\n{}\n____________________________".format(stderr))
+        if returncode != 0:
+            print("\t• Error code: {}".format(returncode))
+        else:
+            print("\t• Successful!")
+
+    def print_popen_status(self, launched_count: int, total: int, start_time: float, running_count: int, failed_count: int):
+        # total is None while the jobs are still being planned
+        if total is None:
+            print("[{}] Processing: {}/? | {} instance(s) | {} job(s) failed.".format(self.name, launched_count, running_count, failed_count), flush=True)
+            return
+        print("[{}] Processing: {}/{} ({:.2f}h) | {} instance(s) | {} job(s) failed.".format(self.name, launched_count, total, ((total - launched_count) * ((time.time() - start_time) / max(launched_count, 1))) / 3600.0, running_count, failed_count), flush=True)
+
+    async def run_popen_jobs_event_driven(self,
+                                          process_command: str,
+                                          job_args,
+                                          print_stdout: bool,
+                                          print_stderr: bool,
+                                          max_retry_count: int,
+                                          print_stdout_to_file: bool,
+                                          job_args_stdout_file_name_index: int,
+                                          allocated_cores: int,
+                                          status_update_time_delta_threshold: float,
+                                          debug: bool,
+                                          batch_size: int = 1,
+                                          batch_command: str = None,
+                                          batch_job_converter = musescore_batch_job,
+                                          job_success_callback = None,
+                                          concurrency: ConcurrencyController = None,
+                                          timeout_policy: JobTimeoutPolicy = None,
+                                          failure_classifier = classify_popen_failure,
+                                          keep_stderr: bool = True,
+                                          small_job_slots: int = 0,
+                                          resource_limits: ChildResourceLimits = None):
+        total = len(job_args) if hasattr(job_args, "__len__") else None
+        jobs = job_args if isinstance(job_args, JobQueue) else JobQueue(job_args)
+        start_time = time.time()
+        stage_command = process_command if process_command is not None else batch_command
+        if timeout_policy is None:
+            timeout_policy = JobTimeoutPolicy()
+
+        launched_count = 0
+        running_count = 0
+        failed_jobs = []
+        timed_out_jobs = []
+        # Jobs to run again: (time from which they may start, order, job, retry count, timeout count)
+        retry_queue = []
+        retry_order = itertools.count()
+
+        # Workers holding a job, bounded by the limit of the concurrency controller
+        active_count = 0
+        slot_released = asyncio.Condition()
+
+        async def run_command(cmd: str, job_inputs, retry_count: int, stdout_path: str = None):
+            nonlocal running_count
+            job_count = len(job_inputs) if isinstance(job_inputs, list) else 1
+            start_time = time.perf_counter()
+            # The command writes its outputs to files: stdout to stdout_path once it succeeded
+            outputs = CommandOutputs(stdout_path, debug and print_stdout, keep_stderr)
+            proc, cgroup = spawn_command(cmd, outputs, resource_limits)
+            running_count += 1
+            usage = {"peak_rss": None, "cpu_time": None, "peak_vms": None, "timeout": None, "limit": None}
+            monitor_task = asyncio.create_task(monitor_command(proc.pid, usage, timeout_policy, timeout_policy.get_wall_timeout(job_count), resource_limits is not None and resource_limits.samples_peak_vms()))
+            try:
+                add_rusage(usage, await wait_command(proc))
+                if concurrency is not None and usage["peak_rss"] is not None:
+                    concurrency.add_peak_rss(usage["peak_rss"])
+            finally:
+                running_count -= 1
+                monitor_task.cancel()
+                stdout, stderr = outputs.close(proc.returncode == 0 and usage["timeout"] is None)
+                if resource_limits is not None:
+                    usage["limit"] = resource_limits.get_exceeded_limit(cgroup, proc.returncode, stderr, usage["cpu_time"], usage["peak_vms"], usage["peak_rss"])
+                    resource_limits.remove_cgroup(cgroup)
+            wall_time = time.perf_counter() - start_time
+            if proc.returncode == 0 and usage["timeout"] is None:
+                timeout_policy.add_latency(wall_time / job_count)
+            self.telemetry.record(job_inputs, wall_time, usage["cpu_time"], usage["peak_rss"], retries=retry_count, returncode=proc.returncode, job_count=job_count, timeout=usage["timeout"], limit=usage["limit"])
+            return proc, stdout, stderr, usage["timeout"], usage["limit"]
+
+        def get_batch_outputs(job):
+            outputs = batch_job_converter(job)["out"]
+            return outputs if isinstance(outputs, list) else [outputs]
+
+        def complete_job(job, signature: str):
+            # A success callback that raises (e.g. on an empty or corrupt output) only fails its own job, the stage keeps running
+            if job_success_callback is not None:
+                try:
+                    job_success_callback(job)
+                except Exception as e:
+                    print("[{}] Exception in the success callback of {}: {}".format(self.name, job[0], e))
+                    failed_jobs.append(job)
+                    self.failures.add(job[0], ChildResourceLimits.get_failure_parameters(stage_command, resource_limits), signature, "callback_error", None, repr(e).encode())
+                    return
+            self.add_completed_popen_job(stage_command, job, signature)
+            self.failures.resolve(job[0])
+
+        async def run_batch(batch: list, retry_count: int):
+            # Outputs left by an interrupted run would pass for results of this batch
+            for job in batch:
+                for output in get_batch_outputs(job):
+                    if os.path.exists(output):
+                        os.remove(output)
+
+            with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False, encoding="utf8") as job_file:
+                json.dump([batch_job_converter(job) for job in batch], job_file)
+
+            try:
+                cmd = batch_command.format(job_file.name)
+                proc, stdout, stderr, timeout, limit = await run_command(cmd, [job[0] for job in batch] if len(batch) > 1 else batch[0][0], retry_count)
+            finally:
+                os.remove(job_file.name)
+
+            if debug:
+                self.print_popen_outcome(proc.pid, cmd, retry_count, proc.returncode, stdout, stderr, print_stdout, print_stderr)
+
+            # A batch succeeds file by file: a crash on one file only leaves the outputs of the remaining ones missing
+            missing_jobs = []
+            for job in batch:
+                if all(os.path.exists(output) for output in get_batch_outputs(job)):
+                    complete_job(job, self.manifest.signature(job[0]))
+                else:
+                    missing_jobs.append(job)
+            return missing_jobs, proc.returncode, stderr, timeout, limit
+
+        def requeue_job(job, retry_count: int, timeout_count: int, delay: float = 0):
+            heapq.heappush(retry_queue, (time.monotonic() + delay, next(retry_order), job, retry_count, timeout_count))
+
+        async def run_job(job, retry_count: int = 0, timeout_count: int = 0):
+            # Runs the job once, a transient failure being requeued (after a backoff when it timed out) until it runs out of retries
+            signature = self.manifest.signature(job[0])
+
+            if process_command is None:
+                missing_jobs, returncode, stderr, timeout, limit = await run_batch([job], retry_count)
+                # Completed by run_batch, or failed by its success callback
+                if len(missing_jobs) == 0:
+                    return
+            else:
+                cmd = process_command.format(*job)
+                proc, stdout, stderr, timeout, limit = await run_command(cmd, job[0], retry_count, job[job_args_stdout_file_name_index] if print_stdout_to_file else None)
+                returncode = proc.returncode
+
+                if debug:
+                    self.print_popen_outcome(proc.pid, cmd, retry_count, proc.returncode, stdout, stderr, print_stdout, print_stderr)
+
+                if proc.returncode == 0 and timeout is None:
+                    complete_job(job, signature)
+                    return
+
+            failure_class = failure_classifier(returncode, stderr, timeout, limit)
+
+            if timeout is not None:
+                timeout_count += 1
+                if timeout_count <= timeout_policy.max_retry_count:
+                    requeue_job(job, retry_count, timeout_count, timeout_policy.get_backoff(timeout_count))
+                    return
+                timed_out_jobs.append(job)
+            elif failure_class in TRANSIENT_FAILURE_CLASSES and retry_count <= max_retry_count:
+                requeue_job(job, retry_count + 1, timeout_count)
+                return
+
+            failed_jobs.append(job)
+            self.failures.add(job[0], ChildResourceLimits.get_failure_parameters(stage_command, resource_limits), signature, failure_class, returncode, stderr)
+
+        async def acquire_slot():
+            nonlocal active_count
+            if concurrency is None:
+                active_count += 1
+                return
+            async with slot_released:
+                await slot_released.wait_for(lambda: active_count < concurrency.limit)
+                active_count += 1
+
+        async def release_slot():
+            nonlocal active_count
+            active_count -= 1
+            if concurrency is not None:
+                async with slot_released:
+                    slot_released.notify()
+
+        async def worker(worker_index: int):
+            nonlocal launched_count
+            # Every worker pulls from the same queue: a worker takes the next job the moment its previous one ends
+            # The first small_job_slots workers take the cheapest jobs of a queue ordered longest first
+            cheapest = worker_index < small_job_slots
+            while True:
+                # Requeued jobs whose backoff is over come first
+                if len(retry_queue) > 0 and retry_queue[0][0] <= time.monotonic():
+                    _, _, job, retry_count, timeout_count = heapq.heappop(retry_queue)
+                    await acquire_slot()
+                    try:
+                        await run_job(job, retry_count, timeout_count)
+                    finally:
+                        await release_slot()
+                    continue
+
+                await acquire_slot()
+                try:
+                    batch = jobs.take(batch_size, cheapest)
+                    if len(batch) > 0:
+                        launched_count += len(batch)
+
+                        if batch_size == 1:
+                            await run_job(batch[0])
+                            continue
+
+                        # Files that failed within a batch are requeued on their own, so a bad file does not fail its neighbours again
+                        missing_jobs, _, _, _, _ = await run_batch(batch, 0)
+                        for job in missing_jobs:
+                            requeue_job(job, 1, 0)
+                        continue
+                finally:
+                    await release_slot()
+
+                if len(retry_queue) == 0:
+                    return
+                # No job left to plan, only requeued ones waiting for their backoff (without holding a slot)
+                await asyncio.sleep(min(1, max(0, retry_queue[0][0] - time.monotonic())))
+
+        async def control_concurrency():
+            while True:
+                await asyncio.sleep(CONCURRENCY_UPDATE_INTERVAL)
+                concurrency.update(running_count)
+                # A raised limit lets waiting workers in
+                async with slot_released:
+                    slot_released.notify_all()
+
+        async def report_status():
+            while True:
+                await asyncio.sleep(status_update_time_delta_threshold)
+                self.print_popen_status(launched_count, total, start_time, running_count, len(failed_jobs))
+
+        status_task = asyncio.create_task(report_status())
+        # With a concurrency controller, there is one worker per instance of the ceiling, only concurrency.limit of them holding a job
+        control_task = asyncio.create_task(control_concurrency()) if concurrency is not None else None
+        try:
+            await asyncio.gather(*(worker(i) for i in range(allocated_cores if concurrency is None else concurrency.max_limit)))
+        finally:
+            status_task.cancel()
+            if control_task is not None:
+                control_task.cancel()
+
+        self.print_popen_status(launched_count, launched_count if total is None else total, start_time, running_count, len(failed_jobs))
+
+        return failed_jobs, timed_out_jobs
+
+    def run_popen_jobs_polling(self,
+                               process_command: str,
+                               job_args: list[str],
+                               default_data: list,
+                               print_stdout: bool,
+                               print_stderr: bool,
+                               max_retry_count: int,
+                               print_stdout_to_file: bool,
+                               job_args_stdout_file_name_index: int,
+                               allocated_cores: int,
+                               status_update_time_delta_threshold: float,
+                               scheduler_tick_rate: float,
+                               debug: bool,
+                               concurrency: ConcurrencyController = None,
+                               timeout_policy: JobTimeoutPolicy = None,
+                               failure_classifier = classify_popen_failure,
+                               keep_stderr: bool = True,
+                               resource_limits: ChildResourceLimits = None):
+        if timeout_policy is None:
+            timeout_policy = JobTimeoutPolicy()
 
         retries = {}
+        timeouts = {}
         data = {}
+        signatures = {}
+        # Start time, peak RSS, CPU time, timeout kind, cgroup and peak VMS of the running process of each job
+        usages = {}
+        # Files the running process of each job writes its stdout and stderr to
+        outputs = {}
         for i in range(len(job_args)):
             retries[i] = 0
+            timeouts[i] = 0
             data[i] = default_data.copy()
 
         start_time = time.time()
         last_status_update_time = start_time
+        last_sample_time = 0
 
         job_index = 0
         running_processes = []
+        # Jobs to run again: (time from which they may start, job index)
+        retry_queue = []
 
         failed_jobs = []
+        timed_out_jobs = []
 
-        while job_index < len(job_args) or len(running_processes) > 0:
-            while job_index < len(job_args) and len(running_processes) < allocated_cores:
-                job = job_args[job_index]
+        def start_process(curr_job_index: int):
+            job = job_args[curr_job_index]
+            cmd = process_command.format(*job)
+            command_outputs = CommandOutputs(job[job_args_stdout_file_name_index] if print_stdout_to_file else None, debug and print_stdout, keep_stderr)
+            proc, cgroup = spawn_command(cmd, command_outputs, resource_limits)
+            outputs[curr_job_index] = command_outputs
+            usages[curr_job_index] = [time.perf_counter(), None, None, None, cgroup, None]
+            running_processes.append((proc, cmd, job, curr_job_index))
 
-                cmd = process_command.format(*job)
+        while job_index < len(job_args) or len(running_processes) > 0 or len(retry_queue) > 0:
+            if concurrency is not None:
+                allocated_cores = concurrency.update(len(running_processes))
+
+            while len(running_processes) < allocated_cores:
+                # Requeued jobs whose backoff is over come first
+                if len(retry_queue) > 0 and retry_queue[0][0] <= time.monotonic():
+                    start_process(heapq.heappop(retry_queue)[1])
+                    continue
 
-                proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if job_index >= len(job_args):
+                    break
 
-                running_processes.append((proc, cmd, job, job_index))
+                signatures[job_index] = self.manifest.signature(job_args[job_index][0])
+                start_process(job_index)
 
                 job_index += 1
 
+            # Process trees are only sampled for a CPU timeout or RLIMIT_AS, every RESOURCE_SAMPLING_INTERVAL
+            is_sampled = (timeout_policy.cpu_timeout is not None or (resource_limits is not None and resource_limits.samples_peak_vms())) and time.perf_counter() - last_sample_time >= RESOURCE_SAMPLING_INTERVAL
+            if is_sampled:
+                last_sample_time = time.perf_counter()
+
             for proc_tuple in running_processes.copy():
                 curr_proc, curr_cmd, curr_job, curr_job_index = proc_tuple
 
-                try:
-                    stdout, stderr = curr_proc.communicate(timeout=0.01)
-                    # buff[job[0]][1] += stdout
-                    # buff[job[0]][2] += stderr
-                except subprocess.TimeoutExpired:
-                    pass
-
-                if curr_proc.poll() is not None:  # process finished
-                    stdout, stderr = curr_proc.communicate()
-                    # buff[job[0]][1] += stdout
-                    # buff[job[0]][2] += stderr
-                    # stdout, stderr = buff[job[0]][1], buff[job[0]][2]
+                rusage = reap_command(curr_proc, False)
+                if curr_proc.returncode is None:
+                    usage = usages[curr_job_index]
+                    if is_sampled:
+                        sample = sample_process_tree(curr_proc.pid)
+                        if sample is not None:
+                            usage[1] = max(usage[1] or 0, sample[0])
+                            usage[2] = max(usage[2] or 0, sample[1])
+                            usage[5] = max(usage[5] or 0, sample[2])
+
+                    timeout = timeout_policy.get_timeout_kind(time.perf_counter() - usage[0], usage[2], timeout_policy.get_wall_timeout())
+                    if timeout is not None:
+                        usage[3] = timeout
+                        kill_process_tree(curr_proc.pid)
+                        rusage = reap_command(curr_proc)
+
+                if curr_proc.returncode is not None:  # process finished
+                    start, peak_rss, cpu_time, timeout, cgroup, peak_vms = usages.pop(curr_job_index)
+                    process_usage = {"cpu_time": cpu_time, "peak_rss": peak_rss}
+                    add_rusage(process_usage, rusage)
+                    cpu_time, peak_rss = process_usage["cpu_time"], process_usage["peak_rss"]
+                    if concurrency is not None and peak_rss is not None:
+                        concurrency.add_peak_rss(peak_rss)
+                    stdout, stderr = outputs.pop(curr_job_index).close(curr_proc.returncode == 0 and timeout is None)
+                    limit = None
+                    if resource_limits is not None:
+                        limit = resource_limits.get_exceeded_limit(cgroup, curr_proc.returncode, stderr, cpu_time, peak_vms, peak_rss)
+                        resource_limits.remove_cgroup(cgroup)
+                    wall_time = time.perf_counter() - start
+                    if curr_proc.returncode == 0 and timeout is None:
+                        timeout_policy.add_latency(wall_time)
+                    self.telemetry.record(curr_job[0], wall_time, cpu_time, peak_rss, retries=retries[curr_job_index], returncode=curr_proc.returncode, timeout=timeout, limit=limit)
                     if debug:
-                        print("[{}] Outcome for process {}:\n\t• Command: {}\n\t• Number of fails: {}".format(self.name, curr_proc.pid, curr_cmd, retries[curr_job_index]))
-                        if print_stdout or print_stderr:
-                            print("\t• Logs:")
-                            if print_stdout:
-                                print("___________stdout___________\n\n{}\n____________________________".format(stdout))
-                            if print_stderr:
-                                print("___________stderr___________\n\n{}\n____________________________".format(stderr))
-                    if curr_proc.returncode != 0:
-                        if debug:
-                            print("\t• Error code: {}".format(curr_proc.returncode))
-                        if retries[curr_job_index] > max_retry_count:
+                        self.print_popen_outcome(curr_proc.pid, curr_cmd, retries[curr_job_index], curr_proc.returncode, stdout, stderr, print_stdout, print_stderr)
+                    if curr_proc.returncode != 0 or timeout is not None:
+                        failure_class = failure_classifier(curr_proc.returncode, stderr, timeout, limit)
+                        if timeout is not None:
+                            timeouts[curr_job_index] += 1
+                            is_failed = timeouts[curr_job_index] > timeout_policy.max_retry_count
+                            delay = timeout_policy.get_backoff(timeouts[curr_job_index])
+                        else:
+                            # Permanent failures are not retried
+                            is_failed = failure_class not in TRANSIENT_FAILURE_CLASSES or retries[curr_job_index] > max_retry_count
+                            delay = 0
+
+                        if is_failed:
                             failed_jobs.append(curr_job)
+                            if timeout is not None:
+                                timed_out_jobs.append(curr_job)
+                            self.failures.add(curr_job[0], ChildResourceLimits.get_failure_parameters(process_command, resource_limits), signatures[curr_job_index], failure_class, curr_proc.returncode, stderr)
                             del data[curr_job_index]
                             del retries[curr_job_index]
+                            del signatures[curr_job_index]
                         else:
-                            retries[curr_job_index] += 1
-
-                            cmd_restart = process_command.format(*curr_job)
-                            new_proc = subprocess.Popen(cmd_restart, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                            if timeout is None:
+                                retries[curr_job_index] += 1
 
-                            running_processes.append((new_proc, cmd_restart, curr_job, curr_job_index))
+                            heapq.heappush(retry_queue, (time.monotonic() + delay, curr_job_index))
 
                             data[curr_job_index] = default_data.copy()
                     else:
-                        if debug:
-                            print("\t• Successful!")
                         del data[curr_job_index]
                         del retries[curr_job_index]
-                        if print_stdout_to_file:
-                            with open(curr_job[job_args_stdout_file_name_index], "wb") as json_file:
-                                json_file.write(stdout)
+                        self.failures.resolve(curr_job[0])
+                        self.add_completed_popen_job(process_command, curr_job, signatures.pop(curr_job_index))
                     running_processes.remove(proc_tuple)
             if time.time() - last_status_update_time > status_update_time_delta_threshold:
-                print("[{}] Processing: {}/{} ({:.2f}h) | {} instance(s) | {} job(s) failed.".format(self.name, job_index, len(job_args), ((len(job_args) - job_index) * ((time.time() - start_time) / job_index)) / 3600.0, len(running_processes), len(failed_jobs)))
+                self.print_popen_status(job_index, len(job_args), start_time, len(running_processes), len(failed_jobs))
                 last_status_update_time = time.time()
-            time.sleep(scheduler_tick_rate)
+            # Outputs go to files, so nothing has to be drained between two ticks
+            time.sleep(max(scheduler_tick_rate, 0.01))
 
-        print("[{}] Processing: {}/{} ({:.2f}h) | {} instance(s) | {} job(s) failed.".format(self.name, job_index, len(job_args), ((len(job_args) - job_index) * ((time.time() - start_time) / job_index)) / 3600.0, len(running_processes), len(failed_jobs)))
+        self.print_popen_status(job_index, len(job_args), start_time, len(running_processes), len(failed_jobs))
 
-        print("[{}] Failed jobs:".format(self.name), failed_jobs)
+        return failed_jobs, timed_out_jobs
 
-        with open("./results/failed_jobs_{}.json".format(self.name), "w") as wrong_file:
-            json.dump(failed_jobs, wrong_file)
+
+class PipelineStage:
+    """
+    Stage of a StreamingPipeline, run for each item as soon as the stages it depends on settled for this item.
+
+    get_job(item) gives the paths of the job: (input path, output paths...), the folders of the outputs being created beforehand.
+    The job runs command, a format string of these paths, or function(input path, output path) in the process pool.
+    A command succeeds when it exits with 0 (its stdout being written to the last path with stdout_to_file), a function
+    when it does not raise and is_success(result) holds. on_result(item, result) gets the result of the function in the main process.
+
+    condition(outcomes) tells whether the stage runs for an item, from the outcomes of the stages it depends on
+    (True, False, or None when skipped). By default, the stage runs when they all succeeded.
+    With deduplicate, a duplicate item (see StreamingPipeline.canonical_items) gets a copy of the outputs of its canonical item
+    instead of running the command, the input path written in them being replaced when substitute_input_path is set.
+    manifest_result(result) is what the completion manifest records, and gives back to on_result on resume
+    unless manifest_result_check(result) tells it can no longer be used, the job running again.
+    Failed commands are retried as in step_by_popen (max_retry_count, timeout_policy, failure_classifier).
+    """
+    def __init__(self,
+                 name: str,
+                 get_job,
+                 command: str = None,
+                 function = None,
+                 depends_on: list[str] = (),
+                 condition = None,
+                 workers: int = None,
+                 output_folder_path: str = None,
+                 stdout_to_file: bool = False,
+                 is_success = None,
+                 on_result = None,
+                 deduplicate: bool = False,
+                 substitute_input_path: bool = False,
+                 max_retry_count: int = 10,
+                 timeout_policy: JobTimeoutPolicy = None,
+                 resource_limits: ChildResourceLimits = None,
+                 manifest_result = None,
+                 manifest_result_check = None,
+                 failure_classifier = classify_popen_failure):
+        self.name = name
+        self.get_job = get_job
+        self.command = command
+        self.function = function
+        self.depends_on = list(depends_on)
+        self.condition = condition
+        self.workers = workers if workers is not None else psutil.cpu_count()
+        self.output_folder_path = output_folder_path
+        self.stdout_to_file = stdout_to_file
+        self.is_success = is_success
+        self.on_result = on_result
+        self.deduplicate = deduplicate
+        self.substitute_input_path = substitute_input_path
+        self.max_retry_count = max_retry_count
+        self.timeout_policy = timeout_policy if timeout_policy is not None else JobTimeoutPolicy()
+        self.resource_limits = resource_limits
+        self.manifest_result = manifest_result
+        self.manifest_result_check = manifest_result_check
+        self.failure_classifier = failure_classifier
+
+        if (command is None) == (function is None):
+            print("[{}] A pipeline stage runs either a command or a function.".format(name))
+            sys.exit(1)
+
+    def get_parameters(self):
+        # Identifies the stage in its completion manifest (and failure store, with the resource limits)
+        return CompletionManifest.hash_parameters(self.command if self.command is not None else "{}.{}".format(self.function.__module__, self.function.__qualname__))
+
+
+class StreamingPipeline:
+    """
+    Runs a graph of stages item by item (e.g. MIDI file by MIDI file): an item moves to a stage as soon as the stages
+    it depends on settled for it, so the stages overlap instead of each waiting for the previous one to end on the whole dataset.
+    Each stage has its own worker budget (commands running at once, or jobs in the shared process pool), and at most
+    max_items_in_flight items are in the graph at once. Stages keep their completion manifest, telemetry and failure store
+    under "<pipeline name>_<stage name>", so an interrupted pipeline can be resumed.
+    """
+    def __init__(self, name: str, stages: list[PipelineStage], resume: bool = False, function_workers: int = None, max_items_in_flight: int = None, status_update_time_delta_threshold: float = 10):
+        self.name = name
+        self.stages = stages
+        self.resume = resume
+        self.function_workers = function_workers if function_workers is not None else psutil.cpu_count()
+        self.max_items_in_flight = max_items_in_flight if max_items_in_flight is not None else 4 * sum(stage.workers for stage in stages)
+        self.status_update_time_delta_threshold = status_update_time_delta_threshold
+
+        # Duplicated item -> item with the same content, filled by the on_result of a stage (e.g. from a content hash)
+        self.canonical_items = {}
+        # Outcomes of the deduplicated stages: futures while the item is in flight, then (stage name, item) -> outcome
+        self.stage_futures = {}
+        self.stage_outcomes = {}
+
+        stage_names = set()
+        for stage in stages:
+            for dependency in stage.depends_on:
+                # Stages are given in an order that respects their dependencies, so the graph has no cycle
+                if dependency not in stage_names:
+                    print("[{}] Stage {} depends on {}, which is not a previous stage.".format(self.name, stage.name, dependency))
+                    sys.exit(1)
+            stage_names.add(stage.name)
+
+        for folder_path in sorted({stage.output_folder_path for stage in stages if stage.output_folder_path is not None}):
+            if not resume and os.path.exists(folder_path):
+                print("[{}] Target directory ({}) already exists.".format(self.name, folder_path))
+                sys.exit(1)
+            os.makedirs(folder_path, exist_ok=True)
+            invalidate_folder_listing(folder_path)
+
+        self.manifests = {stage.name: CompletionManifest("./results/manifests/{}_{}.jsonl".format(self.name, stage.name), resume) for stage in stages}
+        self.telemetries = {stage.name: StageTelemetry("{}_{}".format(self.name, stage.name), resume) for stage in stages}
+        self.failures = {stage.name: FailureStore("{}_{}".format(self.name, stage.name)) for stage in stages if stage.command is not None}
+        self.counts = {stage.name: {"completed": 0, "failed": 0, "skipped": 0, "resumed": 0} for stage in stages}
+
+        print("[{}] Pipeline of {} stage(s) created: {}.".format(self.name, len(stages), ", ".join("{} ({} workers)".format(stage.name, stage.workers) for stage in stages)))
+
+    def run(self, items, executor: concurrent.futures.Executor = None):
+        # The Python stages run in executor when given (e.g. a WorkerPool), in a pool of function_workers otherwise
+        start_time = time.time()
+        with contextlib.nullcontext(executor) if executor is not None else concurrent.futures.ProcessPoolExecutor(max_workers=self.function_workers) as executor:
+            asyncio.run(self.run_items(items, executor))
+
+        for stage in self.stages:
+            self.telemetries[stage.name].summarize()
+            if stage.output_folder_path is not None:
+                invalidate_folder_listing(stage.output_folder_path)
+
+        self.print_status(start_time)
+        return self.counts
+
+    def print_status(self, start_time: float):
+        print("[{}] {:.2f}h | {}".format(self.name, (time.time() - start_time) / 3600.0, " | ".join("{} {} ({} failed)".format(stage.name, self.counts[stage.name]["completed"], self.counts[stage.name]["failed"]) for stage in self.stages)), flush=True)
+
+    async def run_items(self, items, executor):
+        self.executor = executor
+        self.semaphores = {stage.name: asyncio.Semaphore(stage.workers) for stage in self.stages}
+
+        start_time = time.time()
+
+        async def report_status():
+            while True:
+                await asyncio.sleep(self.status_update_time_delta_threshold)
+                self.print_status(start_time)
+
+        status_task = asyncio.create_task(report_status())
+
+        # Items are taken from the (lazy) iterable only as earlier items leave the graph
+        admitted = asyncio.Semaphore(self.max_items_in_flight)
+        tasks = set()
+        try:
+            for item in items:
+                await admitted.acquire()
+                task = asyncio.create_task(self.run_item(item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: admitted.release())
+            await asyncio.gather(*tasks)
+        finally:
+            status_task.cancel()
+
+    async def run_item(self, item):
+        loop = asyncio.get_running_loop()
+        futures = {stage.name: loop.create_future() for stage in self.stages}
+        for stage in self.stages:
+            if stage.deduplicate:
+                self.stage_futures[(stage.name, item)] = futures[stage.name]
+
+        async def run_stage(stage: PipelineStage):
+            outcome = False
+            try:
+                outcomes = {dependency: await futures[dependency] for dependency in stage.depends_on}
+                if not (stage.condition(outcomes) if stage.condition is not None else all(outcomes.values())):
+                    self.counts[stage.name]["skipped"] += 1
+                    outcome = None
+                    return
+                outcome = await self.run_stage_job(stage, item)
+            except Exception as e:
+                print("[{}] Exception during {} of {}: {}".format(self.name, stage.name, item, e))
+            finally:
+                futures[stage.name].set_result(outcome)
+
+        await asyncio.gather(*(run_stage(stage) for stage in self.stages))
+
+        for stage in self.stages:
+            if stage.deduplicate:
+                self.stage_outcomes[(stage.name, item)] = futures[stage.name].result()
+                del self.stage_futures[(stage.name, item)]
+
+    async def get_stage_outcome(self, stage: PipelineStage, item):
+        future = self.stage_futures.get((stage.name, item))
+        if future is not None:
+            return await future
+        return self.stage_outcomes.get((stage.name, item))
+
+    async def run_stage_job(self, stage: PipelineStage, item):
+        job = stage.get_job(item)
+        for output_path in job[1:]:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        manifest = self.manifests[stage.name]
+        parameters = stage.get_parameters()
+        signature = manifest.signature(job[0])
+
+        record = manifest.get_completed(job[0], parameters, signature) if self.resume else None
+        if record is not None and stage.manifest_result_check is not None and not stage.manifest_result_check(CompletionManifest.get_result(record)):
+            record = None
+        if record is not None:
+            is_success = self.handle_result(stage, item, CompletionManifest.get_result(record)) if stage.function is not None else True
+            self.counts[stage.name]["resumed"] += 1
+            self.counts[stage.name]["completed" if is_success else "failed"] += 1
+            return is_success
+
+        if stage.command is not None and self.failures[stage.name].get_permanent_failure(job[0], ChildResourceLimits.get_failure_parameters(stage.command, stage.resource_limits), signature) is not None:
+            self.counts[stage.name]["failed"] += 1
+            return False
+
+        # Duplicates wait for their canonical item without holding a worker of the stage
+        canonical_item = self.canonical_items.get(item) if stage.deduplicate else None
+        if canonical_item is not None:
+            canonical_outcome = await self.get_stage_outcome(stage, canonical_item)
+            if canonical_outcome is not None:
+                if canonical_outcome:
+                    await asyncio.to_thread(self.copy_canonical_outputs, stage, stage.get_job(canonical_item), job)
+                    manifest.add(job[0], parameters, signature, job[-1])
+                self.counts[stage.name]["completed" if canonical_outcome else "failed"] += 1
+                return canonical_outcome
+
+        if stage.command is not None:
+            is_success = await self.run_command_job(stage, job, parameters, signature)
+        else:
+            is_success = await self.run_function_job(stage, item, job, parameters, signature)
+
+        self.counts[stage.name]["completed" if is_success else "failed"] += 1
+        return is_success
+
+    def handle_result(self, stage: PipelineStage, item, result):
+        if stage.on_result is not None:
+            stage.on_result(item, result)
+        return stage.is_success(result) if stage.is_success is not None else True
+
+    @staticmethod
+    def copy_canonical_outputs(stage: PipelineStage, canonical_job, job):
+        for canonical_output, output in zip(canonical_job[1:], job[1:]):
+            if stage.substitute_input_path:
+                # Outputs that embed their input path (e.g. midi2abc's "T: from <path>") get the path of the duplicate
+                with open(canonical_output, "rb") as canonical_file:
+                    data = canonical_file.read()
+                with open(output, "wb") as duplicate_file:
+                    duplicate_file.write(data.replace(canonical_job[0].encode(), job[0].encode()))
+            else:
+                shutil.copyfile(canonical_output, output)
+
+    async def run_function_job(self, stage: PipelineStage, item, job, parameters: str, signature: str):
+        async with self.semaphores[stage.name]:
+            outcomes, _ = await asyncio.get_running_loop().run_in_executor(self.executor, run_function_jobs, stage.function, [job])
+
+        is_success, result, wall_time, cpu_time, worker_rss = outcomes[0]
+        self.telemetries[stage.name].record(job[0], wall_time, cpu_time, worker_rss=worker_rss, returncode=0 if is_success else 1)
+
+        if not is_success:
+            print("[{}] Exception during {} of {}: {}".format(self.name, stage.name, job[0], result))
+            return False
+
+        # As with iter_by_function, the result of a job that did not raise is recorded, whether it reports a success or not
+        self.manifests[stage.name].add(job[0], parameters, signature, job[-1], stage.manifest_result(result) if stage.manifest_result is not None else result)
+        return self.handle_result(stage, item, result)
+
+    async def run_command_job(self, stage: PipelineStage, job, parameters: str, signature: str):
+        # Same retry policy as step_by_popen: transient failures are retried, timed out commands after a backoff
+        cmd = stage.command.format(*job)
+        retry_count = 0
+        timeout_count = 0
+
+        while True:
+            async with self.semaphores[stage.name]:
+                start_time = time.perf_counter()
+                outputs = CommandOutputs(job[-1] if stage.stdout_to_file else None)
+                proc, cgroup = spawn_command(cmd, outputs, stage.resource_limits)
+                usage = {"peak_rss": None, "cpu_time": None, "peak_vms": None, "timeout": None, "limit": None}
+                monitor_task = asyncio.create_task(monitor_command(proc.pid, usage, stage.timeout_policy, stage.timeout_policy.get_wall_timeout(), stage.resource_limits is not None and stage.resource_limits.samples_peak_vms()))
+                try:
+                    add_rusage(usage, await wait_command(proc))
+                finally:
+                    monitor_task.cancel()
+                    is_success = proc.returncode == 0 and usage["timeout"] is None
+                    stdout, stderr = outputs.close(is_success)
+                    if stage.resource_limits is not None:
+                        usage["limit"] = stage.resource_limits.get_exceeded_limit(cgroup, proc.returncode, stderr, usage["cpu_time"], usage["peak_vms"], usage["peak_rss"])
+                        stage.resource_limits.remove_cgroup(cgroup)
+
+            wall_time = time.perf_counter() - start_time
+            self.telemetries[stage.name].record(job[0], wall_time, usage["cpu_time"], usage["peak_rss"], retries=retry_count, returncode=proc.returncode, timeout=usage["timeout"], limit=usage["limit"])
+
+            if is_success:
+                stage.timeout_policy.add_latency(wall_time)
+                self.failures[stage.name].resolve(job[0])
+                self.manifests[stage.name].add(job[0], parameters, signature, job[-1])
+                return True
+
+            failure_class = stage.failure_classifier(proc.returncode, stderr, usage["timeout"], usage["limit"])
+            if usage["timeout"] is not None:
+                timeout_count += 1
+                if timeout_count <= stage.timeout_policy.max_retry_count:
+                    await asyncio.sleep(stage.timeout_policy.get_backoff(timeout_count))
+                    continue
+            elif failure_class in TRANSIENT_FAILURE_CLASSES and retry_count <= stage.max_retry_count:
+                retry_count += 1
+                continue
+
+            self.failures[stage.name].add(job[0], ChildResourceLimits.get_failure_parameters(stage.command, stage.resource_limits), signature, failure_class, proc.returncode, stderr)
+            return False
@@ -1,15 +1,45 @@
 import os
 import sys
+import json
 import shutil
+import hashlib
 
 sys.path.append(os.path.dirname("scripts"))
-from data_pipeline_lib import Process
+from data_pipeline_lib import Process, parse_process_arguments
 
 
 def process_function(from_path: str, to_path: str):
     shutil.copy2(from_path, to_path)
 
+    with open(to_path, "rb") as midi_file:
+        return (to_path, hashlib.file_digest(midi_file, "md5").hexdigest())
+
+
+def build_deduplication_index(results: list[tuple[str, str]], to_folder_path: str):
+    # The same MIDI is often matched to several MSD tracks: expensive stages only process the canonical copy
+    files_by_digest = {}
+    for to_path, digest in results:
+        key = os.path.splitext(os.path.relpath(to_path, os.path.abspath(to_folder_path)))[0].replace(os.sep, "/")
+        files_by_digest.setdefault(digest, []).append(key)
+
+    deduplication_index = {}
+    for keys in files_by_digest.values():
+        canonical_key, *duplicate_keys = sorted(keys)
+        for key in duplicate_keys:
+            deduplication_index[key] = canonical_key
+
+    return deduplication_index
+
 
 if __name__ == "__main__":
-    process = Process("flatten", "./midi/lmd_matched", "./midi/lmd_matched_flat")
-    process.step_by_function(process_function, useProcessExecutor=True)
+    arguments = parse_process_arguments()
+
+    process = Process("flatten", "./midi/lmd_matched", "./midi/lmd_matched_flat", resume=arguments.resume)
+    results = process.step_by_function(process_function, useProcessExecutor=True, adaptive_chunking=True)
+
+    deduplication_index = build_deduplication_index(results, process.to_folder_path)
+
+    print("[flatten] {} duplicate file(s) found out of {}.".format(len(deduplication_index), len(results)))
+
+    with open("./results/deduplication_index.json", "w", encoding="utf8") as index_file:
+        json.dump(deduplication_index, index_file)
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.dirname("scripts"))
+from data_pipeline_lib import StageTelemetry, get_results_path
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("shard_count", type=int, help="Number of shards of the run (N of --shard i/N).")
+    return parser.parse_args()
+
+def list_files(shard_folder_paths: list[str], folder: str, extension: str):
+    # Names of the files of a results folder found in any shard
+    file_names = set()
+    for shard_folder_path in shard_folder_paths:
+        folder_path = os.path.join(shard_folder_path, folder)
+        if os.path.isdir(folder_path):
+            file_names.update(file_name for file_name in os.listdir(folder_path) if file_name.endswith(extension))
+    return sorted(file_names)
+
+def read_lines(path: str):
+    # Lines of a JSON lines file, the last one being cut when its shard was interrupted
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf8") as lines_file:
+        for line in lines_file:
+            yield line if line.endswith("\n") else line + "\n"
+
+def append_json_lines(shard_folder_paths: list[str], folder: str):
+    # Manifests and failure stores are appended to the canonical ones, the last line of an input being its current state
+    file_names = list_files(shard_folder_paths, folder, ".jsonl")
+    for file_name in file_names:
+        path = get_results_path("{}/{}".format(folder, file_name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf8") as merged_file:
+            for shard_folder_path in shard_folder_paths:
+                merged_file.writelines(read_lines(os.path.join(shard_folder_path, folder, file_name)))
+    return len(file_names)
+
+def merge_telemetry(shard_folder_paths: list[str]):
+    # The telemetry of a stage is rewritten from the records of every shard, and summarized again
+    file_names = [file_name for file_name in list_files(shard_folder_paths, "telemetry", ".jsonl") if not file_name.endswith(".previous.jsonl")]
+    for file_name in file_names:
+        records = []
+        for shard_folder_path in shard_folder_paths:
+            for line in read_lines(os.path.join(shard_folder_path, "telemetry", file_name)):
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        records.sort(key=lambda record: record["end_time"])
+
+        telemetry = StageTelemetry(os.path.splitext(file_name)[0])
+        if len(records) > 0:
+            telemetry.start_time = min(record["end_time"] - record["wall_time"] for record in records)
+        for record in records:
+            telemetry.add_record(record, len(record["input"]) if isinstance(record["input"], list) else 1)
+        telemetry.telemetry_file.close()
+        telemetry.summarize()
+    return len(file_names)
+
+def merge_json_results(shard_folder_paths: list[str]):
+    # Failed jobs lists are concatenated, failed jobs dictionaries (e.g. failed_jobs_clean_abc.json) merged
+    file_names = list_files(shard_folder_paths, "", ".json")
+    for file_name in file_names:
+        merged = None
+        for shard_folder_path in shard_folder_paths:
+            path = os.path.join(shard_folder_path, file_name)
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf8") as shard_file:
+                content = json.load(shard_file)
+            if merged is None:
+                merged = content
+            elif isinstance(merged, list):
+                merged += content
+            else:
+                merged.update(content)
+
+        with open(get_results_path(file_name), "w", encoding="utf8") as merged_file:
+            json.dump(merged, merged_file)
+    return len(file_names)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+
+    shard_folder_paths = [get_results_path("", (shard_index, arguments.shard_count)) for shard_index in range(arguments.shard_count)]
+
+    missing_shards = [str(shard_index) for shard_index, shard_folder_path in enumerate(shard_folder_paths) if not os.path.isdir(shard_folder_path)]
+    if len(missing_shards) > 0:
+        print("[merge_shards] Shard(s) {} of {} not found in ./results/shards.".format(", ".join(missing_shards), arguments.shard_count))
+        sys.exit(1)
+
+    manifest_count = append_json_lines(shard_folder_paths, "manifests")
+    failure_count = append_json_lines(shard_folder_paths, "failures")
+    telemetry_count = merge_telemetry(shard_folder_paths)
+    result_count = merge_json_results(shard_folder_paths)
+
+    print("[merge_shards] {} shard(s) merged: {} manifest(s), {} failure store(s), {} telemetry file(s) and {} result file(s).".format(arguments.shard_count, manifest_count, failure_count, telemetry_count, result_count))
@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+
+METADATA_FOLDER_PATH = "./midi/lmd_matched_flat_metadata"
+
+# MuseScore part metadata, in the key order of its JSON output
+MUSESCORE_INFO_TYPE = pa.struct([
+    ("harmonyCount", pa.int64()),
+    ("hasDrumStaff", pa.string()),
+    ("hasPitchedStaff", pa.string()),
+    ("hasTabStaff", pa.string()),
+    ("instrumentId", pa.string()),
+    ("isVisible", pa.string()),
+    ("lyricCount", pa.int64()),
+    ("name", pa.string()),
+    ("program", pa.int64()),
+])
+
+INDEX_SCHEMA = pa.schema([
+    ("track_id", pa.string()),
+    ("arrangement_id", pa.string()),
+    ("parts", pa.list_(MUSESCORE_INFO_TYPE)),
+])
+
+_metadata_indexes = {}
+
+
+def get_index_path(metadata_folder_path: str):
+    return os.path.normpath(metadata_folder_path) + ".parquet"
+
+def invalidate_metadata_index(metadata_folder_path: str):
+    # Removed by the stages writing metadata, so that readers fall back to the JSON files until it is compiled again
+    index_path = get_index_path(metadata_folder_path)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+def compile_metadata_index(metadata_folder_path: str):
+    # One row per MuseScore metadata JSON (track folder, arrangement file), sorted like the folders
+    rows = []
+    with os.scandir(metadata_folder_path) as track_entries:
+        track_entries = sorted((entry for entry in track_entries if entry.is_dir()), key=lambda entry: entry.name)
+
+    for track_entry in tqdm(track_entries, unit="track"):
+        with os.scandir(track_entry.path) as metadata_entries:
+            metadata_entries = sorted((entry for entry in metadata_entries if entry.name.endswith(".json")), key=lambda entry: entry.name)
+
+        for metadata_entry in metadata_entries:
+            try:
+                with open(metadata_entry.path, "r", encoding="utf8") as metadata_file:
+                    parts = json.load(metadata_file)["metadata"]["parts"]
+            except Exception as e:
+                print("[metadata_index] Could not read {}: {}".format(metadata_entry.path, e))
+                continue
+            rows.append({"track_id": track_entry.name, "arrangement_id": os.path.splitext(metadata_entry.name)[0], "parts": parts})
+
+    pq.write_table(pa.Table.from_pylist(rows, schema=INDEX_SCHEMA), get_index_path(metadata_folder_path), compression="zstd")
+    return len(rows)
+
+
+class MetadataIndex:
+    """
+    Parts of every MuseScore metadata JSON of a folder, looked up by (track, arrangement) without opening any JSON.
+    """
+
+    def __init__(self, index_path: str):
+        table = pq.read_table(index_path)
+        self.rows = {key: i for i, key in enumerate(zip(table.column("track_id").to_pylist(), table.column("arrangement_id").to_pylist()))}
+        # Parts are only converted to Python objects when looked up
+        self.parts = table.column("parts").combine_chunks()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_parts(self, track_id: str, arrangement_id: str):
+        i = self.rows.get((track_id, arrangement_id))
+        if i is None:
+            return None
+        # Fields MuseScore did not write are null in the index
+        return [{key: value for key, value in part.items() if value is not None} for part in self.parts[i].as_py()]
+
+
+def get_metadata_index(metadata_folder_path: str):
+    # Index of a metadata folder, loaded once per process (e.g. by the warm-up of a worker), None when not compiled
+    metadata_folder_path = os.path.abspath(metadata_folder_path)
+    if metadata_folder_path not in _metadata_indexes:
+        index_path = get_index_path(metadata_folder_path)
+        _metadata_indexes[metadata_folder_path] = MetadataIndex(index_path) if os.path.exists(index_path) else None
+    return _metadata_indexes[metadata_folder_path]
+
+def load_metadata(metadata_path: str):
+    """
+    Same content as json.load() of a MuseScore metadata file (reduced to its parts), None when it does not exist.
+    The index of the metadata folder is used when compiled, the JSON file when it is missing from it.
+    """
+    track_folder_path, file_name = os.path.split(metadata_path)
+
+    metadata_index = get_metadata_index(os.path.dirname(track_folder_path))
+    if metadata_index is not None:
+        parts = metadata_index.get_parts(os.path.basename(track_folder_path), os.path.splitext(file_name)[0])
+        if parts is not None:
+            return {"metadata": {"parts": parts}}
+
+    if not os.path.exists(metadata_path):
+        return None
+
+    with open(metadata_path, "r", encoding="utf8") as metadata_file:
+        return json.load(metadata_file)
+
+
+if __name__ == "__main__":
+    if not os.path.exists(METADATA_FOLDER_PATH):
+        print("[metadata_index] Metadata directory ({}) does not exist.".format(METADATA_FOLDER_PATH))
+        sys.exit(1)
+
+    count = compile_metadata_index(METADATA_FOLDER_PATH)
+    print("[metadata_index] {} metadata file(s) compiled to {}.".format(count, get_index_path(METADATA_FOLDER_PATH)))
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+sys.path.append(os.path.dirname("scripts"))
+from data_pipeline_lib import ChildResourceLimits, JobTimeoutPolicy, PipelineStage, StreamingPipeline, WorkerPool, add_resource_limit_arguments, get_folder_listing, get_resource_limits, verify_software_dependency
+import flatten
+import clean_abc
+import tokenize_abc
+import split_abc_tracks
+import token_corpus
+import metadata_index
+
+
+SOURCE_FOLDER_PATH = "./midi/lmd_matched"
+FLAT_FOLDER_PATH = "./midi/lmd_matched_flat"
+METADATA_FOLDER_PATH = metadata_index.METADATA_FOLDER_PATH
+SANITIZED_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized"
+ABC_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized_abc"
+UNSANITIZED_ABC_FOLDER_PATH = "./midi/lmd_matched_flat_abc"
+CLEAN_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean"
+TOKENIZED_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean_tokenized"
+SPLIT_FOLDER_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean_split"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="Keep the existing target folders and only run the jobs that are new, changed or failed.")
+    parser.add_argument("--workers", action="append", default=[], metavar="STAGE=N", help="Worker budget of a stage (default: number of CPUs), e.g. --workers sanitize=16.")
+    parser.add_argument("--function-workers", type=int, default=None, help="Size of the process pool shared by the Python stages (default: number of CPUs).")
+    parser.add_argument("--parquet", action="store_true", help="Build the Parquet dataset once every file went through the pipeline.")
+    add_resource_limit_arguments(parser)
+    return parser.parse_args()
+
+def get_path(folder_path: str, item, extension: str = ""):
+    # Items are (track id, arrangement id, source path) tuples
+    track_id, arrangement_id, _ = item
+    return os.path.abspath(os.path.join(folder_path, track_id, arrangement_id + extension))
+
+def iter_items():
+    # One item per MIDI file of the Lakh MIDI dataset, the track being the folder holding it (as flattened by flatten.py)
+    for root, file_paths in get_folder_listing(SOURCE_FOLDER_PATH).walk():
+        for file_path in file_paths:
+            yield (os.path.basename(root), os.path.splitext(os.path.basename(file_path))[0], os.path.abspath(file_path))
+
+def any_success(*stage_names):
+    return lambda outcomes: any(outcomes[stage_name] for stage_name in stage_names)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+
+    workers = {}
+    for argument in arguments.workers:
+        stage_name, _, count = argument.partition("=")
+        workers[stage_name] = int(count)
+
+    musescore_path = verify_software_dependency(os.path.join("musescore", "MuseScore4.exe" if os.name == "nt" else "musescore"))
+    musescore_path = musescore_path if os.name == "posix" else musescore_path.replace('/', '\\')
+    midi2abc_path = verify_software_dependency(os.path.join("abcmidi", "midi2abc.exe" if os.name == "nt" else "midi2abc"))
+    midi2abc_path = midi2abc_path if os.name == "posix" else midi2abc_path.replace('/', '\\')
+
+    midi2abc_command = midi2abc_path + " -f {} -k 0 -obpl -nogr -noly -o {}"
+
+    flatten_results = []
+    digests = {}
+    wrong_abc_files = {}
+    wrong_tokenized_abc_files = {}
+    unused_tokens = set()
+
+    def on_flatten_result(item, result):
+        # The first item of each content is the canonical one, its duplicates copy the outputs of the external tools
+        flatten_results.append(result)
+        canonical_item = digests.setdefault(result[1], item)
+        if canonical_item != item:
+            pipeline.canonical_items[item] = canonical_item
+
+    def on_clean_result(item, result):
+        is_success, from_path, reason = result
+        if not is_success:
+            wrong_abc_files[from_path] = reason
+            print("[clean_abc]", from_path, "is a wrong abc file:", reason)
+
+    def on_tokenize_result(item, result):
+        is_success, from_path, reason_or_unused_tokens, voices = result
+        if not is_success:
+            wrong_tokenized_abc_files[from_path] = reason_or_unused_tokens
+            print("[tokenize_abc]", from_path, "is a wrong abc file:", reason_or_unused_tokens)
+        else:
+            unused_tokens.update(reason_or_unused_tokens)
+            tokenize_abc.add_voices_to_corpus(corpus_writer, from_path, voices)
+
+    timeout_policy = lambda: JobTimeoutPolicy(600, relative_timeout=20)
+    limits = get_resource_limits(arguments)
+    resource_limits = lambda stage_name: ChildResourceLimits("run_pipeline_" + stage_name, **limits) if limits["memory_limit"] is not None or limits["cpu_time_limit"] is not None else None
+
+    # Same stages as the scripts of the quick start, described per MIDI file:
+    # flatten -> (metadata, sanitize -> abc) -> clean (-> abc from the unsanitized MIDI -> clean) -> (tokenize, split)
+    stages = [
+        PipelineStage("flatten", lambda item: (item[2], get_path(FLAT_FOLDER_PATH, item, ".mid")), function=flatten.process_function, output_folder_path=FLAT_FOLDER_PATH, on_result=on_flatten_result),
+        PipelineStage("metadata", lambda item: (get_path(FLAT_FOLDER_PATH, item, ".mid"), get_path(METADATA_FOLDER_PATH, item, ".json")), command=musescore_path + " {} --score-meta", depends_on=["flatten"], output_folder_path=METADATA_FOLDER_PATH, stdout_to_file=True, deduplicate=True, timeout_policy=timeout_policy(), resource_limits=resource_limits("metadata")),
+        PipelineStage("sanitize", lambda item: (get_path(FLAT_FOLDER_PATH, item, ".mid"), get_path(SANITIZED_FOLDER_PATH, item, ".mid")), command=musescore_path + " {} -o {}", depends_on=["flatten"], output_folder_path=SANITIZED_FOLDER_PATH, deduplicate=True, timeout_policy=timeout_policy(), resource_limits=resource_limits("sanitize")),
+        PipelineStage("abc", lambda item: (get_path(SANITIZED_FOLDER_PATH, item, ".mid"), get_path(ABC_FOLDER_PATH, item, ".abc")), command=midi2abc_command, depends_on=["sanitize"], output_folder_path=ABC_FOLDER_PATH, deduplicate=True, substitute_input_path=True, timeout_policy=timeout_policy(), resource_limits=resource_limits("abc")),
+        PipelineStage("clean", lambda item: (get_path(ABC_FOLDER_PATH, item, ".abc"), get_path(CLEAN_FOLDER_PATH, item, ".abc")), function=clean_abc.process_function, depends_on=["abc", "metadata"], output_folder_path=CLEAN_FOLDER_PATH, is_success=lambda result: result[0], on_result=on_clean_result),
+        # ABC files that failed to clean are converted again from the unsanitized MIDI (see clean_abc.py)
+        PipelineStage("abc_unsanitized", lambda item: (get_path(FLAT_FOLDER_PATH, item, ".mid"), get_path(UNSANITIZED_ABC_FOLDER_PATH, item, ".abc")), command=midi2abc_command, depends_on=["clean"], condition=lambda outcomes: outcomes["clean"] is False, output_folder_path=UNSANITIZED_ABC_FOLDER_PATH, deduplicate=True, substitute_input_path=True, timeout_policy=timeout_policy(), resource_limits=resource_limits("abc_unsanitized")),
+        PipelineStage("clean_unsanitized", lambda item: (get_path(UNSANITIZED_ABC_FOLDER_PATH, item, ".abc"), get_path(CLEAN_FOLDER_PATH, item, ".abc")), function=clean_abc.process_function, depends_on=["abc_unsanitized"], is_success=lambda result: result[0], on_result=on_clean_result),
+        PipelineStage("tokenize", lambda item: (get_path(CLEAN_FOLDER_PATH, item, ".abc"), get_path(TOKENIZED_FOLDER_PATH, item)), function=tokenize_abc.process_function, depends_on=["clean", "clean_unsanitized"], condition=any_success("clean", "clean_unsanitized"), output_folder_path=TOKENIZED_FOLDER_PATH, is_success=lambda result: result[0], on_result=on_tokenize_result, manifest_result=tokenize_abc.get_manifest_result, manifest_result_check=lambda result: manifest_result_check(result)),
+        PipelineStage("split", lambda item: (get_path(CLEAN_FOLDER_PATH, item, ".abc"), get_path(SPLIT_FOLDER_PATH, item)), function=split_abc_tracks.process_function, depends_on=["clean", "clean_unsanitized"], condition=any_success("clean", "clean_unsanitized"), output_folder_path=SPLIT_FOLDER_PATH),
+    ]
+
+    for stage in stages:
+        stage.workers = workers.pop(stage.name, stage.workers)
+    if len(workers) > 0:
+        print("[run_pipeline] Unknown stage(s): {}.".format(", ".join(workers)))
+        sys.exit(1)
+
+    pipeline = StreamingPipeline("run_pipeline", stages, arguments.resume, arguments.function_workers)
+    # The metadata stage writes the metadata again, the workers read the JSON files until the index is compiled at the end
+    metadata_index.invalidate_metadata_index(METADATA_FOLDER_PATH)
+    # Only opened once the target folders are checked, as it starts the corpus over without resume
+    corpus_writer = token_corpus.TokenCorpusWriter(tokenize_abc.TOKEN_CORPUS_PATH, arguments.resume)
+    manifest_result_check = tokenize_abc.get_manifest_result_check(corpus_writer)
+    with WorkerPool("run_pipeline", arguments.function_workers, [clean_abc.warm_up, tokenize_abc.warm_up]) as pool:
+        pipeline.run(iter_items(), pool)
+
+# region Outputs written once every file went through the pipeline
+
+    corpus_writer.close()
+
+    with open("./results/deduplication_index.json", "w", encoding="utf8") as index_file:
+        json.dump(flatten.build_deduplication_index(flatten_results, FLAT_FOLDER_PATH), index_file)
+
+    # A file cleaned from its unsanitized MIDI is no longer wrong
+    wrong_abc_files = {from_path: reason for from_path, reason in wrong_abc_files.items() if not os.path.exists(os.path.join(CLEAN_FOLDER_PATH, os.path.basename(os.path.dirname(from_path)), os.path.basename(from_path)))}
+
+    with open("./results/failed_jobs_clean_abc.json", "w") as wrong_file:
+        json.dump(wrong_abc_files, wrong_file)
+
+    with open("./results/failed_jobs_clean_abc_tokenize.json", "w") as wrong_file:
+        json.dump(wrong_tokenized_abc_files, wrong_file)
+
+    with open("./results/unused_tokens_clean_abc_tokenize.json", "w") as wrong_file:
+        json.dump(list(unused_tokens), wrong_file)
+
+    count = metadata_index.compile_metadata_index(METADATA_FOLDER_PATH)
+    print("[run_pipeline] {} metadata file(s) compiled to {}.".format(count, metadata_index.get_index_path(METADATA_FOLDER_PATH)))
+
+# endregion
+
+    if arguments.parquet:
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_parquet_dataset.py")], check=True)
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+
+sys.path.append(os.path.dirname("scripts"))
+from data_pipeline_lib import Process, get_resource_limits, invalidate_folder_listing, load_deduplication_index, parse_process_arguments, verify_software_dependency
+import metadata_index
+
+
+METADATA_FOLDER_PATH = metadata_index.METADATA_FOLDER_PATH
+
+
+def path_converter(from_path: str, is_folder: bool):
+    return os.path.basename(from_path) if is_folder else os.path.basename(from_path).replace(".midi", ".mid")
+
+def get_metadata_path(to_path: str):
+    track_folder_path, file_name = os.path.split(to_path)
+    return os.path.abspath(os.path.join(METADATA_FOLDER_PATH, os.path.basename(track_folder_path), os.path.splitext(file_name)[0] + ".json"))
+
+def get_metajson_path(metadata_path: str):
+    # MuseScore picks its exporter from the output extension
+    return os.path.splitext(metadata_path)[0] + ".metajson"
+
+def job_converter(from_path: str, to_path: str):
+    metadata_path = get_metadata_path(to_path)
+    os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+    return (from_path, to_path, metadata_path if os.name == "posix" else metadata_path.replace("/", "\\"))
+
+def musescore_batch_job(job):
+    # One load of the MIDI file exports both the sanitized MIDI and the score metadata
+    return {"in": job[0], "out": [job[1], get_metajson_path(job[2])]}
+
+def move_metadata(job):
+    with open(get_metajson_path(job[2]), "r", encoding="utf8") as metajson_file:
+        metadata = json.load(metajson_file)
+
+    # Same layout as the output of --score-meta used by generate_metadata.py
+    if "metadata" not in metadata:
+        metadata = {"metadata": metadata}
+
+    with open(job[2], "w", encoding="utf8") as json_file:
+        json.dump(metadata, json_file)
+
+    os.remove(get_metajson_path(job[2]))
+
+
+if __name__ == "__main__":
+    arguments = parse_process_arguments(resource_limits=True, sharding=True)
+
+    if not (arguments.resume or arguments.shard is not None) and os.path.exists(METADATA_FOLDER_PATH):
+        print("[sanitize_midi_and_generate_metadata] Target directory ({}) already exists.".format(METADATA_FOLDER_PATH))
+        sys.exit(1)
+
+    process = Process("sanitize_midi_and_generate_metadata", "./midi/lmd_matched_flat", "./midi/lmd_matched_flat_sanitized", resume=arguments.resume, shard=arguments.shard)
+
+    musescore_path = verify_software_dependency(os.path.join("musescore", "MuseScore4.exe" if os.name == "nt" else "musescore"))
+    musescore_path = musescore_path if os.name == "posix" else musescore_path.replace('/', '\\')
+
+    batch_command = musescore_path + " -j {}"
+
+    # The compiled index would no longer match the metadata written by this stage
+    metadata_index.invalidate_metadata_index(METADATA_FOLDER_PATH)
+
+    # Files that fail within a batch are retried on their own, in a batch job file of one
+    process.step_by_popen(None, process.plan_jobs(path_converter, job_converter), [bytearray(), bytearray()], True, True, 10, deduplication_index=load_deduplication_index(), batch_size=16, batch_command=batch_command, batch_job_converter=musescore_batch_job, job_success_callback=move_metadata, adaptive_concurrency=True, job_timeout=600, relative_job_timeout=20, longest_job_first=True, small_job_slots=1, **get_resource_limits(arguments))
+
+    # The metadata folder is written next to the target folder
+    invalidate_folder_listing(METADATA_FOLDER_PATH)
@@ -2,38 +2,48 @@ import os
 import sys
 
 sys.path.append(os.path.dirname("scripts"))
-from data_pipeline_lib import Process
+from data_pipeline_lib import Process, join_path, make_folders, packed_open, parse_process_arguments
+
+
+# "packed" writes the track files to a few large shard files of the target folder instead of one file per track (see PackedStore)
+STORAGE = "files"
 
 
 def path_converter(from_path: str, is_folder: bool):
     return os.path.basename(from_path) if is_folder else os.path.basename(from_path).replace(".abc", "")
 
+def split_abc_lines(lines: list[str]):
+    track_data = {}
+    track = 0
+    header = ""
+
+    for line in lines:
+        if line.replace(" ", "").startswith("V:"):
+            track += 1
+            track_data[track] = [header]
+            continue
+
+        if track == 0:
+            header += line
+        else:
+            track_data[track].append(line)
+
+    return track_data
+
+def write_tracks(track_data: dict, to_path: str):
+    for track_num, data in track_data.items():
+        track_path = join_path(to_path, f"track {track_num}.abc")
+        with packed_open(track_path, 'w') as f:
+            f.writelines(data)
+
 def process_function(from_path: str, to_path: str):
     try:
-        os.makedirs(to_path, exist_ok=True)
+        make_folders(to_path)
 
-        with open(from_path, 'r') as abc_file:
+        with packed_open(from_path, 'r') as abc_file:
             lines = abc_file.readlines()
 
-        track_data = {}
-        track = 0
-        header = ""
-
-        for line in lines:
-            if line.replace(" ", "").startswith("V:"):
-                track += 1
-                track_data[track] = [header]
-                continue
-
-            if track == 0:
-                header += line
-            else:
-                track_data[track].append(line)
-
-        for track_num, data in track_data.items():
-            track_path = os.path.join(to_path, f"track {track_num}.abc")
-            with open(track_path, 'w') as f:
-                f.writelines(data)
+        write_tracks(split_abc_lines(lines), to_path)
     except Exception as e:
         import traceback
         print(f"[Process Function Error] Failed for {from_path} -> {to_path} with exception \"{e}\": " + traceback.format_exc())
@@ -41,5 +51,7 @@ def process_function(from_path: str, to_path: str):
 
 
 if __name__ == "__main__":
-    process = Process("split_abc_tracks", "./midi/lmd_matched_flat_sanitized_abc_clean", "./midi/lmd_matched_flat_sanitized_abc_clean_split")
-    process.step_by_function(process_function, path_converter, useProcessExecutor=True)
+    arguments = parse_process_arguments(sharding=True)
+
+    process = Process("split_abc_tracks", "./midi/lmd_matched_flat_sanitized_abc_clean", "./midi/lmd_matched_flat_sanitized_abc_clean_split", resume=arguments.resume, storage=STORAGE, shard=arguments.shard)
+    process.step_by_function(process_function, path_converter, useProcessExecutor=True, adaptive_chunking=True)
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import mmap
+import array
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Closed token set of the tokenizer (see REPORT.md), the id of a token being its index in VOCABULARY
+UNKNOWN_TOKEN = "<unk>"
+SYMBOL_TOKENS = ["|", "[", "]", "z"]
+DURATION_TOKENS = [str(duration) for duration in [0.0625, 0.125, 0.1875, 0.25, 0.375, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0, 12.0, 16.0, 24.0, 32.0, 48.0, 64.0]]
+
+# Notes of the MIDI range (C-1 to G9), naturals being written with or without "n" depending on the carried accidentals
+NOTE_NAMES = [("C", 0), ("C#", 1), ("Cn", 0), ("D", 2), ("D#", 3), ("Dn", 2), ("E", 4), ("F", 5), ("F#", 6), ("Fn", 5), ("G", 7), ("G#", 8), ("Gn", 7), ("A", 9), ("A#", 10), ("An", 9), ("B", 11)]
+PITCH_TOKENS = ["{}{}".format(name, octave) for octave in range(-1, 10) for name, semitone in NOTE_NAMES if (octave + 1) * 12 + semitone <= 127]
+
+VOCABULARY = [UNKNOWN_TOKEN] + SYMBOL_TOKENS + DURATION_TOKENS + PITCH_TOKENS
+TOKEN_TO_ID = {token: i for i, token in enumerate(VOCABULARY)}
+
+# uint8 while the vocabulary allows it, uint16 otherwise
+TYPECODE = "B" if len(VOCABULARY) <= 256 else "H"
+
+INDEX_SCHEMA = pa.schema([
+    ("track_id", pa.string()),
+    ("arrangement_id", pa.string()),
+    ("voice_index", pa.int32()),
+    ("offset", pa.int64()),
+    ("length", pa.int64()),
+    ("unknown_count", pa.int32()),
+    # Strings of the tokens stored as UNKNOWN_TOKEN, in their order in the voice
+    ("unknown_tokens", pa.list_(pa.string())),
+])
+
+
+def encode_tokens(tokens: list[str]):
+    # Tokens outside of the vocabulary are stored as UNKNOWN_TOKEN, their strings being returned in order besides the ids
+    ids = array.array(TYPECODE, [TOKEN_TO_ID.get(token, 0) for token in tokens])
+    return ids, [token for token, token_id in zip(tokens, ids) if token_id == 0]
+
+def decode_ids(ids, unknown_tokens: list[str] = None) -> list[str]:
+    # The original strings of the unknown tokens are put back when given
+    unknown_tokens = iter(unknown_tokens if unknown_tokens is not None else [])
+    return [VOCABULARY[i] if i != 0 else next(unknown_tokens, UNKNOWN_TOKEN) for i in ids]
+
+def get_index_path(corpus_path: str):
+    return corpus_path + ".index.parquet"
+
+def get_previous_path(corpus_path: str):
+    return corpus_path + ".previous"
+
+def get_journal_path(corpus_path: str):
+    return corpus_path + ".journal.jsonl"
+
+
+class TokenCorpusWriter:
+    """
+    Appends the token ids of each voice to a single corpus file, the offsets being written
+    to a Parquet index (sorted by track, arrangement and voice) when closed.
+    Until then, the voices of each arrangement are also appended to a journal once their ids are written, so that
+    an interrupted corpus is continued by the next resumed run instead of being lost.
+
+    With resume, a complete previous corpus is kept aside while the new one is written, so that the voices of the files
+    a resumed run skips are copied from it (see add_previous) instead of being recorded in the completion manifest.
+    """
+
+    def __init__(self, corpus_path: str, resume: bool = False):
+        self.corpus_path = corpus_path
+        self.previous = None
+        self.rows = []
+        self.offset = 0
+        # Arrangements of an interrupted corpus, replaced if they are added again
+        self.journaled_arrangements = set()
+
+        previous_path = get_previous_path(corpus_path)
+        journal_path = get_journal_path(corpus_path)
+        is_continued = resume and not os.path.exists(get_index_path(corpus_path)) and os.path.exists(journal_path)
+        if resume and os.path.exists(get_index_path(corpus_path)):
+            # The last run completed its corpus, which becomes the previous one
+            os.replace(corpus_path, previous_path)
+            os.replace(get_index_path(corpus_path), get_index_path(previous_path))
+        elif is_continued:
+            # The last run was interrupted, its corpus is continued (the previous one, if any, is still the last complete corpus)
+            self.load_journal(journal_path)
+        else:
+            for path in [get_index_path(corpus_path), journal_path] + ([] if resume else [previous_path, get_index_path(previous_path)]):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if resume and os.path.exists(get_index_path(previous_path)):
+            self.previous = TokenCorpus(previous_path)
+
+        if is_continued:
+            # Ids written after the last journaled voice are dropped
+            os.truncate(corpus_path, self.offset * array.array(TYPECODE).itemsize)
+        self.corpus_file = open(corpus_path, "ab" if is_continued else "wb")
+        self.journal_file = open(journal_path, "a" if is_continued else "w", encoding="utf8")
+
+    def load_journal(self, journal_path: str):
+        with open(journal_path, "r", encoding="utf8") as journal_file:
+            for line in journal_file:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # Last line of an interrupted write
+                    break
+                if isinstance(row, dict):
+                    self.remove_arrangement(*row["remove"])
+                else:
+                    # All the voices of an arrangement are on one line
+                    for voice_row in row:
+                        self.rows.append(tuple(voice_row))
+                        self.offset = max(self.offset, voice_row[3] + voice_row[4])
+        self.journaled_arrangements = {row[:2] for row in self.rows}
+
+    def remove_arrangement(self, track_id: str, arrangement_id: str):
+        self.rows = [row for row in self.rows if row[:2] != (track_id, arrangement_id)]
+
+    def write_journal(self, row):
+        self.journal_file.write(json.dumps(row) + "\n")
+        self.journal_file.flush()
+
+    def add_arrangement(self, track_id: str, arrangement_id: str, voices: list):
+        # voices: (voice index, ids bytes, unknown token strings) of each voice of the arrangement
+        if (track_id, arrangement_id) in self.journaled_arrangements:
+            # Added again by the resumed run (e.g. its input changed), the voices of the interrupted run are replaced
+            self.journaled_arrangements.discard((track_id, arrangement_id))
+            self.remove_arrangement(track_id, arrangement_id)
+            self.write_journal({"remove": [track_id, arrangement_id]})
+
+        rows = []
+        for voice_index, ids, unknown_tokens in voices:
+            self.corpus_file.write(ids)
+            length = len(ids) // array.array(TYPECODE).itemsize
+            rows.append((track_id, arrangement_id, voice_index, self.offset, length, len(unknown_tokens), unknown_tokens))
+            self.offset += length
+        self.corpus_file.flush()
+        self.rows += rows
+        self.write_journal(rows)
+
+    def has_voices(self, track_id: str, arrangement_id: str):
+        # Whether add_previous finds the voices of an arrangement
+        return (track_id, arrangement_id) in self.journaled_arrangements or (self.previous is not None and len(self.previous.find(track_id, arrangement_id)) > 0)
+
+    def add_previous(self, track_id: str, arrangement_id: str):
+        # Copies the voices of an arrangement from the previous corpus, False when it is not there
+        if (track_id, arrangement_id) in self.journaled_arrangements:
+            # Already added by the interrupted run
+            return True
+        indices = self.previous.find(track_id, arrangement_id) if self.previous is not None else []
+        if len(indices) > 0:
+            self.add_arrangement(track_id, arrangement_id, [(self.previous.voice_indices[i], self.previous.ids(i).tobytes(), self.previous.get_unknown_tokens(i) or [UNKNOWN_TOKEN] * self.previous.unknown_counts[i]) for i in indices])
+        return len(indices) > 0
+
+    def close(self):
+        self.corpus_file.close()
+        self.journal_file.close()
+
+        self.rows.sort()
+        columns = list(zip(*self.rows)) if self.rows else [[] for _ in INDEX_SCHEMA]
+
+        metadata = {"vocabulary": json.dumps(VOCABULARY), "typecode": TYPECODE, "byteorder": sys.byteorder}
+        table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, INDEX_SCHEMA)], schema=INDEX_SCHEMA.with_metadata(metadata))
+        # Written aside first, an index being what tells a complete corpus
+        pq.write_table(table, get_index_path(self.corpus_path) + ".tmp", compression="zstd")
+        os.replace(get_index_path(self.corpus_path) + ".tmp", get_index_path(self.corpus_path))
+
+        # The journal and the previous corpus are only removed once the new corpus is complete
+        os.remove(get_journal_path(self.corpus_path))
+        if self.previous is not None:
+            self.previous.close()
+            previous_path = get_previous_path(self.corpus_path)
+            os.remove(previous_path)
+            os.remove(get_index_path(previous_path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TokenCorpus:
+    """
+    Memory maps a corpus written by TokenCorpusWriter: ids(i) is a zero-copy view on the token ids of the i-th voice of the index.
+    """
+
+    def __init__(self, corpus_path: str):
+        self.index = pq.read_table(get_index_path(corpus_path))
+
+        metadata = self.index.schema.metadata
+        self.vocabulary = json.loads(metadata[b"vocabulary"])
+        typecode = metadata[b"typecode"].decode()
+        if metadata[b"byteorder"].decode() != sys.byteorder and typecode != "B":
+            raise ValueError("{} was written with a different byte order".format(corpus_path))
+
+        self.track_ids = self.index.column("track_id").to_pylist()
+        self.arrangement_ids = self.index.column("arrangement_id").to_pylist()
+        self.voice_indices = self.index.column("voice_index").to_pylist()
+        self.offsets = self.index.column("offset").to_pylist()
+        self.lengths = self.index.column("length").to_pylist()
+        self.unknown_counts = self.index.column("unknown_count").to_pylist()
+        # Only converted to Python objects when looked up, missing from corpora written before it was kept
+        self.unknown_tokens = self.index.column("unknown_tokens").combine_chunks() if "unknown_tokens" in self.index.column_names else None
+        self.arrangements = None
+
+        with open(corpus_path, "rb") as corpus_file:
+            # mmap does not accept empty files
+            self.mmap = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets and sum(self.lengths) > 0 else None
+        self.data = memoryview(self.mmap if self.mmap is not None else b"").cast(typecode)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def key(self, i: int):
+        return self.track_ids[i], self.arrangement_ids[i], self.voice_indices[i]
+
+    def find(self, track_id: str, arrangement_id: str):
+        # Indices of the voices of an arrangement, the lookup table being built on first use
+        if self.arrangements is None:
+            self.arrangements = {}
+            for i, key in enumerate(zip(self.track_ids, self.arrangement_ids)):
+                self.arrangements.setdefault(key, []).append(i)
+        return self.arrangements.get((track_id, arrangement_id), [])
+
+    def ids(self, i: int):
+        return self.data[self.offsets[i]:self.offsets[i] + self.lengths[i]]
+
+    def array(self):
+        # Zero-copy Arrow view on all the token ids (to_numpy() is zero-copy as well)
+        return pa.Array.from_buffers(pa.uint8() if self.data.format == "B" else pa.uint16(), len(self.data), [None, pa.py_buffer(self.data)])
+
+    def get_unknown_tokens(self, i: int):
+        # Original strings of the unknown tokens of the i-th voice, None when the corpus does not have them
+        if self.unknown_tokens is None:
+            return None
+        return self.unknown_tokens[i].as_py() if self.unknown_counts[i] > 0 else []
+
+    def tokens(self, i: int) -> list[str]:
+        unknown_tokens = iter(self.get_unknown_tokens(i) or [])
+        return [self.vocabulary[token_id] if token_id != 0 else next(unknown_tokens, self.vocabulary[0]) for token_id in self.ids(i)]
+
+    def close(self):
+        self.data.release()
+        if self.mmap is not None:
+            self.mmap.close()
@@ -5,9 +5,16 @@ import pickle
 import music21
 
 sys.path.append(os.path.dirname("scripts"))
-from data_pipeline_lib import Process
+from data_pipeline_lib import Process, WorkerPool, parse_process_arguments
+import abc_lexer
+import token_corpus
+import metadata_index
 
 
+# The voice token ids go to a single memory-mappable corpus, pickles of the token strings are only kept on demand
+TOKEN_CORPUS_PATH = "./midi/lmd_matched_flat_sanitized_abc_clean_tokenized.bin"
+WRITE_VOICE_PICKLES = False
+
 # https://en.wikipedia.org/wiki/General_MIDI
 GENERAL_MIDI_PROGRAM_CATEGORIES = {
     1:  "Piano",
@@ -179,6 +186,22 @@ GENERAL_MIDI_PROGRAM_INSTRUMENTS_MAPPING = {
 }
 
 
+# Program names in program id order
+GENERAL_MIDI_PROGRAM_NAMES = list(GENERAL_MIDI_PROGRAM_INSTRUMENTS_MAPPING)
+
+# Tokenized by each worker when it starts, so that its first file does not pay for the first use of music21
+WARM_UP_ABC = "X:1\nM: 4/4\nL:1/8\nK:C \nV:1\n%%MIDI program 0\nC D E [CEG]2|z2 C/2D/2|\n"
+
+
+def warm_up():
+    # WorkerPool initializer: the lexer, music21's ABC parser (its fallback) and the metadata index are initialized once per worker
+    abc_lexer.split_voices_tokens(WARM_UP_ABC)
+    abc = music21.abcFormat.ABCHandler()
+    abc.process(WARM_UP_ABC)
+    for voice in abc.splitByVoice():
+        voice_to_tokens(voice)
+    metadata_index.get_metadata_index(metadata_index.METADATA_FOLDER_PATH)
+
 def path_converter(from_path: str, is_folder: bool):
     return os.path.basename(from_path) if is_folder else os.path.basename(from_path).replace(".abc", "")
 
@@ -213,75 +236,119 @@ def voice_to_tokens(voice):
             unused_tokens.add(str(token.src))
     return tokens, unused_tokens
 
-def process_function(from_path: str, to_path: str):
-    os.makedirs(to_path, exist_ok=True)
+def get_voices_tokens(data: str, abc=None):
+    # Tokens of each voice after the common header: the lexer covers what midi2abc writes, music21 (or the already processed abc) handles the rest
+    try:
+        return abc_lexer.split_voices_tokens(data)[1:]
+    except abc_lexer.ABCLexerError:
+        if abc is None:
+            abc = music21.abcFormat.ABCHandler()
+            abc.process(data)
+        return [voice_to_tokens(voice) for voice in abc.splitByVoice()[1:]]
 
+def get_voice_instrument_changes(data: str):
+    return [voice.find("%%MIDI program ") + voice.find("%%MIDI channel ") != -2 for voice in data.split("V:")[1:]]
+
+def write_voice_tokens(from_path: str, to_path: str, voices_tokens, metadata, data_voice_has_instrument_change: list[bool]):
     unused_tokens = set()
 
+    voice_midi_program_dict = {}
+    voices = []
+    is_there_a_voice = False
+
+    part_index = -1
+    for i, (tokens, local_unused_tokens) in enumerate(voices_tokens):
+        is_there_a_voice = True
+
+        if data_voice_has_instrument_change[i]:
+            part_index += 1
+
+        program_id = 0 if metadata["metadata"]["parts"][part_index]["hasDrumStaff"] == "true" else (metadata["metadata"]["parts"][part_index]["program"] + 1)
+        program_name = GENERAL_MIDI_PROGRAM_NAMES[program_id]
+        category_id = GENERAL_MIDI_PROGRAM_INSTRUMENTS_MAPPING[program_name]
+        category_name = GENERAL_MIDI_PROGRAM_CATEGORIES[category_id]
+
+        voice_midi_program_dict[i] = {
+            "program_id": program_id,
+            "program_name": program_name,
+            "category_id": category_id,
+            "category_name": category_name,
+            "musescore_info": metadata["metadata"]["parts"][part_index]
+        }
+
+        ids, unknown_tokens = token_corpus.encode_tokens(tokens)
+        voices.append((i, ids.tobytes(), unknown_tokens))
+        unused_tokens.update(local_unused_tokens)
+
+        if WRITE_VOICE_PICKLES:
+            path = os.path.join(to_path, "voice_{}.pkl".format(i))
+            with open(path, "wb") as token_file:
+                pickle.dump(tokens, token_file)
+
+    if not is_there_a_voice:
+        return (False, from_path, "no voices found", None)
+
+    path = os.path.join(to_path, "metadata.json")
+    with open(path, "w", encoding="utf8") as metadata_file:
+        json.dump(voice_midi_program_dict, metadata_file)
+
+    return (True, from_path, unused_tokens, voices)
+
+def get_manifest_result(result):
+    # The voices are left out of the completion manifest, a resumed run copies them from the previous token corpus
+    return result[:3] + (None,)
+
+def get_arrangement_key(from_path: str):
+    return os.path.basename(os.path.dirname(from_path)), path_converter(from_path, False)
+
+def get_manifest_result_check(corpus_writer: token_corpus.TokenCorpusWriter):
+    # Files whose voices are in neither the interrupted nor the previous corpus are tokenized again
+    def manifest_result_check(result):
+        is_success, from_path, _, _ = result
+        return not is_success or corpus_writer.has_voices(*get_arrangement_key(from_path))
+    return manifest_result_check
+
+def add_voices_to_corpus(corpus_writer: token_corpus.TokenCorpusWriter, from_path: str, voices):
+    track_id, arrangement_id = get_arrangement_key(from_path)
+
+    if voices is None:
+        if not corpus_writer.add_previous(track_id, arrangement_id):
+            print("[tokenize_abc] Voices of {} are not in the previous token corpus, run without --resume to tokenize it again.".format(from_path))
+        return
+
+    corpus_writer.add_arrangement(track_id, arrangement_id, voices)
+
+def process_function(from_path: str, to_path: str):
+    os.makedirs(to_path, exist_ok=True)
+
     with open(from_path) as abc_file:
         data = abc_file.read()
 
-    data_voice_has_instrument_change = [voice.find("%%MIDI program ") + voice.find("%%MIDI channel ") != -2 for voice in data.split("V:")[1:]]
+    data_voice_has_instrument_change = get_voice_instrument_changes(data)
 
     if not data_voice_has_instrument_change[0]:
-        return (False, from_path, "no instrument change at start")
+        return (False, from_path, "no instrument change at start", None)
 
     try:
-        abc = music21.abcFormat.ABCHandler()
-        abc.process(data)
+        voices_tokens = get_voices_tokens(data)
 
         metadata_path = get_metadata_from_midi_path(from_path)
         if metadata_path == None:
-            return (False, from_path, "could not create associated metadata path")
-        if not os.path.exists(metadata_path):
-            return (False, from_path, "metadata path does not exist")
-        with open(metadata_path, "r", encoding="utf8") as metadata_file:
-            metadata = json.load(metadata_file)
-
-        voice_midi_program_dict = {}
-        is_there_a_voice = False
-
-        part_index = -1
-        for i, voice in enumerate(abc.splitByVoice()[1:]):
-            is_there_a_voice = True
-
-            if data_voice_has_instrument_change[i]:
-                part_index += 1
-
-            program_id = 0 if metadata["metadata"]["parts"][part_index]["hasDrumStaff"] == "true" else (metadata["metadata"]["parts"][part_index]["program"] + 1)
-            program_name = list(GENERAL_MIDI_PROGRAM_INSTRUMENTS_MAPPING.keys())[program_id]
-            category_id = GENERAL_MIDI_PROGRAM_INSTRUMENTS_MAPPING[program_name]
-            category_name = GENERAL_MIDI_PROGRAM_CATEGORIES[category_id]
-
-            voice_midi_program_dict[i] = {
-                "program_id": program_id,
-                "program_name": program_name,
-                "category_id": category_id,
-                "category_name": category_name,
-                "musescore_info": metadata["metadata"]["parts"][part_index]
-            }
-
-            path = os.path.join(to_path, "voice_{}.pkl".format(i))
-            with open(path, "wb") as token_file:
-                tokens, local_unused_tokens = voice_to_tokens(voice)
-                pickle.dump(tokens, token_file)
-                unused_tokens.update(local_unused_tokens)
+            return (False, from_path, "could not create associated metadata path", None)
+        metadata = metadata_index.load_metadata(metadata_path)
+        if metadata is None:
+            return (False, from_path, "metadata path does not exist", None)
 
-        if not is_there_a_voice:
-            return (False, from_path, "no voices found")
-
-        path = os.path.join(to_path, "metadata.json")
-        with open(path, "w", encoding="utf8") as metadata_file:
-            json.dump(voice_midi_program_dict, metadata_file)
+        return write_voice_tokens(from_path, to_path, voices_tokens, metadata, data_voice_has_instrument_change)
 
     except Exception as e:
         import traceback
-        return (False, from_path, "Error \"{}\" : ".format(e) + traceback.format_exc())
-
-    return (True, from_path, unused_tokens)
+        return (False, from_path, "Error \"{}\" : ".format(e) + traceback.format_exc(), None)
 
 
 if __name__ == "__main__":
+    arguments = parse_process_arguments()
+
     wrong_abc_files = {}
     unused_tokens = set()
 
@@ -289,15 +356,17 @@ if __name__ == "__main__":
         wrong_abc_files.update({from_path: reason})
         print("[tokenize_abc]", from_path, "is a wrong abc file:", reason)
 
-    process = Process("tokenize_abc", "./midi/lmd_matched_flat_sanitized_abc_clean", "./midi/lmd_matched_flat_sanitized_abc_clean_tokenized")
-    results = process.step_by_function(process_function, path_converter=path_converter, useProcessExecutor=True)
-
-    for res in results:
-        is_success, from_path, reason_or_unused_tokens = res
-        if not is_success:
-            wrong_abc(from_path, reason_or_unused_tokens)
-        else:
-            unused_tokens.update(reason_or_unused_tokens)
+    process = Process("tokenize_abc", "./midi/lmd_matched_flat_sanitized_abc_clean", "./midi/lmd_matched_flat_sanitized_abc_clean_tokenized", resume=arguments.resume)
+
+    # Rewritten on every run, voices of files skipped on resume being copied from the previous corpus
+    with token_corpus.TokenCorpusWriter(TOKEN_CORPUS_PATH, arguments.resume) as corpus_writer, WorkerPool("tokenize_abc", initializers=[warm_up]) as pool:
+        for res in process.iter_by_function(process_function, path_converter=path_converter, adaptive_chunking=True, executor=pool, manifest_result=get_manifest_result, manifest_result_check=get_manifest_result_check(corpus_writer)):
+            is_success, from_path, reason_or_unused_tokens, voices = res
+            if not is_success:
+                wrong_abc(from_path, reason_or_unused_tokens)
+            else:
+                unused_tokens.update(reason_or_unused_tokens)
+                add_voices_to_corpus(corpus_writer, from_path, voices)
 
     with open("./results/failed_jobs_clean_abc_tokenize.json", "w") as wrong_file:
         json.dump(wrong_abc_files, wrong_file)